@@ -0,0 +1,186 @@
+import asyncio
+import concurrent.futures
+import io
+import logging
+import urllib.parse
+
+# An asyncio front end for the server.  With ThreadingHTTPServer every device
+# request holds a thread for as long as it waits for work, so the number of
+# threads grows with the number of boards.  Here a waiting device request is
+# a coroutine waiting on an asyncio.Event per board, set whenever the
+# client's condition is notified, and costs a socket rather than a thread.
+#
+# Only the waiting moves.  Every response is still produced by the
+# BaseHTTPRequestHandler of server.py, run over an in-memory copy of the
+# request, so what goes back to the board is byte for byte the same.
+# Control plane requests, which render, run on a thread pool.
+
+# The largest request, headers included, that is accepted.
+MAX_REQUEST_BYTES = 64 * 1024
+
+def bufferedHandler(handlerClass):
+  # A subclass of handlerClass that handles a request read by the event loop
+  # and writes the response to memory.  For device requests the acknowledgement
+  # has already been applied and the block found, deviceResult, or None if
+  # there was no work.
+  class BufferedHandler(handlerClass):
+    def __init__(self, clientManager, requestBytes, clientAddress, deviceResult=None):
+      self.requestBytes = requestBytes
+      self.deviceResult = deviceResult
+      super(BufferedHandler, self).__init__(clientManager, None, clientAddress, None)
+
+    def setup(self):
+      self.rfile = io.BytesIO(self.requestBytes)
+      self.wfile = io.BytesIO()
+
+    def handle(self):
+      # Just the one request.  close_connection is left as the request asked
+      # for and the event loop keeps the connection open or closes it.
+      self.close_connection = True
+      self.handle_one_request()
+
+    def finish(self):
+      pass
+
+    def getNextDeviceBlock(self, clientId, ackBlockNumber):
+      if self.deviceResult is None:
+        self.sendDeviceEmptyResult()
+      else:
+        (blockNumber, header, body) = self.deviceResult
+        self.sendDeviceResult(header, body)
+
+  return BufferedHandler
+
+async def readRequest(reader):
+  # The request line, headers and body, or None if the connection closed
+  # first.
+  try:
+    head = await reader.readuntil(b"\r\n\r\n")
+  except asyncio.IncompleteReadError:
+    return None
+  contentLength = 0
+  for line in head.split(b"\r\n")[1:]:
+    (name, sep, value) = line.partition(b":")
+    if name.strip().lower() == b"content-length":
+      contentLength = int(value.strip())
+  if len(head) + contentLength > MAX_REQUEST_BYTES:
+    raise ValueError("Request too large")
+  return head + await reader.readexactly(contentLength)
+
+
+class AsyncServer(object):
+  def __init__(self, clientManager, handlerClass, port, devicePrefix, clientIdArg,
+      deviceWaitSeconds, threads, keepAliveSeconds):
+    self.clientManager = clientManager
+    self.handlerClass = bufferedHandler(handlerClass)
+    self.port = port
+    self.devicePrefix = devicePrefix
+    self.clientIdArg = clientIdArg
+    self.deviceWaitSeconds = deviceWaitSeconds
+    self.keepAliveSeconds = keepAliveSeconds
+    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads,
+        thread_name_prefix="render")
+    self.loop = None
+    # clientId -> (Client, asyncio.Event set whenever that client's queue
+    # changes).  An evicted client's event goes with it.
+    self.events = {}
+    clientManager.addEvictionListener(self.onEvicted)
+
+  def serve(self):
+    asyncio.run(self.run())
+
+  async def run(self):
+    self.loop = asyncio.get_running_loop()
+    server = await asyncio.start_server(self.handleConnection, None, self.port,
+        limit=MAX_REQUEST_BYTES)
+    logging.info("run - serving with asyncio; port: %d", self.port)
+    async with server:
+      await server.serve_forever()
+
+  def getEvent(self, c):
+    # The client is compared as well as its id since a client brought back
+    # from cold storage is a new Client with a new condition.
+    entry = self.events.get(c.clientId)
+    if entry is None or entry[0] is not c:
+      event = asyncio.Event()
+      entry = (c, event)
+      self.events[c.clientId] = entry
+      c.condition.addListener(lambda: self.loop.call_soon_threadsafe(event.set))
+    return entry[1]
+
+  def onEvicted(self, c):
+    if self.loop is not None:
+      self.loop.call_soon_threadsafe(self.forgetEvent, c)
+
+  def forgetEvent(self, c):
+    entry = self.events.get(c.clientId)
+    if entry is not None and entry[0] is c:
+      del self.events[c.clientId]
+
+  async def handleConnection(self, reader, writer):
+    # Requests are answered one after the other for as long as the client
+    # keeps the connection open, and it is closed once it has been idle for
+    # keepAliveSeconds.
+    clientAddress = writer.get_extra_info("peername")
+    try:
+      while True:
+        try:
+          request = await asyncio.wait_for(readRequest(reader), self.keepAliveSeconds)
+        except asyncio.TimeoutError:
+          return
+        if request is None:
+          return
+        path = request.split(b" ", 2)[1].decode("latin-1")
+        if path.startswith(self.devicePrefix):
+          try:
+            deviceResult = await self.getDeviceResult(path)
+          except (KeyError, ValueError):
+            # Bad arguments, the handler answers with the error.
+            deviceResult = None
+          handler = self.handlerClass(self.clientManager, request, clientAddress, deviceResult)
+        else:
+          handler = await self.loop.run_in_executor(self.executor, self.handlerClass,
+              self.clientManager, request, clientAddress)
+        writer.write(handler.wfile.getvalue())
+        await writer.drain()
+        if handler.close_connection:
+          return
+    except (ConnectionError, asyncio.LimitOverrunError, ValueError, IndexError) as e:
+      logging.info("handleConnection - dropping connection; clientAddress: %s, e: %s",
+          clientAddress, str(e))
+    finally:
+      writer.close()
+
+  async def getDeviceResult(self, path):
+    # Apply the acknowledgement and wait, without holding a thread, for the
+    # next block.  Returns what Client.getNextBlock would have or None if
+    # there was still no work after deviceWaitSeconds.
+    args = urllib.parse.parse_qs(urllib.parse.urlparse(path).query)
+    clientId = args[self.clientIdArg][0]
+    ackBlockNumber = int(args["NUM"][0]) if "NUM" in args else None
+    logging.info("getDeviceResult - Got a request; clientId: %s, ackBlockNumber: %s",
+        clientId, ackBlockNumber)
+
+    c = self.clientManager.getOrMakeClient(clientId)
+    if ackBlockNumber:
+      c.popQueueUntilBlockNumber(ackBlockNumber)
+
+    event = self.getEvent(c)
+    deadline = self.loop.time() + self.deviceWaitSeconds
+    while True:
+      # Cleared before looking so that a change made while looking still
+      # wakes the wait below.
+      event.clear()
+      (result, dueSeconds) = c.pollNextBlock()
+      if result is not None:
+        return result
+      waitSeconds = deadline - self.loop.time()
+      if waitSeconds <= 0:
+        logging.info("getDeviceResult - no work available; clientId: %s", clientId)
+        return None
+      if dueSeconds is not None:
+        waitSeconds = min(waitSeconds, dueSeconds)
+      try:
+        await asyncio.wait_for(event.wait(), waitSeconds)
+      except asyncio.TimeoutError:
+        pass
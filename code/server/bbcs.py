@@ -2,13 +2,48 @@
 import logging
 import struct
 
-from constants import MAX_HEIGHT, MAX_WIDTH
+from constants import ERASER_MAX_X, MAX_HEIGHT, MAX_WIDTH, MOVE_SPEED_X, MOVE_SPEED_Y
 
 # bbcs = board bot command set
 
 # This module implements functionality that encapsulates how to 
 # to encode the basic commands to the iBoardBot.
 
+# Any command whose first code is below this is a move to (code1, code2).
+FIRST_SPECIAL_CODE = 4000
+
+# The first code of the other commands, as decodeCommands gives them.
+START_DRAWING_CODE = 4001
+STOP_DRAWING_CODE = 4002
+LIFT_PEN_CODE = 4003
+DROP_PEN_CODE = 4004
+ERASER_DOWN_CODE = 4005
+ERASER_DOWN_NO_PAUSE_CODE = 4007
+
+def decodeCommands(data):
+  # Yields (code1, code2) for every command in an encoded stream.
+  for i in range(0, len(data) - 2, 3):
+    full = (data[i] << 16) | (data[i+1] << 8) | data[i+2]
+    yield (full >> 12, full & 0xFFF)
+
+def firstPosition(data):
+  for (code1, code2) in decodeCommands(data):
+    if code1 < FIRST_SPECIAL_CODE:
+      return (code1, code2)
+  return None
+
+def lastPosition(data):
+  for i in range(len(data) - len(data) % 3 - 3, -1, -3):
+    full = (data[i] << 16) | (data[i+1] << 8) | data[i+2]
+    if (full >> 12) < FIRST_SPECIAL_CODE:
+      return (full >> 12, full & 0xFFF)
+  return None
+
+def travelSeconds(start, end, speedX=MOVE_SPEED_X, speedY=MOVE_SPEED_Y):
+  # Both axes move at the same time so the slower of the two dominates.
+  # Acceleration is ignored.
+  return max(abs(end[0] - start[0]) / speedX, abs(end[1] - start[1]) / speedY)
+
 class Bbcs(object):
   def _formPacket(self, arg1, arg2, arg3=None):
     if not arg3 is None:
@@ -76,18 +111,29 @@ class Bbcs(object):
     # topY = 200
     for y in range(0, topY, moveY):
       result += self.moveTo(0, y)
-      result += self.moveTo(3580, y)
+      result += self.moveTo(ERASER_MAX_X, y)
       result += self.moveTo(0, y)
 
     for y in range(topY-offset, 0, -moveY):
       result += self.moveTo(0, y)
-      result += self.moveTo(3580, y)
+      result += self.moveTo(ERASER_MAX_X, y)
       result += self.moveTo(0, y)
 
     result += self.moveTo(0, 0)
 
     return result
 
+  def erasePath(self, points):
+    # Put the eraser down at the first of points and take it through the
+    # rest, see eraseplan.
+    result  = self.liftPen()
+    result += self.moveTo(*points[0])
+    result += self.eraserDown()
+    for (x, y) in points[1:]:
+      result += self.moveTo(x, y)
+    result += self.eraserUp()
+    return result
+
   def erasePortion(self, x1,y1,x2,y2,finalSweep):
     result  = self.liftPen()
     result += self.moveTo(x1,y1)
@@ -2,6 +2,7 @@
 import cv2
 import numpy as np
 import bbimage
+import bbshape
 
 class FilledText(object):
   def __init__(self, bbcs, width, height, centered = True):
@@ -89,14 +90,26 @@ class FilledText(object):
             0,
             int(self.fontLineThickness / 8))
 
-    if self.isBoxed:
-        cv2.rectangle(self.mat, (0,0), (self.width-1, self.height-1), 255, 1)
-
     # cv2.imshow("Test",self.mat)
     # cv2.waitKey(0)
 
     self.bbImage = bbimage.Image(self.bbcs)
     self.bbImage.genFromImage(self.mat)
 
+    self.box = None
+    if self.isBoxed:
+      self.box = bbshape.Rectangle(self.bbcs)
+      self.box.setSize(self.width - 1, self.height - 1)
+      self.box.gen()
+
   def getDrawString(self, offsetX, offsetY):
-    return self.bbImage.getDrawString(offsetX, offsetY)
+    result = self.bbImage.getDrawString(offsetX, offsetY)
+    if self.box:
+      result += self.box.getDrawString(offsetX, offsetY)
+    return result
+
+  def getDrawChunks(self, offsetX, offsetY):
+    for chunk in self.bbImage.getDrawChunks(offsetX, offsetY):
+      yield chunk
+    if self.box:
+      yield self.box.getDrawString(offsetX, offsetY)
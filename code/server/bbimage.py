@@ -1,19 +1,50 @@
 
+import collections
 import cv2
 import logging
+import os
 import os.path
+import threading
 from constants import MAX_HEIGHT, MAX_WIDTH
 
+# Vectorizing an image file (load, blur, edge detect, find contours) is the
+# same every time for a given file so the resulting contours are cached keyed
+# by the full filename along with its modification time and size, so a file
+# that is replaced is vectorized again.  The least recently used go once
+# there are MAX_IMAGES of them.
+MAX_IMAGES = 256
+
+_cacheLock = threading.Lock()
+_contourCache = collections.OrderedDict()
+
+def getCacheStats():
+  with _cacheLock:
+    contourBytes = 0
+    for contours in _contourCache.values():
+      contourBytes += sum([c.nbytes for c in contours])
+    return {
+        "images": len(_contourCache),
+        "contourBytes": contourBytes,
+        }
+
 class Image(object):
   def __init__(self, bbcs):
     self.bbcs = bbcs
     self.scaleFactor = 1
     self.width = 0
     self.height = 0
+    self.canvasWidth = MAX_WIDTH
+    self.canvasHeight = MAX_HEIGHT
 
   def setImageCharacteristics(self, scaleFactor):
     self.scaleFactor = scaleFactor
 
+  def setCanvasSize(self, width, height):
+    # A scaleFactor of 0 fits the image to the canvas, which is a single
+    # board unless the image is going on a wall of them.
+    self.canvasWidth = width
+    self.canvasHeight = height
+
   def getDimensions(self):
     return (self.width * self.scaleFactor, self.height * self.scaleFactor)
 
@@ -21,18 +52,38 @@ class Image(object):
     fullFilename = os.path.join(os.path.dirname(__file__),filename)
     logging.info("genFromFile - loading file; fullFilename: %s", fullFilename)
 
-    if not os.path.exists(fullFilename):
+    try:
+      st = os.stat(fullFilename)
+    except OSError:
       logging.info("genFromFile - file does not exist returning nothing; fullFilename: %s", fullFilename)
       self.contours = []
       return False
-    
-    image = cv2.imread(fullFilename)
 
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    gray = cv2.bilateralFilter(gray, 11, 17, 17)
-    edged = cv2.Canny(gray, 30, 200)
-
-    self.genContours(edged)
+    key = (fullFilename, st.st_mtime_ns, st.st_size)
+    with _cacheLock:
+      contours = _contourCache.get(key)
+      if contours is not None:
+        _contourCache.move_to_end(key)
+
+    if contours is None:
+      image = cv2.imread(fullFilename)
+
+      gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+      gray = cv2.bilateralFilter(gray, 11, 17, 17)
+      edged = cv2.Canny(gray, 30, 200)
+
+      contours, _ = cv2.findContours(edged, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+      with _cacheLock:
+        # Whatever was cached for an earlier version of the file is no use.
+        for stale in [k for k in _contourCache if k[0] == fullFilename]:
+          del _contourCache[stale]
+        _contourCache[key] = contours
+        while len(_contourCache) > MAX_IMAGES:
+          _contourCache.popitem(last=False)
+    else:
+      logging.info("genFromFile - using cached contours; fullFilename: %s", fullFilename)
+
+    self.setContours(contours)
     return True
 
   def genFromImage(self, image):
@@ -40,23 +91,30 @@ class Image(object):
 
   def genContours(self, image):
     contours, _ = cv2.findContours(image, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    self.setContours(contours)
 
+  def setContours(self, contours):
     logging.info("genContours - found contours; len: {}".format(len(contours)))
     # ret, thresh = cv2.threshold(gray,100,255,0)
     
-    # Find the maximum x and y in order to come up with the scale factor
-    self.minX = min([coordinate[0] for singleContour in contours for element in singleContour for coordinate in element] )
-    self.minY = min([coordinate[1] for singleContour in contours for element in singleContour for coordinate in element] )
-    self.maxX = max([coordinate[0] for singleContour in contours for element in singleContour for coordinate in element] )
-    self.maxY = max([coordinate[1] for singleContour in contours for element in singleContour for coordinate in element] )
+    # Find the maximum x and y in order to come up with the scale factor.  A
+    # blank image, such as a FilledText of nothing but spaces, has no
+    # contours and draws nothing.
+    if len(contours):
+      self.minX = min([coordinate[0] for singleContour in contours for element in singleContour for coordinate in element] )
+      self.minY = min([coordinate[1] for singleContour in contours for element in singleContour for coordinate in element] )
+      self.maxX = max([coordinate[0] for singleContour in contours for element in singleContour for coordinate in element] )
+      self.maxY = max([coordinate[1] for singleContour in contours for element in singleContour for coordinate in element] )
+    else:
+      self.minX = self.minY = self.maxX = self.maxY = 0
 
     self.contours = contours
     self.width = self.maxX - self.minX
     self.height = self.maxY - self.minY
 
-    if self.scaleFactor == 0:
-      xFactor = MAX_WIDTH / self.width
-      yFactor = MAX_HEIGHT / self.height
+    if self.scaleFactor == 0 and self.width > 0 and self.height > 0:
+      xFactor = self.canvasWidth / self.width
+      yFactor = self.canvasHeight / self.height
       self.scaleFactor = min(xFactor, yFactor)
 
     logging.info("genContours - done; minX: %d, maxX: %d, minY: %d, maxY: %d, "
@@ -66,18 +124,26 @@ class Image(object):
 
 
   def getDrawString(self, offsetX, offsetY):
-    logging.info("getDrawString - offset values; offsetX: %d, offsetY: %d", 
+    # The chunks are bytes, or str for the screen command set.
+    chunks = list(self.getDrawChunks(offsetX, offsetY))
+    return chunks[0][:0].join(chunks)
+
+  def getDrawChunks(self, offsetX, offsetY):
+    # Yields the commands one contour at a time so that a caller streaming
+    # the drawing to a board can send the first contours before the rest are
+    # converted.
+    logging.info("getDrawChunks - offset values; offsetX: %d, offsetY: %d", 
         offsetX, offsetY)
 
-    result = self.bbcs.liftPen()
+    yield self.bbcs.liftPen()
     for c in self.contours:
       area = cv2.contourArea(c)
       if len(c) >= 2:
-        logging.debug("getDrawString - drawing contour; area: %d, len: %d", 
+        logging.debug("getDrawChunks - drawing contour; area: %d, len: %d", 
             area, len(c))
 
         start = c[0]
-        result += self.bbcs.liftPen()
+        result  = self.bbcs.liftPen()
         logging.debug("drawImage - lifting pen;")
         result += self.bbcs.moveTo(int(start[0][0] * self.scaleFactor) + offsetX,
             offsetY - int(start[0][1] * self.scaleFactor))
@@ -88,9 +154,9 @@ class Image(object):
               offsetY - int(e[0][1] * self.scaleFactor))
         logging.debug("drawImage - lifting pen;")
         result += self.bbcs.liftPen()
+        yield result
 
       else:
         logging.info("drawImage - skipping singletons; len: %d", len(c))
 
-    result += self.bbcs.liftPen()
-    return result
+    yield self.bbcs.liftPen()
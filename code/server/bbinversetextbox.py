@@ -2,6 +2,7 @@
 import cv2
 import numpy as np
 import bbimage
+import bbshape
 
 class InverseTextBox(object):
   def __init__(self, bbcs, width, height):
@@ -18,6 +19,7 @@ class InverseTextBox(object):
     self.fontScale = 15
     self.fontColor = 255
     self.fontLineThickness = 50
+    self.isRoundedRectangle = False
 
   def setFontCharacteristics(self, font, fontScale, fontLineThickness):
     self.font = font
@@ -46,27 +48,32 @@ class InverseTextBox(object):
     cv2.putText(self.mat, self.string, bottomLeftCornerOfText, self.font,
             self.fontScale, self.fontColor, self.fontLineThickness)
 
-    if self.isRoundedRectangle:
-      self.genRoundedRectangle(self.mat, self.width, self.height)
-
     self.bbImage = bbimage.Image(self.bbcs)
     self.bbImage.genFromImage(self.mat)
 
-  def genRoundedRectangle(self, mat, w, h):
-    borderRadius = 60
-    thickness = 1
-    edgeShift = 1
-    color = 255
+    # The border is drawn analytically as its own stroke rather than being
+    # rasterized into the mat along with the text.
+    self.border = None
+    if self.isRoundedRectangle:
+      self.border = self.genRoundedRectangle(self.width, self.height)
 
-    cv2.line(mat, (borderRadius, edgeShift), (w - borderRadius, edgeShift), color, 4)
-    cv2.line(mat, (borderRadius, h-thickness), (w - borderRadius, h - thickness), color, thickness)
-    cv2.line(mat, (edgeShift, borderRadius), (edgeShift, h - borderRadius), color, thickness)
-    cv2.line(mat, (w - thickness, borderRadius), (w - thickness, h - borderRadius), color, thickness)
+  def genRoundedRectangle(self, w, h):
+    borderRadius = 60
 
-    cv2.ellipse(mat, (borderRadius+ edgeShift, borderRadius+edgeShift), (borderRadius, borderRadius), 180, 0, 90, color, thickness)
-    cv2.ellipse(mat, (w-(borderRadius+thickness), borderRadius), (borderRadius, borderRadius), 270, 0, 90, color, thickness)
-    cv2.ellipse(mat, (w-(borderRadius+thickness), h-(borderRadius + thickness)), (borderRadius, borderRadius), 10, 0, 90, color, thickness)
-    cv2.ellipse(mat, (borderRadius+edgeShift, h-(borderRadius + thickness)), (borderRadius, borderRadius), 90, 0, 90, color, thickness)
+    border = bbshape.RoundedRectangle(self.bbcs)
+    border.setSize(w - 1, h - 1)
+    border.setRadius(borderRadius)
+    border.gen()
+    return border
 
   def getDrawString(self, offsetX, offsetY):
-    return self.bbImage.getDrawString(offsetX, offsetY)
+    result = self.bbImage.getDrawString(offsetX, offsetY)
+    if self.border:
+      result += self.border.getDrawString(offsetX, offsetY)
+    return result
+
+  def getDrawChunks(self, offsetX, offsetY):
+    for chunk in self.bbImage.getDrawChunks(offsetX, offsetY):
+      yield chunk
+    if self.border:
+      yield self.border.getDrawString(offsetX, offsetY)
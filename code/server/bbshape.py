@@ -1,9 +1,69 @@
-
-import cv2
-import numpy as np
-import bbimage
+import math
 import logging
 
+# Simple geometric shapes that are computed analytically rather than being
+# rasterized into a mat and pulled back out again via the contour pipeline in
+# bbimage.  Every shape follows the same conventions as bbimage.Image:
+#
+#   * gen() computes the shape in local coordinates where (0,0) is the upper
+#     left of the bounding box and y grows downwards.
+#   * getDrawString(offsetX, offsetY) places that upper left corner at
+#     (offsetX, offsetY) on the board and returns the commands.
+#
+# Curves are approximated with straight segments.  The number of segments is
+# chosen so that no chord strays more than 'tolerance' board units (mm/10) from
+# the true curve.
+
+DEFAULT_TOLERANCE = 1.0
+MIN_SEGMENTS_PER_CURVE = 4
+
+def segmentsForRadius(radius, sweepRadians=2 * math.pi, tolerance=DEFAULT_TOLERANCE):
+  # A chord spanning the angle theta on a circle of radius r deviates from the
+  # arc by r * (1 - cos(theta/2)).  Solve that for theta and see how many of
+  # those fit in the requested sweep.
+  sweepRadians = abs(sweepRadians)
+  if radius <= tolerance:
+    return MIN_SEGMENTS_PER_CURVE
+  step = 2 * math.acos(1 - tolerance / radius)
+  return max(MIN_SEGMENTS_PER_CURVE, int(math.ceil(sweepRadians / step)))
+
+def arcPoints(centerX, centerY, radiusX, radiusY, startDegrees, endDegrees,
+    tolerance=DEFAULT_TOLERANCE):
+  # Angles are measured counter clockwise as seen on the board.  Since local
+  # coordinates have y growing downwards the sine term is subtracted.
+  start = math.radians(startDegrees)
+  sweep = math.radians(endDegrees - startDegrees)
+  n = segmentsForRadius(max(radiusX, radiusY), sweep, tolerance)
+  result = []
+  for i in range(n + 1):
+    a = start + sweep * i / n
+    result.append((centerX + radiusX * math.cos(a), centerY - radiusY * math.sin(a)))
+  return result
+
+def strokeString(bbcs, points, offsetX, offsetY, closed=False):
+  # Draw the points as a single pen down stroke.  Points that round to the
+  # same board location as their predecessor are dropped.
+  boardPoints = []
+  for (x, y) in points:
+    p = (offsetX + int(round(x)), offsetY - int(round(y)))
+    if len(boardPoints) == 0 or boardPoints[-1] != p:
+      boardPoints.append(p)
+
+  if closed and len(boardPoints) > 1 and boardPoints[0] != boardPoints[-1]:
+    boardPoints.append(boardPoints[0])
+
+  if len(boardPoints) < 2:
+    return bbcs.liftPen()
+
+  result  = bbcs.liftPen()
+  result += bbcs.moveTo(boardPoints[0][0], boardPoints[0][1])
+  result += bbcs.dropPen()
+  for (x, y) in boardPoints[1:]:
+    result += bbcs.moveTo(x, y)
+  result += bbcs.liftPen()
+  return result
+
+
 class VLine(object):
   def __init__(self, bbcs):
     self.bbcs = bbcs
@@ -24,11 +84,119 @@ class VLine(object):
 
     return result
 
+class Polyline(object):
+  def __init__(self, bbcs):
+    self.bbcs = bbcs
+    self.points = []
+    self.closed = False
+
+  def setPoints(self, points):
+    self.points = list(points)
+
+  def setClosed(self, closed):
+    self.closed = closed
+
+  def gen(self):
+    pass
+
+  def getDimensions(self):
+    if len(self.points) == 0:
+      return (0, 0)
+    return (max([p[0] for p in self.points]) - min([p[0] for p in self.points]),
+        max([p[1] for p in self.points]) - min([p[1] for p in self.points]))
+
+  def getDrawString(self, offsetX, offsetY):
+    return strokeString(self.bbcs, self.points, offsetX, offsetY, self.closed)
+
+class Rectangle(Polyline):
+  def __init__(self, bbcs):
+    super(Rectangle, self).__init__(bbcs)
+    self.width = 0
+    self.height = 0
+    self.closed = True
+
+  def setSize(self, width, height):
+    self.width = width
+    self.height = height
+
+  def gen(self):
+    self.points = [(0, 0), (self.width, 0), (self.width, self.height), (0, self.height)]
+
+class RoundedRectangle(Rectangle):
+  def __init__(self, bbcs):
+    super(RoundedRectangle, self).__init__(bbcs)
+    self.radius = 10
+    self.tolerance = DEFAULT_TOLERANCE
+
+  def setRadius(self, radius):
+    self.radius = radius
+
+  def setTolerance(self, tolerance):
+    self.tolerance = tolerance
+
+  def gen(self):
+    w = self.width
+    h = self.height
+    r = min(self.radius, w / 2, h / 2)
+
+    # Walk the outline clockwise (as seen on the board), the angles going
+    # down, starting on the top edge where the upper right corner begins.
+    # Each corner arc ends where the next straight edge begins so the result
+    # is a single stroke.
+    self.points  = arcPoints(w - r, r, r, r, 90, 0, self.tolerance)
+    self.points += arcPoints(w - r, h - r, r, r, 0, -90, self.tolerance)
+    self.points += arcPoints(r, h - r, r, r, -90, -180, self.tolerance)
+    self.points += arcPoints(r, r, r, r, -180, -270, self.tolerance)
+
+class Ellipse(Polyline):
+  def __init__(self, bbcs):
+    super(Ellipse, self).__init__(bbcs)
+    self.radiusX = 10
+    self.radiusY = 10
+    self.tolerance = DEFAULT_TOLERANCE
+    self.closed = True
+
+  def setRadii(self, radiusX, radiusY):
+    self.radiusX = radiusX
+    self.radiusY = radiusY
+
+  def setTolerance(self, tolerance):
+    self.tolerance = tolerance
+
+  def gen(self):
+    self.points = arcPoints(self.radiusX, self.radiusY, self.radiusX,
+        self.radiusY, 0, 360, self.tolerance)
+
+class Arc(Polyline):
+  def __init__(self, bbcs):
+    super(Arc, self).__init__(bbcs)
+    self.radius = 10
+    self.startDegrees = 0
+    self.endDegrees = 90
+    self.tolerance = DEFAULT_TOLERANCE
+
+  def setRadius(self, radius):
+    self.radius = radius
+
+  def setAngles(self, startDegrees, endDegrees):
+    self.startDegrees = startDegrees
+    self.endDegrees = endDegrees
+
+  def setTolerance(self, tolerance):
+    self.tolerance = tolerance
+
+  def gen(self):
+    # The bounding box is that of the full circle so that arcs with the same
+    # radius and offset share a center.
+    self.points = arcPoints(self.radius, self.radius, self.radius, self.radius,
+        self.startDegrees, self.endDegrees, self.tolerance)
+
 class Circle(object):
   def __init__(self, bbcs):
     self.bbcs = bbcs
     self.radius = 10
     self.thickness = 1
+    self.tolerance = DEFAULT_TOLERANCE
 
   def setRadius(self, radius):
     self.radius = radius
@@ -36,16 +204,24 @@ class Circle(object):
   def setThickness(self, thickness):
     self.thickness = thickness
 
+  def setTolerance(self, tolerance):
+    self.tolerance = tolerance
+
   def gen(self):
-    self.mat = np.zeros((
-      self.radius*2,
-      self.radius*2,
-      1), np.uint8)
-    cv2.circle(self.mat, (self.radius, self.radius), self.radius, 255,
-        self.thickness)
+    # Each unit of thickness beyond the first adds another ring just inside
+    # the previous one.
+    self.rings = []
+    for i in range(max(1, self.thickness)):
+      r = self.radius - i
+      if r <= 0:
+        break
+      self.rings.append(arcPoints(self.radius, self.radius, r, r, 0, 360, self.tolerance))
 
-  def getDrawString(self, offsetX, offsetY):
-    self.bbImage = bbimage.Image(self.bbcs)
-    self.bbImage.genFromImage(self.mat)
+    logging.debug("gen - circle; radius: %d, rings: %d, segments: %d",
+        self.radius, len(self.rings), len(self.rings[0]) - 1 if self.rings else 0)
 
-    return self.bbImage.getDrawString(offsetX, offsetY)
+  def getDrawString(self, offsetX, offsetY):
+    result = self.bbcs.liftPen()
+    for ring in self.rings:
+      result += strokeString(self.bbcs, ring, offsetX, offsetY, closed=True)
+    return result
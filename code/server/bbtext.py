@@ -1,5 +1,56 @@
+import collections
 import freetype
 import logging
+import sys
+import threading
+
+# Loading a face and pulling the outline for a glyph out of freetype is by far
+# the most expensive part of rendering text.  Faces are kept for the life of
+# the process keyed by font filename and set to the size wanted each time
+# they are used.  Glyphs are kept keyed by font, size and character, the
+# least recently used going once there are MAX_GLYPHS of them, since the size
+# comes straight from the request.  freetype faces are not safe to share
+# between threads so all access to them happens under _cacheLock.
+MAX_GLYPHS = 4096
+
+_cacheLock = threading.Lock()
+_faceCache = {}
+_glyphCache = collections.OrderedDict()
+
+def _loadGlyph(font, size, character):
+  key = (font, size, character)
+  with _cacheLock:
+    glyph = _glyphCache.get(key)
+    if glyph is not None:
+      _glyphCache.move_to_end(key)
+      return glyph
+
+    face = _faceCache.get(font)
+    if face is None:
+      logging.info("_loadGlyph - loading face; font: %s", font)
+      face = freetype.Face(font)
+      _faceCache[font] = face
+
+    face.set_char_size(size)
+    face.load_char(character)
+    o = face.glyph.outline
+    glyph = (list(o.points), list(o.contours))
+    _glyphCache[key] = glyph
+    while len(_glyphCache) > MAX_GLYPHS:
+      _glyphCache.popitem(last=False)
+    return glyph
+
+def getCacheStats():
+  with _cacheLock:
+    glyphBytes = 0
+    for (points, contours) in _glyphCache.values():
+      glyphBytes += sys.getsizeof(points) + sys.getsizeof(contours)
+      glyphBytes += sum([sys.getsizeof(p) for p in points])
+    return {
+        "faces": len(_faceCache),
+        "glyphs": len(_glyphCache),
+        "glyphBytes": glyphBytes,
+        }
 
 class Text(object):
   def __init__(self, bbcs):
@@ -30,8 +81,7 @@ class Text(object):
     else:
         self.spaceSize = spaceSize
 
-    self.face = freetype.Face(font)
-    self.face.set_char_size(size)
+    self.font = font
 
   def setBoxed(self, isBoxed):
     self.isBoxed = isBoxed
@@ -47,17 +97,15 @@ class Text(object):
     self.dimensions = []
 
     for s in self.string:
-      self.face.load_char(s)
-      o = self.face.glyph.outline
-      bbox = self.face.bbox
+      (points, contours) = _loadGlyph(self.font, self.size, s)
 
-      if len(o.points) == 0:
+      if len(points) == 0:
         logging.debug("gen - no point information; char: '%s'", s)
         characterWidth = self.spaceSize
         characterHeight = 0
       else:
-        characterWidth = max([ p[0] for p in o.points ])
-        characterHeight = max([ p[1] for p in o.points ])
+        characterWidth = max([ p[0] for p in points ])
+        characterHeight = max([ p[1] for p in points ])
 
         logging.debug("gen - character info; char: '%s', characterHeight: %d, characterWidth: %d",
               s, characterHeight, characterWidth)
@@ -68,8 +116,8 @@ class Text(object):
       if self.height < characterHeight:
         self.height = characterHeight
 
-      self.points.append(o.points)
-      self.contours.append(o.contours)
+      self.points.append(points)
+      self.contours.append(contours)
       self.dimensions.append((characterWidth, characterHeight))
 
     logging.info("gen - final overall text dimensions; width: %d, height: %d", 
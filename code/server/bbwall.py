@@ -0,0 +1,158 @@
+import logging
+import struct
+
+from constants import MAX_HEIGHT, MAX_WIDTH
+
+# A wall is a grid of boards treated as one large canvas.  Anything that can
+# be drawn on a single board is drawn on the wall by rendering it with a
+# RecordingBbcs, which accepts coordinates anywhere on the canvas, and then
+# splitting the recording into a drawing per board.  Each board gets only the
+# parts of the strokes that fall on it, shifted into its own coordinates, so
+# all of the boards can plot their share at the same time.
+
+# Commands in a recording are an op code followed by x and y.
+RECORD_FORMAT = ">Bii"
+OP_MOVE = 0
+OP_LIFT = 1
+OP_DROP = 2
+
+class RecordingBbcs(object):
+  # Stands in for bbcs.Bbcs when rendering onto a wall.  Nothing is clamped
+  # to the size of a board and the commands are recorded in a format that
+  # only Wall.split understands.
+  def _record(self, op, x=0, y=0):
+    return struct.pack(RECORD_FORMAT, op, int(x), int(y))
+
+  def moveTo(self, x, y):
+    return self._record(OP_MOVE, x, y)
+
+  def liftPen(self):
+    return self._record(OP_LIFT)
+
+  def dropPen(self):
+    return self._record(OP_DROP)
+
+def clipSegment(start, end, left, bottom, right, top):
+  # Liang-Barsky.  Returns the part of the segment inside the rectangle, as
+  # (start, end), or None if it misses the rectangle completely.
+  (x0, y0) = start
+  (dx, dy) = (end[0] - x0, end[1] - y0)
+  t0 = 0.0
+  t1 = 1.0
+  for (p, q) in ((-dx, x0 - left), (dx, right - x0), (-dy, y0 - bottom), (dy, top - y0)):
+    if p == 0:
+      if q < 0:
+        return None
+    else:
+      t = q / p
+      if p < 0:
+        if t > t1:
+          return None
+        t0 = max(t0, t)
+      else:
+        if t < t0:
+          return None
+        t1 = min(t1, t)
+  return ((x0 + t0 * dx, y0 + t0 * dy), (x0 + t1 * dx, y0 + t1 * dy))
+
+
+class Tile(object):
+  # One board of the wall along with what has been drawn on it so far.
+  def __init__(self, clientId, left, bottom, width, height):
+    self.clientId = clientId
+    self.left = left
+    self.bottom = bottom
+    self.width = width
+    self.height = height
+    self.chunks = []
+    self.penDown = False
+    self.position = None
+
+  def toBoard(self, point):
+    return (int(round(point[0] - self.left)), int(round(point[1] - self.bottom)))
+
+  def stroke(self, bbcs, start, end):
+    # Draw the part of the line from start to end that is on this board.
+    clipped = clipSegment(start, end, self.left, self.bottom,
+        self.left + self.width - 1, self.bottom + self.height - 1)
+    if clipped is None:
+      return
+
+    a = self.toBoard(clipped[0])
+    b = self.toBoard(clipped[1])
+    if not (self.penDown and self.position == a):
+      self.lift(bbcs)
+      self.chunks.append(bbcs.moveTo(a[0], a[1]))
+      self.chunks.append(bbcs.dropPen())
+      self.penDown = True
+    self.chunks.append(bbcs.moveTo(b[0], b[1]))
+    self.position = b
+
+  def lift(self, bbcs):
+    if self.penDown:
+      self.chunks.append(bbcs.liftPen())
+      self.penDown = False
+
+
+class Wall(object):
+  # Boards are given row by row starting at the upper left of the wall.
+  def __init__(self, name, columns, rows, clientIds, tileWidth=MAX_WIDTH,
+      tileHeight=MAX_HEIGHT):
+    if len(clientIds) != columns * rows:
+      raise ValueError("Wall {} is {}x{} and needs {} boards, not {}".format(
+        name, columns, rows, columns * rows, len(clientIds)))
+    self.name = name
+    self.columns = columns
+    self.rows = rows
+    self.clientIds = clientIds
+    self.tileWidth = tileWidth
+    self.tileHeight = tileHeight
+
+  def getDimensions(self):
+    return (self.columns * self.tileWidth, self.rows * self.tileHeight)
+
+  def split(self, recording, bbcs):
+    # Turn a recording from a RecordingBbcs into [(clientId, commands)] for
+    # every board that has something to draw.  The commands are encoded with
+    # bbcs.
+    tiles = []
+    for (i, clientId) in enumerate(self.clientIds):
+      column = i % self.columns
+      row = self.rows - 1 - i // self.columns
+      tiles.append(Tile(clientId, column * self.tileWidth, row * self.tileHeight,
+        self.tileWidth, self.tileHeight))
+
+    position = None
+    penDown = False
+    for (op, x, y) in struct.iter_unpack(RECORD_FORMAT, recording):
+      if op == OP_MOVE:
+        if penDown and position is not None:
+          for t in tiles:
+            t.stroke(bbcs, position, (x, y))
+        position = (x, y)
+      elif op == OP_DROP:
+        penDown = True
+      elif op == OP_LIFT:
+        penDown = False
+        for t in tiles:
+          t.lift(bbcs)
+
+    result = []
+    for t in tiles:
+      if len(t.chunks):
+        t.lift(bbcs)
+        commands = bbcs.liftPen()
+        for chunk in t.chunks:
+          commands += chunk
+        result.append((t.clientId, commands))
+
+    logging.info("split - done; wall: %s, recordedCommands: %d, boards: %s", self.name,
+        len(recording) // struct.calcsize(RECORD_FORMAT), [clientId for (clientId, c) in result])
+    return result
+
+def parseWall(spec):
+  # NAME=COLUMNSxROWS:ID1,ID2,...
+  (name, layout) = spec.split("=", 1)
+  (size, ids) = layout.split(":", 1)
+  (columns, rows) = [int(v) for v in size.lower().split("x")]
+  return Wall(name, columns, rows, [i for i in ids.split(",") if i])
@@ -0,0 +1,547 @@
+import argparse
+import http.client
+import json
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import bbcs
+import boardmodel
+import clientmanager
+import eraseplan
+import jobs
+import layouts
+import wal
+
+# Benchmarks for the parts of the server that are not tied to a board.  Each
+# one is a subcommand, for example:
+#
+#   python benchmark.py wal --threads 8 --drawings 200
+#   python benchmark.py recovery --clients 20 --drawings 50
+#   python benchmark.py layouts --processes 4
+#   python benchmark.py clients --clients 10000
+#   python benchmark.py http --path /status?ID_IWBB=board
+#   python benchmark.py startup --walDrawings 100
+#   python benchmark.py board --rounds 20
+#   python benchmark.py erase
+
+def percentile(values, fraction):
+  values = sorted(values)
+  if len(values) == 0:
+    return 0
+  return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def makePayload(b, size):
+  # Commands that look like a drawing and are about size bytes long.
+  result = b.liftPen()
+  i = 0
+  while len(result) < size:
+    result += b.moveTo(100 + i % 3000, 100 + (i * 7) % 900)
+    if i % 20 == 0:
+      result += b.dropPen()
+    i += 1
+  return result
+
+def benchmarkWal(args):
+  # Many requests queueing drawings at once, each waiting until its drawing
+  # is durable as the server does before it answers.  Reports throughput,
+  # how many records each fsync covered and the latency a request sees.
+  b = bbcs.Bbcs()
+  payload = makePayload(b, args.size)
+  directory = tempfile.mkdtemp(prefix="wal-benchmark-")
+  log = wal.WriteAheadLog(directory, commitDelayMs=args.commitDelayMs, fsync=not args.noFsync)
+  log.open()
+  latencies = []
+  lock = threading.Lock()
+
+  def worker(n):
+    mine = []
+    for i in range(args.drawings):
+      start = time.time()
+      lsn = log.logAdd("board{}".format(n), n * args.drawings + i + 1, None,
+          clientmanager.PRIORITY_NORMAL, None, payload)
+      log.waitDurable(lsn)
+      mine.append(time.time() - start)
+    with lock:
+      latencies.extend(mine)
+
+  start = time.time()
+  threads = [threading.Thread(target=worker, args=(n,)) for n in range(args.threads)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  seconds = time.time() - start
+
+  stats = log.getStats()
+  log.close()
+  shutil.rmtree(directory)
+
+  drawings = args.threads * args.drawings
+  print("wal: threads: {}, drawings: {}, size: {}, fsync: {}, commitDelayMs: {}".format(
+    args.threads, drawings, len(payload), not args.noFsync, args.commitDelayMs))
+  print("  {:.0f} drawings/s, {:.2f} MB/s, {} commits, {:.1f} records/commit".format(
+    drawings / seconds, stats["bytes"] / seconds / 1e6, stats["commits"],
+    stats["records"] / max(1, stats["commits"])))
+  print("  latency p50: {:.2f} ms, p99: {:.2f} ms, max: {:.2f} ms".format(
+    percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000,
+    max(latencies) * 1000))
+
+def benchmarkRecovery(args):
+  # Fill a log through a ClientManager the way the server would, with part of
+  # each queue already drawn, and time how long a restart takes to read it
+  # back and rebuild the queues.
+  b = bbcs.Bbcs()
+  payload = makePayload(b, args.size)
+  directory = tempfile.mkdtemp(prefix="wal-benchmark-")
+
+  log = wal.WriteAheadLog(directory, fsync=not args.noFsync)
+  manager = clientmanager.ClientManager(b, 0, 0, log=log)
+  manager.recover()
+  start = time.time()
+  for n in range(args.clients):
+    c = manager.getOrMakeClient("board{}".format(n))
+    for i in range(args.drawings):
+      c.addNewDrawing(payload, priority=i % len(clientmanager.PRIORITY_NAMES))
+    # Draw a few blocks so that the board is in the middle of a session.
+    for i in range(args.blocksAcked):
+      (blockNumber, header, body) = c.getNextBlock(0)
+      c.popQueueUntilBlockNumber(blockNumber)
+  log.waitDurable()
+  fillSeconds = time.time() - start
+  queueBlocks = sum([manager.getClient(i).getQueueSize() for i in manager.getClientIds()])
+  log.close()
+
+  log = wal.WriteAheadLog(directory)
+  manager = clientmanager.ClientManager(b, 0, 0, log=log)
+  start = time.time()
+  recovery = manager.recover()
+  seconds = time.time() - start
+  restoredBlocks = sum([manager.getClient(i).getQueueSize() for i in manager.getClientIds()])
+  log.close()
+  shutil.rmtree(directory)
+
+  print("recovery: clients: {}, drawings: {}, size: {}, fill: {:.2f}s".format(
+    args.clients, args.clients * args.drawings, len(payload), fillSeconds))
+  print("  {:.3f}s to recover, {:.3f}s reading the log, {} records, {:.1f} MB, {:.0f} records/s".format(
+    seconds, recovery.stats["seconds"], recovery.stats["records"],
+    recovery.stats["bytes"] / 1e6, recovery.stats["records"] / max(seconds, 1e-6)))
+  print("  queued blocks before: {}, after: {}".format(queueBlocks, restoredBlocks))
+
+# Arguments for the layouts benchmark, as a request might send them.
+LAYOUT_ARGS = {
+    "weather": dict(dayOfWeek="WED", dayOfMonth="02", time="12 PM", temperature="70",
+        minTemperature="50", maxTemperature="80", description="CLOUDY", conditionString="CLOUDY"),
+    "weatherStartOfDay": dict(dayOfWeek="Wed", dayOfMonth="2", time="12PM", temperature="101",
+        minTemperature="32", maxTemperature="132", description="Cloudy", iconFilename="w/rain.png"),
+    "text": dict(s="Hello There", x=0, y=0, fontFace="fonts/Exo2-Bold.otf", size=200),
+    }
+
+def benchmarkLayouts(args):
+  # Render each layout with its elements one after another in this process
+  # and then with all of them at once in a pool of worker processes, the two
+  # ways the server can render a request.  Caches are warmed first, in every
+  # worker too, so that only the rendering is timed.
+  b = bbcs.Bbcs()
+  manager = jobs.JobManager(None, args.processes)
+  manager.start()
+
+  def renderSerial(name):
+    return [clientmanager.joinChunks(d) for d in layouts.render(b, name,
+        layouts.LAYOUTS[name](**LAYOUT_ARGS[name]))]
+
+  def renderParallel(name):
+    return [clientmanager.joinChunks(d) for d in manager.renderParallel(name,
+        layouts.LAYOUTS[name](**LAYOUT_ARGS[name]), "benchmark")]
+
+  print("layouts: processes: {}, rounds: {}".format(manager.processes, args.rounds))
+  for name in LAYOUT_ARGS:
+    for i in range(args.warmup):
+      renderSerial(name)
+      renderParallel(name)
+
+    serial = []
+    parallel = []
+    for i in range(args.rounds):
+      start = time.time()
+      expected = renderSerial(name)
+      serial.append(time.time() - start)
+      start = time.time()
+      if renderParallel(name) != expected:
+        raise Exception("Rendering {} in parallel changed the commands".format(name))
+      parallel.append(time.time() - start)
+
+    last = layouts.getStats()[name]["last"]
+    print("  {}: serial p50: {:.1f} ms, parallel p50: {:.1f} ms, speedup: {:.2f}, "
+        "slowest element: {} {:.1f} ms".format(name, percentile(serial, 0.5) * 1000,
+        percentile(parallel, 0.5) * 1000, percentile(serial, 0.5) / percentile(parallel, 0.5),
+        last["slowest"], last["slowestSeconds"] * 1000))
+  manager.shutdown()
+
+def benchmarkClients(args):
+  # Register a lot of boards the way their first requests would, from
+  # several threads at once, and report what they cost in memory, how long
+  # looking one up takes and what cold storage saves once they go idle.
+  b = bbcs.Bbcs()
+  manager = clientmanager.ClientManager(b, clientTtlSeconds=60)
+  clientIds = ["board{}".format(n) for n in range(args.clients)]
+
+  tracemalloc.start()
+  before = tracemalloc.get_traced_memory()[0]
+  start = time.time()
+  made = [None] * args.threads
+
+  def register(n):
+    # Every thread asks for every board so that they race to make them.
+    ids = list(clientIds)
+    random.Random(n).shuffle(ids)
+    made[n] = {i: manager.getOrMakeClient(i) for i in ids}
+
+  threads = [threading.Thread(target=register, args=(n,)) for n in range(args.threads)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  registerSeconds = time.time() - start
+  for i in clientIds:
+    if len(set([id(m[i]) for m in made])) != 1:
+      raise Exception("{} was made more than once".format(i))
+  made = None
+  inMemoryBytes = tracemalloc.get_traced_memory()[0] - before
+
+  # Age every board past the ttl and move them to cold storage.
+  for c in list(manager.clientDevices.values()):
+    c.lastAccessMs -= 120 * 1000
+  before = tracemalloc.get_traced_memory()[0]
+  start = time.time()
+  evicted = manager.evictIdle()
+  evictSeconds = time.time() - start
+  coldBytes = inMemoryBytes + tracemalloc.get_traced_memory()[0] - before
+  tracemalloc.stop()
+
+  def lookup(clientId):
+    start = time.perf_counter()
+    manager.getClient(clientId)
+    return time.perf_counter() - start
+
+  # The first lookup of each board brings it back into memory.
+  thawed = [lookup(i) for i in clientIds]
+  latencies = [lookup(clientIds[random.randrange(len(clientIds))]) for i in range(args.lookups)]
+  misses = [lookup("unknown") for i in range(args.lookups)]
+
+  print("clients: clients: {}, threads: {}, lookups: {}".format(args.clients, args.threads,
+    args.lookups))
+  print("  registered in {:.2f}s, {:.0f} bytes per client in memory, {:.0f} bytes per client "
+      "in cold storage".format(registerSeconds, inMemoryBytes / args.clients,
+      coldBytes / args.clients))
+  print("  lookup p50: {:.2f} us, p99: {:.2f} us, max: {:.2f} us, unknown id p50: {:.2f} us".format(
+    percentile(latencies, 0.5) * 1e6, percentile(latencies, 0.99) * 1e6, max(latencies) * 1e6,
+    percentile(misses, 0.5) * 1e6))
+  print("  evicted {} in {:.3f}s, lookup from cold storage p50: {:.2f} us, p99: {:.2f} us".format(
+    evicted, evictSeconds, percentile(thawed, 0.5) * 1e6, percentile(thawed, 0.99) * 1e6))
+
+def startServer(port, extraArgs):
+  # A server.py of its own, once it is taking connections.
+  server = subprocess.Popen([sys.executable, "server.py", "--port", str(port)] + extraArgs,
+      cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.DEVNULL,
+      stderr=subprocess.DEVNULL)
+  deadline = time.time() + 60
+  while True:
+    try:
+      c = http.client.HTTPConnection("localhost", port)
+      c.request("GET", "/ping")
+      c.getresponse().read()
+      c.close()
+      return server
+    except ConnectionError:
+      if time.time() > deadline or server.poll() is not None:
+        server.kill()
+        raise Exception("The server did not start")
+      time.sleep(0.2)
+
+def benchmarkHttp(args):
+  # Control plane requests made one after the other, as the weather client or
+  # a script would, over a single kept alive connection per thread and then
+  # with a new connection for each.
+  extraArgs = ["--asyncio"] if args.asyncio else []
+  server = startServer(args.port, extraArgs)
+
+  def run(keepAlive):
+    latencies = []
+    lock = threading.Lock()
+
+    def worker():
+      mine = []
+      c = http.client.HTTPConnection("localhost", args.port)
+      for i in range(args.requests):
+        start = time.time()
+        c.request("GET", args.path)
+        r = c.getresponse()
+        r.read()
+        if r.status != 200:
+          raise Exception("{} answered {}".format(args.path, r.status))
+        if not keepAlive or r.will_close:
+          c.close()
+          c = http.client.HTTPConnection("localhost", args.port)
+        mine.append(time.time() - start)
+      c.close()
+      with lock:
+        latencies.extend(mine)
+
+    start = time.time()
+    threads = [threading.Thread(target=worker) for n in range(args.threads)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    return (time.time() - start, latencies)
+
+  try:
+    run(True)
+    print("http: path: {}, threads: {}, requests: {}{}".format(args.path, args.threads,
+      args.threads * args.requests, ", asyncio" if args.asyncio else ""))
+    for keepAlive in [True, False]:
+      (seconds, latencies) = run(keepAlive)
+      print("  {}: {:.0f} requests/s, p50: {:.2f} ms, p99: {:.2f} ms".format(
+        "keep-alive" if keepAlive else "new connection each", len(latencies) / seconds,
+        percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000))
+  finally:
+    server.kill()
+
+def getBlocks(c):
+  # The bodies of every block queued for the client, acknowledging each.
+  blocks = []
+  while True:
+    try:
+      (blockNumber, header, body) = c.getNextBlock(0)
+    except clientmanager.NoWorkException:
+      return blocks
+    blocks.append(bytes(body))
+    c.popQueueUntilBlockNumber(blockNumber)
+
+def benchmarkBoard(args):
+  # What keeping a model of each board costs: the time to update it with the
+  # blocks of a weather update, and of an erase, as they are acknowledged and
+  # the memory it takes.
+  b = bbcs.Bbcs()
+  c = clientmanager.ClientManager(b, 0, 0).getOrMakeClient("board")
+  for d in layouts.render(b, "weather", layouts.LAYOUTS["weather"](**LAYOUT_ARGS["weather"])):
+    c.addNewDrawing(clientmanager.joinChunks(d))
+  drawBlocks = getBlocks(c)
+  c.addNewDrawing(b.eraseAll())
+  eraseBlocks = getBlocks(c)
+
+  perBlock = []
+  eraseSeconds = []
+  for i in range(args.rounds):
+    board = boardmodel.BoardModel()
+    for block in drawBlocks:
+      start = time.perf_counter()
+      board.apply(block)
+      perBlock.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    for block in eraseBlocks:
+      board.apply(block)
+    eraseSeconds.append(time.perf_counter() - start)
+    if board.getStatus()["inkCells"]:
+      raise Exception("The erase left ink on the model")
+
+  tracemalloc.start()
+  before = tracemalloc.get_traced_memory()[0]
+  board = boardmodel.BoardModel()
+  for block in drawBlocks:
+    board.apply(block)
+  modelBytes = tracemalloc.get_traced_memory()[0] - before
+  tracemalloc.stop()
+  status = board.getStatus()
+
+  print("board: rounds: {}, weather blocks: {}, strokes: {}, points: {}".format(args.rounds,
+    len(drawBlocks), status["strokes"], status["strokePoints"]))
+  print("  per block p50: {:.2f} ms, p99: {:.2f} ms, eraseAll: {:.2f} ms".format(
+    percentile(perBlock, 0.5) * 1000, percentile(perBlock, 0.99) * 1000,
+    percentile(eraseSeconds, 0.5) * 1000))
+  print("  model: {:.0f} bytes in memory, {} bytes in cold storage".format(modelBytes,
+    len(board.toBytes())))
+
+def benchmarkErase(args):
+  # How long erasing takes going by the eraser's speeds, planned from the
+  # board model against the full double erase, for a board the server has
+  # just met and for a clean board with each layout drawn on it.
+  b = bbcs.Bbcs()
+  full = eraseplan.fullPlan().getSeconds()
+  boards = [("unknown", boardmodel.BoardModel())]
+  for name in LAYOUT_ARGS:
+    board = boardmodel.BoardModel()
+    board.apply(b.eraseAll())
+    for d in layouts.render(b, name, layouts.LAYOUTS[name](**LAYOUT_ARGS[name])):
+      board.apply(clientmanager.joinChunks(d))
+    boards.append((name, board))
+
+  print("erase: full erase {:.1f} s".format(full))
+  for (name, board) in boards:
+    cells = eraseplan.getBoardCells(board)
+    for veryClean in (False, True):
+      start = time.perf_counter()
+      plan = eraseplan.planErase(cells, veryClean)
+      planSeconds = time.perf_counter() - start
+      erased = board.copy()
+      erased.apply(b"".join(plan.getDrawings(b)))
+      if len(eraseplan.getBoardCells(erased)):
+        raise Exception("The plan for {} left ink on the model".format(name))
+      print("  {}{}: {} cells, axis: {}, {:.1f} s ({:.0f}% of full), planned in {:.1f} ms".format(
+        name, " very clean" if veryClean else "", len(cells), plan.axis or "full",
+        plan.getSeconds(), plan.getSeconds() * 100 / full, planSeconds * 1000))
+
+# Run in a new interpreter, so that nothing is imported already, by the
+# startup benchmark.
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.time()
+import server
+imported = time.time()
+app = server.createApp(server.parseConfig([]))
+print(json.dumps({"importSeconds": imported - start, "createSeconds": time.time() - imported,
+    "loaded": [m for m in ("cv2", "numpy", "freetype") if m in sys.modules]}))
+"""
+
+def getDeviceBlock(port, clientId):
+  # One device request, None when the server is not taking connections yet.
+  try:
+    c = http.client.HTTPConnection("localhost", port)
+    c.request("GET", "/ibb-device/?ID_IWBB={}&STATUS=READY".format(clientId))
+    body = c.getresponse().read()
+    c.close()
+    return body
+  except ConnectionError:
+    return None
+
+def benchmarkStartup(args):
+  # How long a restarted server takes to import and to build its App, and
+  # how long after it is started a board that had work queued is sent its
+  # first block and the first control plane render is done.
+  directory = os.path.dirname(os.path.abspath(__file__))
+  results = []
+  for i in range(args.rounds):
+    output = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT], cwd=directory,
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
+    results.append(json.loads(output))
+  print("startup: rounds: {}".format(args.rounds))
+  print("  import server: p50: {:.3f}s, createApp: p50: {:.3f}s, loaded: {}".format(
+    percentile([r["importSeconds"] for r in results], 0.5),
+    percentile([r["createSeconds"] for r in results], 0.5),
+    ", ".join(results[0]["loaded"]) or "nothing heavy"))
+
+  walDir = tempfile.mkdtemp(prefix="startup-benchmark-")
+  b = bbcs.Bbcs()
+  log = wal.WriteAheadLog(walDir)
+  manager = clientmanager.ClientManager(b, 0, 0, log=log)
+  manager.recover()
+  payload = makePayload(b, 2000)
+  c = manager.getOrMakeClient("board")
+  for i in range(args.walDrawings):
+    c.addNewDrawing(payload)
+  log.waitDurable()
+  log.close()
+
+  extraArgs = ["--walDir", walDir] + (["--asyncio"] if args.asyncio else [])
+  start = time.time()
+  server = subprocess.Popen([sys.executable, "server.py", "--port", str(args.port)] + extraArgs,
+      cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  try:
+    while True:
+      body = getDeviceBlock(args.port, "board")
+      if body is not None:
+        break
+      if time.time() - start > 60 or server.poll() is not None:
+        raise Exception("The server did not start")
+      time.sleep(0.01)
+    blockSeconds = time.time() - start
+    if len(body) < 6:
+      raise Exception("The queued work was not recovered")
+    c = http.client.HTTPConnection("localhost", args.port)
+    c.request("GET", "/serverStatus")
+    loaded = json.loads(c.getresponse().read())["startup"]["loaded"]
+    c.request("GET", "/addText?ID_IWBB=other&s=Hello%20There&f=fonts/Exo2-Bold.otf&size=200&x=0&y=0")
+    r = c.getresponse()
+    r.read()
+    if r.status != 200:
+      raise Exception("/addText answered {}".format(r.status))
+    renderSeconds = time.time() - start
+    c.close()
+  finally:
+    server.kill()
+    server.wait()
+    shutil.rmtree(walDir)
+  print("  server.py{}: first block of {} queued drawings after {:.3f}s, loaded then: {}".format(
+    " --asyncio" if args.asyncio else "", args.walDrawings, blockSeconds,
+    ", ".join(loaded) or "nothing heavy"))
+  print("  first render done after {:.3f}s".format(renderSeconds))
+
+def main():
+  logging.basicConfig(level=logging.WARNING)
+  parser = argparse.ArgumentParser(description='Benchmarks for the iBoardBot server')
+  subparsers = parser.add_subparsers(dest="command", required=True)
+
+  p = subparsers.add_parser("wal", help="Write-ahead log throughput with group commit")
+  p.add_argument('--threads', type=int, default=8)
+  p.add_argument('--drawings', type=int, default=200, help='Drawings per thread')
+  p.add_argument('--size', type=int, default=2000, help='Bytes of commands per drawing')
+  p.add_argument('--commitDelayMs', type=float, default=0)
+  p.add_argument('--noFsync', default=False, action="store_true")
+  p.set_defaults(func=benchmarkWal)
+
+  p = subparsers.add_parser("recovery", help="Time to rebuild the queues from the write-ahead log")
+  p.add_argument('--clients', type=int, default=20)
+  p.add_argument('--drawings', type=int, default=50, help='Drawings per client')
+  p.add_argument('--size', type=int, default=2000, help='Bytes of commands per drawing')
+  p.add_argument('--blocksAcked', type=int, default=2, help='Blocks each board has drawn')
+  p.add_argument('--noFsync', default=False, action="store_true")
+  p.set_defaults(func=benchmarkRecovery)
+
+  p = subparsers.add_parser("layouts", help="Rendering the elements of a layout at once")
+  p.add_argument('--processes', type=int, default=None, help='Worker processes, one per CPU by default')
+  p.add_argument('--rounds', type=int, default=10)
+  p.add_argument('--warmup', type=int, default=5, help='Untimed rounds to fill the caches')
+  p.set_defaults(func=benchmarkLayouts)
+
+  p = subparsers.add_parser("clients", help="Memory and lookup time with many boards registered")
+  p.add_argument('--clients', type=int, default=10000)
+  p.add_argument('--threads', type=int, default=8)
+  p.add_argument('--lookups', type=int, default=100000)
+  p.set_defaults(func=benchmarkClients)
+
+  p = subparsers.add_parser("http", help="Control plane requests per second with keep-alive")
+  p.add_argument('--path', default="/ping")
+  p.add_argument('--requests', type=int, default=2000, help='Requests per thread')
+  p.add_argument('--threads', type=int, default=1)
+  p.add_argument('--port', type=int, default=8765, help='Port for the server started to measure')
+  p.add_argument('--asyncio', default=False, action="store_true")
+  p.set_defaults(func=benchmarkHttp)
+
+  p = subparsers.add_parser("board", help="Keeping a model of what is on each board")
+  p.add_argument('--rounds', type=int, default=20)
+  p.set_defaults(func=benchmarkBoard)
+
+  p = subparsers.add_parser("erase", help="Erase plans against the full double erase")
+  p.set_defaults(func=benchmarkErase)
+
+  p = subparsers.add_parser("startup", help="Time until a restarted server answers the boards")
+  p.add_argument('--rounds', type=int, default=5, help='Times the import is measured')
+  p.add_argument('--walDrawings', type=int, default=100,
+      help='Drawings queued in the write-ahead log before the server is started')
+  p.add_argument('--port', type=int, default=8765, help='Port for the server started to measure')
+  p.add_argument('--asyncio', default=False, action="store_true")
+  p.set_defaults(func=benchmarkStartup)
+
+  args = parser.parse_args()
+  args.func(args)
+
+if __name__ == "__main__":
+  main()
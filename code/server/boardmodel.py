@@ -0,0 +1,339 @@
+import array
+import struct
+import zlib
+
+import bbcs
+from constants import ERASER_MAX_X, ERASER_SIZE, MAX_HEIGHT
+
+# What is on a board, as far as the server can tell from the blocks the board
+# has acknowledged.  The board is split into square cells, each of which is
+# clear, has ink on it or is unknown, and the strokes drawn since the board
+# was last erased are kept in a coarse spatial index.  Every cell starts out
+# unknown, since a board may have anything on it when the server first hears
+# from it, and only becomes clear once the eraser has been right over it.
+#
+# The cells are the record of where the ink is.  The strokes say what was
+# drawn but are only dropped once the eraser has been over the whole of them,
+# or the whole board is clear, and the oldest are forgotten past
+# MAX_STROKE_POINTS, so they are a guide to what is left rather than an
+# account of it.
+
+CELL_SIZE = 50
+
+# The eraser cannot clear anything past ERASER_MAX_X, so the cells stop
+# there.  Anything drawn further right is put in the last column.
+COLUMNS = (ERASER_MAX_X + ERASER_SIZE // 2) // CELL_SIZE
+ROWS = MAX_HEIGHT // CELL_SIZE
+
+CELL_CLEAR = 0
+CELL_INK = 1
+CELL_UNKNOWN = 2
+
+# The strokes are indexed by the tiles of this size their bounds overlap.
+TILE_SIZE = 400
+
+# Most points kept across the strokes of one board.
+MAX_STROKE_POINTS = 8192
+
+MODE_MOVE = 0
+MODE_DRAW = 1
+MODE_ERASE = 2
+
+MODES = {
+    bbcs.START_DRAWING_CODE: MODE_MOVE,
+    bbcs.STOP_DRAWING_CODE: MODE_MOVE,
+    bbcs.LIFT_PEN_CODE: MODE_MOVE,
+    bbcs.DROP_PEN_CODE: MODE_DRAW,
+    bbcs.ERASER_DOWN_CODE: MODE_ERASE,
+    bbcs.ERASER_DOWN_NO_PAUSE_CODE: MODE_ERASE,
+    }
+
+# toBytes writes the version, mode, position (-1 when it is not known) and
+# number of dropped strokes, then the cells, then the number of points of
+# every stroke followed by its points and the same for the stroke being drawn.
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<BBhhI")
+COUNT = struct.Struct("<I")
+
+def getCell(x, y):
+  return (min(x // CELL_SIZE, COLUMNS - 1), min(y // CELL_SIZE, ROWS - 1))
+
+def getCellBounds(column, row):
+  return (column * CELL_SIZE, row * CELL_SIZE, (column + 1) * CELL_SIZE, (row + 1) * CELL_SIZE)
+
+def getTiles(bounds):
+  (x1, y1, x2, y2) = bounds
+  return [(tx, ty) for tx in range(x1 // TILE_SIZE, x2 // TILE_SIZE + 1)
+      for ty in range(y1 // TILE_SIZE, y2 // TILE_SIZE + 1)]
+
+def overlaps(a, b):
+  return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+def contains(outer, inner):
+  return (outer[0] <= inner[0] and inner[2] <= outer[2] and
+      outer[1] <= inner[1] and inner[3] <= outer[3])
+
+
+class Stroke(object):
+  # A run of the pen from when it is dropped to when it is lifted, as the x
+  # and y of every point in turn.
+  __slots__ = ("strokeId", "points", "bounds")
+
+  def __init__(self, strokeId, points):
+    self.strokeId = strokeId
+    self.points = points
+    xs = points[0::2]
+    ys = points[1::2]
+    self.bounds = (min(xs), min(ys), max(xs), max(ys))
+
+  def getStatus(self):
+    return {
+        "strokeId": self.strokeId,
+        "bounds": list(self.bounds),
+        "points": [[self.points[i], self.points[i+1]] for i in range(0, len(self.points), 2)],
+        }
+
+
+class BoardModel(object):
+  def __init__(self):
+    self.cells = bytearray([CELL_UNKNOWN]) * (COLUMNS * ROWS)
+    # strokeId -> Stroke, oldest first.
+    self.strokes = {}
+    # (tileX, tileY) -> the ids of the strokes that overlap the tile.  There
+    # are only a few strokes per tile so lists take less room than sets.
+    self.tiles = {}
+    self.nextStrokeId = 1
+    self.numberOfPoints = 0
+    self.droppedStrokes = 0
+    self.mode = MODE_MOVE
+    self.position = None
+    # The points of the stroke being drawn.
+    self.current = None
+
+  def copy(self):
+    other = BoardModel()
+    other.cells[:] = self.cells
+    other.strokes = dict(self.strokes)
+    other.tiles = dict([(tile, list(ids)) for (tile, ids) in self.tiles.items()])
+    other.nextStrokeId = self.nextStrokeId
+    other.numberOfPoints = self.numberOfPoints
+    other.droppedStrokes = self.droppedStrokes
+    other.mode = self.mode
+    other.position = self.position
+    other.current = None if self.current is None else array.array("H", self.current)
+    return other
+
+  def startSession(self):
+    # The first block of every session lifts the pen, see
+    # Client._getHeader.
+    self._setMode(MODE_MOVE)
+
+  def apply(self, data, erase=True):
+    # Update the model with commands the board has carried out.  Without
+    # erase the eraser is taken to clear nothing, for drawings that are only
+    # queued and may yet be drawn in a different order.
+    for (code1, code2) in bbcs.decodeCommands(data):
+      if code1 < bbcs.FIRST_SPECIAL_CODE:
+        self._moveTo(code1, code2, erase)
+      elif code1 in MODES:
+        self._setMode(MODES[code1])
+
+  def _setMode(self, mode):
+    if mode != MODE_DRAW:
+      self._endStroke()
+    self.mode = mode
+
+  def _moveTo(self, x, y, erase):
+    if self.position is not None and self.position != (x, y):
+      if self.mode == MODE_DRAW:
+        self._draw(self.position, (x, y))
+      elif self.mode == MODE_ERASE and erase:
+        self._erase(self.position, (x, y))
+    self.position = (x, y)
+
+  def _getSamples(self, start, end):
+    # Points along the line from start to end no more than half a cell apart.
+    dx = end[0] - start[0]
+    dy = end[1] - start[1]
+    n = max(abs(dx), abs(dy)) // (CELL_SIZE // 2) + 1
+    return [(start[0] + dx * i // n, start[1] + dy * i // n) for i in range(n + 1)]
+
+  def _draw(self, start, end):
+    if self.current is None:
+      self.current = array.array("H", start)
+    self.current.extend(end)
+    for (x, y) in self._getSamples(start, end):
+      (column, row) = getCell(x, y)
+      self.cells[row * COLUMNS + column] = CELL_INK
+
+  def _endStroke(self):
+    if self.current is not None:
+      self._addStroke(self.current)
+      self.current = None
+
+  def _addStroke(self, points):
+    if len(points) > MAX_STROKE_POINTS * 2:
+      self.droppedStrokes += 1
+      return
+    while self.numberOfPoints + len(points) // 2 > MAX_STROKE_POINTS:
+      self._removeStroke(next(iter(self.strokes)))
+      self.droppedStrokes += 1
+    # A copy is only as long as it needs to be.
+    stroke = Stroke(self.nextStrokeId, array.array("H", points))
+    self.nextStrokeId += 1
+    self.strokes[stroke.strokeId] = stroke
+    self.numberOfPoints += len(points) // 2
+    for tile in getTiles(stroke.bounds):
+      self.tiles.setdefault(tile, []).append(stroke.strokeId)
+
+  def _removeStroke(self, strokeId):
+    stroke = self.strokes.pop(strokeId)
+    self.numberOfPoints -= len(stroke.points) // 2
+    for tile in getTiles(stroke.bounds):
+      ids = self.tiles[tile]
+      ids.remove(strokeId)
+      if len(ids) == 0:
+        del self.tiles[tile]
+
+  def _erase(self, start, end):
+    # The eraser clears every cell that lies wholly under it somewhere along
+    # its path.  Straight across or up and down is the usual sweep and is
+    # done in one go, anything else a step at a time.
+    if start[0] == end[0] or start[1] == end[1]:
+      steps = [(start, end)]
+    else:
+      samples = self._getSamples(start, end)
+      steps = [(p, p) for p in samples]
+    half = ERASER_SIZE // 2
+    for (a, b) in steps:
+      self.clear((min(a[0], b[0]) - half, min(a[1], b[1]) - half,
+          max(a[0], b[0]) + half, max(a[1], b[1]) + half))
+
+  def clear(self, bounds):
+    # Mark the cells wholly inside bounds as clear and forget the strokes
+    # that are.
+    (x1, y1, x2, y2) = bounds
+    firstColumn = max(0, -(-x1 // CELL_SIZE))
+    lastColumn = min(COLUMNS, x2 // CELL_SIZE)
+    for row in range(max(0, -(-y1 // CELL_SIZE)), min(ROWS, y2 // CELL_SIZE)):
+      if firstColumn < lastColumn:
+        self.cells[row * COLUMNS + firstColumn:row * COLUMNS + lastColumn] = (
+            bytes(lastColumn - firstColumn))
+
+    if not any(self.cells):
+      self.strokes.clear()
+      self.tiles.clear()
+      self.numberOfPoints = 0
+      self.droppedStrokes = 0
+      return
+    erased = set()
+    for tile in getTiles((max(0, x1), max(0, y1), max(0, x2), max(0, y2))):
+      for strokeId in self.tiles.get(tile, ()):
+        if contains(bounds, self.strokes[strokeId].bounds):
+          erased.add(strokeId)
+    for strokeId in erased:
+      self._removeStroke(strokeId)
+
+  def isKnown(self):
+    # Whether every cell is known to be clear or to have ink on it.
+    return not CELL_UNKNOWN in self.cells
+
+  def getCells(self, state):
+    # (column, row) of every cell in the state.
+    return [(i % COLUMNS, i // COLUMNS) for (i, cell) in enumerate(self.cells) if cell == state]
+
+  def getInkBounds(self, includeUnknown=False):
+    # The bounds of the cells with ink on them, and those that are unknown
+    # if asked, or None if there are none.
+    cells = self.getCells(CELL_INK)
+    if includeUnknown:
+      cells += self.getCells(CELL_UNKNOWN)
+    if len(cells) == 0:
+      return None
+    return (min([c for (c, r) in cells]) * CELL_SIZE, min([r for (c, r) in cells]) * CELL_SIZE,
+        (max([c for (c, r) in cells]) + 1) * CELL_SIZE, (max([r for (c, r) in cells]) + 1) * CELL_SIZE)
+
+  def getCoverage(self, bounds):
+    # The fraction of the cells overlapping bounds that have ink on them and
+    # that are unknown.
+    (x1, y1, x2, y2) = bounds
+    (firstColumn, firstRow) = getCell(max(0, x1), max(0, y1))
+    (lastColumn, lastRow) = getCell(max(0, x2 - 1), max(0, y2 - 1))
+    counts = [0, 0, 0]
+    for row in range(firstRow, lastRow + 1):
+      for cell in self.cells[row * COLUMNS + firstColumn:row * COLUMNS + lastColumn + 1]:
+        counts[cell] += 1
+    total = max(1, sum(counts))
+    return {
+        "bounds": [x1, y1, x2, y2],
+        "ink": round(counts[CELL_INK] / total, 3),
+        "unknown": round(counts[CELL_UNKNOWN] / total, 3),
+        }
+
+  def getRegions(self, columns, rows):
+    # getCoverage for the board split into columns by rows regions, a row at
+    # a time starting from y 0.
+    width = COLUMNS * CELL_SIZE
+    height = ROWS * CELL_SIZE
+    return [self.getCoverage((width * c // columns, height * r // rows,
+        width * (c + 1) // columns, height * (r + 1) // rows))
+        for r in range(rows) for c in range(columns)]
+
+  def getStrokes(self, bounds, limit=None):
+    # The strokes whose bounds overlap bounds, oldest first.
+    ids = set()
+    for tile in getTiles((max(0, bounds[0]), max(0, bounds[1]), max(0, bounds[2]),
+        max(0, bounds[3]))):
+      ids.update(self.tiles.get(tile, ()))
+    strokes = [self.strokes[i] for i in sorted(ids) if overlaps(bounds, self.strokes[i].bounds)]
+    return strokes[:limit]
+
+  def getStatus(self):
+    inkBounds = self.getInkBounds()
+    return {
+        "cellSize": CELL_SIZE,
+        "columns": COLUMNS,
+        "rows": ROWS,
+        "known": self.isKnown(),
+        "inkCells": self.cells.count(CELL_INK),
+        "unknownCells": self.cells.count(CELL_UNKNOWN),
+        "inkBounds": None if inkBounds is None else list(inkBounds),
+        "strokes": len(self.strokes),
+        "strokePoints": self.numberOfPoints,
+        "droppedStrokes": self.droppedStrokes,
+        }
+
+  def toBytes(self):
+    (x, y) = self.position if self.position is not None else (-1, -1)
+    parts = [HEADER.pack(FORMAT_VERSION, self.mode, x, y, self.droppedStrokes), bytes(self.cells),
+        COUNT.pack(len(self.strokes))]
+    for points in [s.points for s in self.strokes.values()] + [self.current or array.array("H")]:
+      parts.append(COUNT.pack(len(points)))
+      parts.append(points.tobytes())
+    return zlib.compress(b"".join(parts))
+
+def fromBytes(data):
+  data = zlib.decompress(data)
+  (version, mode, x, y, droppedStrokes) = HEADER.unpack_from(data)
+  if version != FORMAT_VERSION:
+    # An older layout, start again from nothing known.
+    return BoardModel()
+  model = BoardModel()
+  model.mode = mode
+  model.position = None if x < 0 else (x, y)
+  offset = HEADER.size
+  model.cells[:] = data[offset:offset + len(model.cells)]
+  offset += len(model.cells)
+  (numberOfStrokes,) = COUNT.unpack_from(data, offset)
+  offset += COUNT.size
+  for i in range(numberOfStrokes + 1):
+    (n,) = COUNT.unpack_from(data, offset)
+    offset += COUNT.size
+    points = array.array("H", data[offset:offset + n * 2])
+    offset += n * 2
+    if i < numberOfStrokes:
+      model._addStroke(points)
+    elif n:
+      model.current = points
+  model.droppedStrokes = droppedStrokes
+  return model
@@ -0,0 +1,1462 @@
+import bisect
+import collections
+import heapq
+import itertools
+import logging
+import math
+import threading
+import time
+
+import bbcs
+import boardmodel
+import wal
+
+# The ClientManager keeps track of every iBoardBot that has talked to the
+# server along with the queue of blocks waiting to be sent to it.
+
+# Default limits on how much work can be waiting for a single board.  A board
+# is slow, so anything beyond this is almost certainly a runaway client.
+DEFAULT_MAX_QUEUE_BYTES = 4 * 1024 * 1024
+DEFAULT_MAX_QUEUE_BLOCKS = 8192
+
+# The firmware will accept a packet of at most this many bytes.
+MAX_PACKET_SIZE = 768
+
+# Block numbers travel in a 12 bit field and the firmware treats anything of
+# 4000 or above as 'no block'.  Internally every block gets an ever increasing
+# sequence number which is folded into 1..MAX_BLOCK_NUMBER on the wire.  An
+# acknowledgement is only accepted if it falls within BLOCK_NUMBER_WINDOW
+# blocks of the next unacknowledged block, which keeps the comparison
+# unambiguous no matter how many blocks are queued behind it.
+MAX_BLOCK_NUMBER = 3999
+BLOCK_NUMBER_WINDOW = MAX_BLOCK_NUMBER // 2
+
+def toBlockNumber(sequence):
+  return (sequence - 1) % MAX_BLOCK_NUMBER + 1
+
+def blockNumberDistance(fromNumber, toNumber):
+  # How many blocks forward, allowing for wraparound, it is from one block
+  # number to another.
+  return (toNumber - fromNumber) % MAX_BLOCK_NUMBER
+
+# Each client has a lane of work per priority.  The device always gets its
+# next session from the most urgent lane that has one.
+PRIORITY_URGENT = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BACKGROUND = 2
+PRIORITY_NAMES = ["urgent", "normal", "background"]
+
+def parsePriority(name):
+  if name is None:
+    return PRIORITY_NORMAL
+  if not name in PRIORITY_NAMES:
+    raise ValueError("Unknown priority '{}', expected one of {}".format(name, PRIORITY_NAMES))
+  return PRIORITY_NAMES.index(name)
+
+# Drawing ids are unique across every client served by this process, and
+# across restarts when there is a write-ahead log, see ClientManager.recover.
+_drawingIds = itertools.count(1)
+
+def nextDrawingId():
+  return next(_drawingIds)
+
+def useDrawingIds(ids):
+  # Replace where drawing ids come from, see sharedstore where several
+  # processes hand them out.
+  global _drawingIds
+  _drawingIds = ids
+
+# What a drawing can be doing.  Once a drawing reaches one of the final
+# states it stays there.
+DRAWING_SCHEDULED = "scheduled"
+DRAWING_QUEUED = "queued"
+DRAWING_DRAWING = "drawing"
+DRAWING_DONE = "done"
+DRAWING_CANCELLED = "cancelled"
+DRAWING_SUPERSEDED = "superseded"
+DRAWING_CLEARED = "cleared"
+DRAWING_UNKNOWN = "unknown"
+FINAL_DRAWING_STATES = [DRAWING_DONE, DRAWING_CANCELLED, DRAWING_SUPERSEDED,
+    DRAWING_CLEARED, DRAWING_UNKNOWN]
+
+# How many finished drawings each client remembers the outcome of.
+MAX_FINISHED_DRAWINGS = 1024
+
+# Rough time the board takes to draw a block, used for estimates until it has
+# acknowledged blocks of its own.
+DEFAULT_SECONDS_PER_BLOCK = 10.0
+
+# A lookup only moves a client's lastAccessMs on once it is this far behind,
+# so that looking a board up is a read and not a write.
+ACCESS_RESOLUTION_MS = 1000
+
+# The registry of clients is guarded by this many locks, a client id always
+# maps to the same one, so that requests for different boards do not queue up
+# behind each other to find their client.
+CLIENT_LOCK_STRIPES = 64
+
+# A client that has had nothing queued and has not been looked up for this
+# long is put into cold storage, see ClientManager.evictIdle.  0 keeps every
+# client in memory.
+DEFAULT_CLIENT_TTL_SECONDS = 24 * 60 * 60
+
+class NoWorkException(Exception):
+  pass
+
+class QueueFullException(Exception):
+  def __init__(self, clientId, queueBytes, queueBlocks, requiredBytes, requiredBlocks):
+    super(QueueFullException, self).__init__(
+        "Queue full for client {}, retry later; queueBytes: {}, queueBlocks: {}, "
+        "requiredBytes: {}, requiredBlocks: {}".format(clientId, queueBytes,
+          queueBlocks, requiredBytes, requiredBlocks))
+    self.clientId = clientId
+
+class NotifyingCondition(threading.Condition):
+  # A Condition that also calls listeners on notify_all, for waiters that are
+  # not threads, see asyncserver.
+  def __init__(self):
+    super(NotifyingCondition, self).__init__()
+    self.listeners = []
+
+  def addListener(self, listener):
+    self.listeners.append(listener)
+
+  def notify_all(self):
+    super(NotifyingCondition, self).notify_all()
+    for listener in self.listeners:
+      listener()
+
+class Part(object):
+  # A single call to addNewDrawing.  The drawing id is what callers use to
+  # refer to it and the part records where its commands sit in the payload of
+  # the session that it was merged into.
+  def __init__(self, drawingId, supersedeKey, start, end):
+    self.drawingId = drawingId
+    self.supersedeKey = supersedeKey
+    self.start = start
+    self.end = end
+
+def blockCapacity(index):
+  # How many bytes of the command stream fit in a block after its header.
+  headerCommands = Client.HEADER_COMMANDS_FOR_SUBSEQUENT_PACKET
+  if index == 0:
+    headerCommands = Client.HEADER_COMMANDS_FOR_FIRST_PACKET
+  return MAX_PACKET_SIZE - headerCommands * Client.SIZE_OF_COMMAND
+
+def blocksForSize(size):
+  # How many blocks a command stream of this many bytes is split into.
+  if size <= blockCapacity(0):
+    return 1
+  return 1 + int(math.ceil((size - blockCapacity(0)) / blockCapacity(1)))
+
+def applyBlocks(board, session, first, end):
+  # Update a boardmodel.BoardModel with the blocks of session, from first up
+  # to end, that the board has drawn.
+  for index in range(first, end):
+    if index == 0:
+      board.startSession()
+    board.apply(session.getBlock(index))
+
+def joinChunks(chunks):
+  # Drawings can be given as a single string of commands or as an iterable of
+  # chunks.  The commands are bytes, or str for the screen command set.
+  if isinstance(chunks, (bytes, bytearray, str)):
+    return chunks
+  chunks = list(chunks)
+  if len(chunks) == 0:
+    return b""
+  return chunks[0][:0].join(chunks)
+
+class DrawingStream(object):
+  # Feeds drawings into a client while they are still being rendered.  Each
+  # drawing is an iterable of chunks of commands and every block that fills
+  # up is released to the device straight away, so the board can start on
+  # the first element of a layout while the rest is rendered.  When the
+  # client coalesces all of the drawings of a stream go into one session,
+  # which is only finished off with the footer by close().  Otherwise each
+  # drawing is a session of its own, finished off as soon as it is queued.
+  def __init__(self, client, priority):
+    self.client = client
+    self.priority = priority
+    self.session = None
+    self.needsSeparator = False
+    self.drawingIds = []
+
+  def addDrawing(self, chunks, supersedeKey=None):
+    # Returns the id of the new drawing once all of its chunks are queued.
+    if isinstance(chunks, (bytes, bytearray, str)):
+      chunks = [chunks]
+    drawingId = next(_drawingIds)
+    self.drawingIds.append(drawingId)
+    self.client._startStreamPart(self, drawingId, supersedeKey)
+    for chunk in chunks:
+      if len(chunk):
+        self.client._writeStream(self, chunk)
+    self.client._endStreamPart(self)
+    return drawingId
+
+  def close(self):
+    self.client._closeStream(self)
+
+  def abort(self):
+    self.client._abortStream(self)
+
+
+class Session(object):
+  # A session is what the device draws between one start drawing command and
+  # the next stop drawing command.  It holds one or more parts and is stored
+  # exactly once as the command stream (payload plus footer) along with the
+  # offset at which each block starts.  The blocks themselves are never
+  # materialized; getBlock hands out a memoryview over the buffer and the
+  # small block header is produced when the block is sent.
+  #
+  # A session built in one go holds the whole stream in a single segment.  A
+  # session that is still open, see DrawingStream, grows as the drawing is
+  # rendered: bytes collect in pending and each time a block's worth is there
+  # it is frozen into a segment of its own and becomes available to send.
+  # Segments are never modified so views handed out stay valid.
+  #
+  # A session only gets its block sequence numbers once the device starts on
+  # it.
+
+  def __init__(self, parts, priority, enqueuedMs):
+    self.parts = parts
+    self.priority = priority
+    self.enqueuedMs = enqueuedMs
+    self.firstSequence = None
+    self.numberOfBlocksAcked = 0
+    self.segments = []
+    self.segmentStarts = []
+    self.offsets = [0]
+    self.pending = bytearray()
+    self.payloadSize = 0
+    self.isOpen = True
+    self.detached = False
+    # Shared sessions hold the same buffers as the sessions of other boards,
+    # see ClientGroup, and are never merged with other drawings.
+    self.isShared = False
+
+  def setData(self, data, payloadSize):
+    # Use data, the entire command stream, as the one and only segment.
+    self.segments = [data]
+    self.segmentStarts = [0]
+    self.payloadSize = payloadSize
+    self.offsets = [0]
+    offset = min(len(data), blockCapacity(0))
+    while offset < len(data):
+      self.offsets.append(offset)
+      offset += blockCapacity(1)
+    self.offsets.append(len(data))
+    self.isOpen = False
+
+  def shareData(self, other):
+    # Use the buffers of another finished session.  None of them are modified
+    # once a session is finished so they are used as they are.
+    self.segments = other.segments
+    self.segmentStarts = other.segmentStarts
+    self.offsets = other.offsets
+    self.payloadSize = other.payloadSize
+    self.isOpen = False
+    self.isShared = True
+
+  def append(self, data):
+    # Add to the payload of an open session.  Returns the number of blocks
+    # that became available.
+    self.payloadSize += len(data)
+    return self._push(data)
+
+  def finish(self, footer):
+    # Add the footer and make the last, partial, block available.
+    numberOfBlocks = self._push(footer)
+    if len(self.pending) or len(self.offsets) == 1:
+      self._freeze(len(self.pending))
+      numberOfBlocks += 1
+    self.isOpen = False
+    return numberOfBlocks
+
+  def _push(self, data):
+    self.pending += data
+    numberOfBlocks = 0
+    while len(self.pending) >= blockCapacity(self.getNumberOfBlocks()):
+      self._freeze(blockCapacity(self.getNumberOfBlocks()))
+      numberOfBlocks += 1
+    return numberOfBlocks
+
+  def _freeze(self, size):
+    self.segmentStarts.append(self.offsets[-1])
+    self.segments.append(bytes(self.pending[:size]))
+    del self.pending[:size]
+    self.offsets.append(self.offsets[-1] + size)
+
+  def getNumberOfBlocks(self):
+    # Only blocks that are available to send are counted.
+    return len(self.offsets) - 1
+
+  def getNumberOfBlocksRemaining(self):
+    return self.getNumberOfBlocks() - self.numberOfBlocksAcked
+
+  def isFinished(self):
+    return not self.isOpen and self.getNumberOfBlocksRemaining() == 0
+
+  def getBlockSize(self, index):
+    return MAX_PACKET_SIZE - blockCapacity(index) + self.offsets[index+1] - self.offsets[index]
+
+  def getBytesRemaining(self):
+    return sum([self.getBlockSize(i) for i in range(self.numberOfBlocksAcked, self.getNumberOfBlocks())])
+
+  def getSize(self):
+    return self.offsets[-1] + len(self.pending)
+
+  def getBlock(self, index):
+    k = bisect.bisect_right(self.segmentStarts, self.offsets[index]) - 1
+    start = self.offsets[index] - self.segmentStarts[k]
+    end = self.offsets[index+1] - self.segmentStarts[k]
+    return memoryview(self.segments[k])[start:end]
+
+  def getRange(self, start, end):
+    # The bytes of the command stream from start to end, a view when they lie
+    # in a single segment.  A segment may run on past the next one's start,
+    # see reopen, so each is only read up to where the next begins.
+    pieces = []
+    k = max(0, bisect.bisect_right(self.segmentStarts, start) - 1)
+    while start < end and k < len(self.segments):
+      segmentStart = self.segmentStarts[k]
+      if k + 1 < len(self.segments):
+        stop = min(end, self.segmentStarts[k+1])
+      else:
+        stop = min(end, self.offsets[-1])
+      if start < stop:
+        pieces.append(memoryview(self.segments[k])[start - segmentStart:stop - segmentStart])
+        start = stop
+      k += 1
+    if start < end:
+      # pending is resized as blocks are frozen so it is copied rather than
+      # viewed.
+      pieces.append(bytes(self.pending[start - self.offsets[-1]:end - self.offsets[-1]]))
+    if len(pieces) == 1:
+      return pieces[0]
+    return b"".join(pieces)
+
+  def getPayload(self):
+    return self.getRange(0, self.payloadSize)
+
+  def getLastPosition(self, end):
+    # Where the last move before end in the command stream goes to, looking
+    # back only as far as it has to.
+    window = MAX_PACKET_SIZE
+    while True:
+      start = max(0, end - window)
+      position = bbcs.lastPosition(self.getRange(start, end))
+      if position is not None or start == 0:
+        return position
+      window *= 4
+
+  def reopen(self):
+    # An open session with the parts and payload of this finished one, ready
+    # for more to be appended.  The blocks before the one where the payload
+    # ends are used as they are, only the commands of that block are copied,
+    # so adding drawing after drawing does not copy the ones before again.
+    d = Session(list(self.parts), self.priority, self.enqueuedMs)
+    last = min(bisect.bisect_right(self.offsets, self.payloadSize) - 1, self.getNumberOfBlocks() - 1)
+    last = max(0, last)
+    lastStart = self.offsets[last]
+    kept = bisect.bisect_left(self.segmentStarts, lastStart)
+    d.segments = self.segments[:kept]
+    d.segmentStarts = self.segmentStarts[:kept]
+    d.offsets = self.offsets[:last + 1]
+    d.pending = bytearray(self.getRange(lastStart, self.payloadSize))
+    d.payloadSize = self.payloadSize
+    return d
+
+  def getPieces(self):
+    # The (drawingId, supersedeKey, payload) of every part, in order.
+    payload = self.getPayload()
+    return [(p.drawingId, p.supersedeKey, payload[p.start:p.end]) for p in self.parts]
+
+  def getPartBlocks(self, part):
+    # The first and last block, inclusive, holding the commands of the part.
+    # Neighbouring parts can share a block and the last part also owns the
+    # block with the footer.  While the session is open only the blocks that
+    # are available so far are counted.
+    lastBlock = max(0, self.getNumberOfBlocks() - 1)
+    first = bisect.bisect_right(self.offsets, part.start) - 1
+    last = bisect.bisect_right(self.offsets, max(part.start, part.end - 1)) - 1
+    if part is self.parts[-1]:
+      last = lastBlock
+    return (min(first, lastBlock), min(last, lastBlock))
+
+  def isPartAvailable(self, part):
+    # Whether every block of the part is available to send.
+    if not self.isOpen:
+      return True
+    return part is not self.parts[-1] and part.end <= self.offsets[-1]
+
+
+class Lane(object):
+  # The sessions waiting at a single priority along with how long sessions
+  # have been waiting before the device started on them.
+  __slots__ = ("priority", "sessions", "numberDispatched", "totalWaitMs")
+
+  def __init__(self, priority):
+    self.priority = priority
+    # Coalescing keeps this short, and an empty list is a fraction of the
+    # size of an empty deque.
+    self.sessions = []
+    self.numberDispatched = 0
+    self.totalWaitMs = 0
+
+  def getStatus(self, nowMs):
+    oldestWaitMs = 0
+    if len(self.sessions):
+      oldestWaitMs = nowMs - self.sessions[0].enqueuedMs
+    averageWaitMs = 0
+    if self.numberDispatched:
+      averageWaitMs = round(self.totalWaitMs / self.numberDispatched)
+    return {
+        "sessions": len(self.sessions),
+        "blocks": sum([d.getNumberOfBlocks() for d in self.sessions]),
+        "oldestWaitMs": oldestWaitMs,
+        "averageWaitMs": averageWaitMs,
+        "dispatched": self.numberDispatched,
+        }
+
+
+class ColdClient(object):
+  # What is kept of a Client while it is in cold storage.  Everything else
+  # is either empty, since only idle clients are evicted, or can be started
+  # afresh.
+  __slots__ = ("createdMs", "lastAccessMs", "numberOfAccesses", "nextSequence",
+      "nextWeatherSlot", "secondsPerBlock", "measuredBlocks", "coalesceStats", "board")
+
+
+class Client(object):
+
+  HEADER_COMMANDS_FOR_FIRST_PACKET = 4
+  SIZE_OF_COMMAND = 3
+  HEADER_COMMANDS_FOR_SUBSEQUENT_PACKET = 2
+
+  # There can be many thousands of these.
+  __slots__ = ("numberOfAccesses", "clientId", "bbcs", "createdMs", "lastAccessMs",
+      "condition", "lanes", "current", "scheduled", "queueBlocks", "queueBytes",
+      "maxQueueBytes", "maxQueueBlocks", "coalesce", "nextSequence", "coalesceStats",
+      "nextWeatherSlot", "finished", "secondsPerBlock", "measuredBlocks", "sentSequence",
+      "sentTime", "log", "evicted", "board")
+
+  def __init__(self, clientId, bbcs, maxQueueBytes=DEFAULT_MAX_QUEUE_BYTES,
+      maxQueueBlocks=DEFAULT_MAX_QUEUE_BLOCKS, coalesce=True, log=None):
+    self.numberOfAccesses = 1
+    self.clientId = clientId
+    self.bbcs = bbcs
+    self.createdMs = round(time.time() * 1000)
+    self.lastAccessMs = self.createdMs
+    self.condition = NotifyingCondition()
+    # Sessions wait in one lane per priority.  The device works through the
+    # blocks of the current session and only when that is finished does the
+    # next session come off the highest priority lane that has work.
+    self.lanes = [Lane(p) for p in range(len(PRIORITY_NAMES))]
+    self.current = None
+    # Drawings that may not start before a given time are rendered and
+    # packetized up front and wait in a heap of (notBeforeMs, drawingId,
+    # session) until they are due.  They count against the queue limits.
+    self.scheduled = []
+    self.queueBlocks = 0
+    self.queueBytes = 0
+    self.maxQueueBytes = maxQueueBytes
+    self.maxQueueBlocks = maxQueueBlocks
+    self.coalesce = coalesce
+    self.nextSequence = 1
+    self.coalesceStats = {
+        "drawingsMerged": 0,
+        "blocksSaved": 0,
+        "travelSaved": 0,
+        "travelSecondsSaved": 0.0,
+        }
+    self.nextWeatherSlot = 0
+    # drawingId -> (state, numberOfBlocks) for drawings that are no longer
+    # waiting or being drawn, oldest first.
+    self.finished = collections.OrderedDict()
+    # How long the board takes per block, measured from handing a block out
+    # to its acknowledgement.
+    self.secondsPerBlock = DEFAULT_SECONDS_PER_BLOCK
+    self.measuredBlocks = 0
+    self.sentSequence = None
+    self.sentTime = None
+    # Every drawing queued and everything that happens to it afterwards is
+    # written to the log, see wal.WriteAheadLog.
+    self.log = log if log is not None else wal.NullLog()
+    # Set once the ClientManager has put the client into cold storage, see
+    # ClientManager.evictIdle.
+    self.evicted = False
+    # What is on the board, see boardmodel.  None until the board has drawn
+    # something, which is the same as a model with nothing known.
+    self.board = None
+
+  def recordAccess(self):
+    # Returns True if lastAccessMs moved on.
+    self.numberOfAccesses += 1
+    nowMs = round(time.time() * 1000)
+    if nowMs - self.lastAccessMs < ACCESS_RESOLUTION_MS:
+      return False
+    self.lastAccessMs = nowMs
+    return True
+
+  def isIdle(self):
+    # Nothing queued, scheduled or being drawn.  A stream that is open has a
+    # session in a lane, so it counts as queued.
+    with self.condition:
+      return (self.current is None and len(self.scheduled) == 0 and
+          all([len(lane.sessions) == 0 for lane in self.lanes]))
+
+  def toCold(self):
+    cold = ColdClient()
+    for name in ColdClient.__slots__:
+      setattr(cold, name, getattr(self, name))
+    # The model is mostly empty cells so it shrinks a long way.
+    cold.board = None if self.board is None else self.board.toBytes()
+    return cold
+
+  def fromCold(self, cold):
+    for name in ColdClient.__slots__:
+      setattr(self, name, getattr(cold, name))
+    self.board = None if cold.board is None else boardmodel.fromBytes(cold.board)
+
+  def popQueueUntilBlockNumber(self, blockNumber):
+    logging.info("popQueueUntilBlockNumber - onEnter; blockNumber: %d", blockNumber)
+    numPopped = 0
+    with self.condition:
+      d = self.current
+      if d is not None:
+        qBlockNumber = toBlockNumber(d.firstSequence + d.numberOfBlocksAcked)
+        logging.info("popQueueUntilBlockNumber - top of queue; qBlockNumber: %d", qBlockNumber)
+
+        # Everything from the next unacknowledged block up to and including
+        # the acknowledged block is done.  An acknowledgement from outside
+        # the window is for a block that has already been popped.
+        distance = blockNumberDistance(qBlockNumber, blockNumber)
+        if distance < BLOCK_NUMBER_WINDOW:
+          firstAcked = d.numberOfBlocksAcked
+          while numPopped <= distance and d.getNumberOfBlocksRemaining() > 0:
+            numPopped += 1
+            self.queueBlocks -= 1
+            self.queueBytes -= d.getBlockSize(d.numberOfBlocksAcked)
+            d.numberOfBlocksAcked += 1
+          if numPopped > 0:
+            if self.board is None:
+              self.board = boardmodel.BoardModel()
+            applyBlocks(self.board, d, firstAcked, d.numberOfBlocksAcked)
+          if numPopped > 0 and self.sentTime is not None:
+            self._recordBlockTime((time.time() - self.sentTime) / numPopped)
+            self.sentTime = None
+          if d.isFinished():
+            self._recordFinished(d, d.parts, DRAWING_DONE)
+            self.nextSequence = d.firstSequence + d.getNumberOfBlocks()
+            self.current = None
+            self.log.logEnd(self.clientId, self.nextSequence)
+          elif numPopped > 0:
+            self.log.logAck(self.clientId, d.numberOfBlocksAcked)
+          self.condition.notify_all()
+        else:
+          logging.info("popQueueUntilBlockNumber - ignoring stale acknowledgement; qBlockNumber: %d, distance: %d",
+              qBlockNumber, distance)
+      logging.info("popQueueUntilBlockNumber - done with work; numPopped: %d, size of Queue remaining: %d", numPopped, self.queueBlocks)
+
+  def clearQueue(self):
+    with self.condition:
+      sessions = [d for lane in self.lanes for d in lane.sessions]
+      sessions += [d for (notBeforeMs, firstDrawingId, d) in self.scheduled]
+      if self.current is not None:
+        sessions.append(self.current)
+      for d in sessions:
+        self._recordFinished(d, d.parts, DRAWING_CLEARED)
+        d.detached = True
+      if self.current is not None:
+        self.nextSequence = self.current.firstSequence + self.current.getNumberOfBlocks()
+      self.log.logEnd(self.clientId, self.nextSequence)
+
+      for lane in self.lanes:
+        lane.sessions.clear()
+      self.scheduled = []
+      self.current = None
+      self.queueBlocks = 0
+      self.queueBytes = 0
+      self.condition.notify_all()
+
+  def restore(self, session, drawings):
+    # Put back what was queued before a restart, see ClientManager.recover.
+    # session is the wal.SessionState and drawings the wal.RecoveredDrawing
+    # of every drawing that was not finished.  The session the board was in
+    # the middle of is rebuilt exactly as it was, so its blocks and block
+    # numbers line up with what the board has already drawn, and everything
+    # else is queued again in its original order.
+    with self.condition:
+      self.nextSequence = session.nextSequence
+      pieces = [(i, drawings[i].supersedeKey, drawings[i].payload)
+          for i in session.drawingIds if i in drawings]
+      if session.firstSequence is not None and len(pieces):
+        d = self._buildSession(pieces, drawings[pieces[0][0]].priority)
+        d.firstSequence = session.firstSequence
+        d.numberOfBlocksAcked = min(session.blocksAcked, d.getNumberOfBlocks())
+        self.current = d
+        self.queueBlocks += d.getNumberOfBlocksRemaining()
+        self.queueBytes += d.getBytesRemaining()
+
+    for r in drawings.values():
+      if self.current is None or not r.drawingId in session.drawingIds:
+        self.addNewDrawing(r.payload, r.supersedeKey, r.priority, r.notBeforeMs, r.drawingId)
+
+    logging.info("restore - done; clientId: %s, drawings: %d, currentBlocksRemaining: %d, queueSize: %d",
+        self.clientId, len(drawings),
+        self.current.getNumberOfBlocksRemaining() if self.current else 0, self.queueBlocks)
+
+  def _recordBlockTime(self, seconds):
+    # The first measurement replaces the default outright, after that it is a
+    # moving average.
+    if self.measuredBlocks == 0:
+      self.secondsPerBlock = seconds
+    else:
+      self.secondsPerBlock = 0.8 * self.secondsPerBlock + 0.2 * seconds
+    self.measuredBlocks += 1
+
+  def _recordFinished(self, d, parts, state):
+    for part in parts:
+      (first, last) = d.getPartBlocks(part)
+      self.finished[part.drawingId] = (state, last - first + 1)
+    while len(self.finished) > MAX_FINISHED_DRAWINGS:
+      self.finished.popitem(last=False)
+    if len(parts):
+      self.log.logFinished(self.clientId, [p.drawingId for p in parts], state)
+
+  def _checkCapacity(self, numBytes, numBlocks):
+    # Refuse the whole drawing if it will not fit.
+    overBytes = self.maxQueueBytes and self.queueBytes + numBytes > self.maxQueueBytes
+    overBlocks = self.maxQueueBlocks and self.queueBlocks + numBlocks > self.maxQueueBlocks
+    if overBytes or overBlocks:
+      logging.info("_checkCapacity - rejecting drawing; clientId: %s, numBytes: %d, numBlocks: %d",
+          self.clientId, numBytes, numBlocks)
+      raise QueueFullException(self.clientId, self.queueBytes, self.queueBlocks,
+          numBytes, numBlocks)
+
+  def checkCapacity(self, numBytes, numBlocks):
+    with self.condition:
+      self._checkCapacity(numBytes, numBlocks)
+
+  def addSharedSession(self, template, notBeforeMs=None):
+    # Queue a session that shares its buffers with template.  Only the block
+    # headers, produced as each block is sent, differ between boards.
+    nowMs = round(time.time() * 1000)
+    with self.condition:
+      parts = [Part(p.drawingId, p.supersedeKey, p.start, p.end) for p in template.parts]
+      d = Session(parts, template.priority, nowMs)
+      d.shareData(template)
+      self._checkCapacity(d.getBytesRemaining(), d.getNumberOfBlocks())
+      if notBeforeMs is not None and notBeforeMs > nowMs:
+        d.enqueuedMs = notBeforeMs
+        heapq.heappush(self.scheduled, (notBeforeMs, parts[0].drawingId, d))
+      else:
+        self.lanes[d.priority].sessions.append(d)
+      self.queueBlocks += d.getNumberOfBlocks()
+      self.queueBytes += d.getBytesRemaining()
+      for (drawingId, supersedeKey, payload) in template.getPieces():
+        self.log.logAdd(self.clientId, drawingId, supersedeKey, d.priority, notBeforeMs, payload)
+      self.condition.notify_all()
+
+    logging.info("addSharedSession - done; clientId: %s, drawingIds: %s, numBlocks: %d",
+        self.clientId, [p.drawingId for p in parts], d.getNumberOfBlocks())
+
+  def addNewDrawing(self, payload, supersedeKey=None, priority=PRIORITY_NORMAL,
+      notBeforeMs=None, drawingId=None):
+    # The data can be arbitrary size and is broken up into blocks of at most
+    # 768 bytes, including the header, that can be transferred in a single
+    # chunk.  That split is only recorded as offsets into the session.
+    #
+    # Returns the id of the new drawing.  The supersedeKey is only recorded
+    # here, see supersede().  A drawing with a notBeforeMs in the future is
+    # held back until then, see scheduleDrawing().  The drawingId is only
+    # given when restoring a drawing from the log.
+    if drawingId is None:
+      drawingId = next(_drawingIds)
+    if len(payload) + len(self._getFooter()) == 0:
+      # The screen command set used by --mockScreen produces no bytes at all.
+      return drawingId
+
+    if notBeforeMs is not None and notBeforeMs > round(time.time() * 1000):
+      return self.scheduleDrawing(drawingId, payload, supersedeKey, priority, notBeforeMs)
+
+    with self.condition:
+      lane = self.lanes[priority]
+      tail = None
+      if self.coalesce and len(lane.sessions) and not lane.sessions[-1].isShared:
+        tail = lane.sessions[-1]
+
+      if tail is None:
+        d = self._buildSession([(drawingId, supersedeKey, payload)], priority)
+        self._checkCapacity(d.getBytesRemaining(), d.getNumberOfBlocks())
+        lane.sessions.append(d)
+      else:
+        d = self._mergeDrawing(tail, drawingId, supersedeKey, payload)
+        lane.sessions[-1] = d
+
+      self.queueBlocks += d.getNumberOfBlocks()
+      self.queueBytes += d.getBytesRemaining()
+      self.log.logAdd(self.clientId, drawingId, supersedeKey, priority, notBeforeMs, payload)
+      self.condition.notify_all()
+
+    logging.info("addNewDrawing - done; drawingId: %d, priority: %s, numBlocks: %d, size: %d, parts: %d",
+        drawingId, PRIORITY_NAMES[priority], d.getNumberOfBlocks(), d.getSize(), len(d.parts))
+    return drawingId
+
+  def scheduleDrawing(self, drawingId, payload, supersedeKey, priority, notBeforeMs):
+    # All of the work of turning the drawing into blocks happens now so that
+    # releasing it at notBeforeMs is only a matter of moving the session onto
+    # its lane.  Drawings due at the same time on the same lane, such as the
+    # pieces of a weather layout, are coalesced with each other.
+    with self.condition:
+      index = None
+      if self.coalesce:
+        for (i, (t, firstDrawingId, tail)) in enumerate(self.scheduled):
+          if t == notBeforeMs and tail.priority == priority and not tail.isShared:
+            index = i
+
+      if index is None:
+        d = self._buildSession([(drawingId, supersedeKey, payload)], priority, notBeforeMs)
+        self._checkCapacity(d.getBytesRemaining(), d.getNumberOfBlocks())
+        heapq.heappush(self.scheduled, (notBeforeMs, drawingId, d))
+      else:
+        # The heap key stays the same so the heap does not need fixing up.
+        (t, firstDrawingId, tail) = self.scheduled[index]
+        d = self._mergeDrawing(tail, drawingId, supersedeKey, payload)
+        self.scheduled[index] = (t, firstDrawingId, d)
+
+      self.queueBlocks += d.getNumberOfBlocks()
+      self.queueBytes += d.getBytesRemaining()
+      self.log.logAdd(self.clientId, drawingId, supersedeKey, priority, notBeforeMs, payload)
+      # Wake up a waiting device request so that it waits no longer than
+      # this drawing is due.
+      self.condition.notify_all()
+
+    logging.info("scheduleDrawing - done; drawingId: %d, priority: %s, notBeforeMs: %d, numBlocks: %d",
+        drawingId, PRIORITY_NAMES[priority], notBeforeMs, d.getNumberOfBlocks())
+    return drawingId
+
+  def _releaseScheduled(self, nowMs):
+    # Move every scheduled session that is due onto its lane.
+    while len(self.scheduled) and self.scheduled[0][0] <= nowMs:
+      (notBeforeMs, firstDrawingId, d) = heapq.heappop(self.scheduled)
+      self.lanes[d.priority].sessions.append(d)
+      logging.info("_releaseScheduled - released session; firstDrawingId: %d, parts: %d, lateMs: %d",
+          firstDrawingId, len(d.parts), nowMs - notBeforeMs)
+
+  def _buildSession(self, pieces, priority, enqueuedMs=None):
+    # Lay the pieces out one after another, making sure the pen is up at each
+    # boundary, and add the footer.
+    if enqueuedMs is None:
+      enqueuedMs = round(time.time() * 1000)
+    liftPen = self.bbcs.liftPen()
+    chunks = []
+    parts = []
+    offset = 0
+    for (drawingId, supersedeKey, payload) in pieces:
+      if offset > 0 and bytes(payload[:len(liftPen)]) != liftPen:
+        chunks.append(liftPen)
+        offset += len(liftPen)
+      parts.append(Part(drawingId, supersedeKey, offset, offset + len(payload)))
+      chunks.append(payload)
+      offset += len(payload)
+    chunks.append(self._getFooter())
+
+    d = Session(parts, priority, enqueuedMs)
+    d.setData(b"".join(chunks), offset)
+    return d
+
+  def _mergeDrawing(self, tail, drawingId, supersedeKey, payload):
+    # The device has not started on the session at the end of the lane (or
+    # the scheduled session due at the same time) so rather than have the
+    # carriage stop, drive home and start again the new payload is folded
+    # into it.  The result has one start, one footer and blocks packed all the
+    # way to 768 bytes, laid out just as _buildSession would lay it out.
+    d = tail.reopen()
+    liftPen = self.bbcs.liftPen()
+    if d.payloadSize > 0 and bytes(payload[:len(liftPen)]) != liftPen:
+      d.append(liftPen)
+    d.parts.append(Part(drawingId, supersedeKey, d.payloadSize, d.payloadSize + len(payload)))
+    d.append(payload)
+    d.finish(self._getFooter())
+
+    self._checkCapacity(d.getBytesRemaining() - tail.getBytesRemaining(),
+        d.getNumberOfBlocks() - tail.getNumberOfBlocks())
+    self.queueBlocks -= tail.getNumberOfBlocks()
+    self.queueBytes -= tail.getBytesRemaining()
+
+    footerSize = len(self._getFooter())
+    blocksSeparately = tail.getNumberOfBlocks() + blocksForSize(len(payload) + footerSize)
+    self._recordMerge(tail.getLastPosition(tail.payloadSize), payload,
+        blocksSeparately - d.getNumberOfBlocks())
+
+    logging.info("_mergeDrawing - merged into unsent session; parts: %d, blocks: %d, blocksSeparately: %d",
+        len(d.parts), d.getNumberOfBlocks(), blocksSeparately)
+    return d
+
+  def _recordMerge(self, end, payload, blocksSaved):
+    # Work out how far the carriage no longer has to travel by skipping the
+    # trip home between the two drawings, end being where the first left off.
+    start = bbcs.firstPosition(payload)
+    if end is not None and start is not None:
+      home = (0, 0)
+      viaHome = math.hypot(end[0], end[1]) + math.hypot(start[0], start[1])
+      direct = math.hypot(start[0] - end[0], start[1] - end[1])
+      self.coalesceStats["travelSaved"] += int(viaHome - direct)
+      self.coalesceStats["travelSecondsSaved"] += (bbcs.travelSeconds(end, home) +
+          bbcs.travelSeconds(home, start) - bbcs.travelSeconds(end, start))
+
+    self.coalesceStats["drawingsMerged"] += 1
+    self.coalesceStats["blocksSaved"] += blocksSaved
+
+  def openStream(self, priority=PRIORITY_NORMAL):
+    return DrawingStream(self, priority)
+
+  def _startStreamPart(self, stream, drawingId, supersedeKey):
+    # The first part of a stream goes into the unstarted session at the end
+    # of the lane, reopening it, when coalescing.  Otherwise the part gets a
+    # session of its own, see _endStreamPart.
+    with self.condition:
+      if stream.session is None:
+        lane = self.lanes[stream.priority]
+        nowMs = round(time.time() * 1000)
+        if (self.coalesce and len(lane.sessions) and not lane.sessions[-1].isOpen and
+            not lane.sessions[-1].isShared):
+          tail = lane.sessions[-1]
+          d = tail.reopen()
+          self.queueBlocks += d.getNumberOfBlocks() - tail.getNumberOfBlocks()
+          self.queueBytes += d.getBytesRemaining() - tail.getBytesRemaining()
+          lane.sessions[-1] = d
+        else:
+          d = Session([], stream.priority, nowMs)
+          lane.sessions.append(d)
+        stream.session = d
+
+      d = stream.session
+      d.parts.append(Part(drawingId, supersedeKey, d.payloadSize, d.payloadSize))
+      stream.needsSeparator = d.payloadSize > 0
+
+  def _writeStream(self, stream, data):
+    with self.condition:
+      d = stream.session
+      if d.detached:
+        # The queue was cleared while the drawing was being rendered.
+        return
+
+      part = d.parts[-1]
+      if stream.needsSeparator:
+        # As in _buildSession the pen must be up between parts.
+        stream.needsSeparator = False
+        liftPen = self.bbcs.liftPen()
+        if bytes(data[:len(liftPen)]) != liftPen:
+          data = liftPen + data
+          part.start += len(liftPen)
+
+      self._checkCapacity(len(data), blocksForSize(len(data)))
+      numberOfBlocks = d.append(data)
+      part.end = d.payloadSize
+      if numberOfBlocks:
+        self._addStreamBlocks(d, numberOfBlocks)
+
+  def _endStreamPart(self, stream):
+    with self.condition:
+      d = stream.session
+      part = d.parts[-1]
+      # A part nothing was written to takes up no room, not even a separator.
+      # It is not logged either, so a session restored from the log is laid
+      # out the same way.
+      stream.needsSeparator = False
+      if d.detached:
+        return
+
+      payload = d.getRange(part.start, part.end)
+      if part.start > 0:
+        # Blocks saved are worked out the same way as for _mergeDrawing; the
+        # session so far as opposed to the part on its own.
+        footerSize = len(self._getFooter())
+        blocksSaved = (blocksForSize(part.start + footerSize) +
+            blocksForSize(part.end - part.start + footerSize) - blocksForSize(part.end + footerSize))
+        self._recordMerge(d.getLastPosition(part.start), payload, blocksSaved)
+      if part.end > part.start:
+        self.log.logAdd(self.clientId, part.drawingId, part.supersedeKey, d.priority, None,
+            payload, d is self.current)
+
+      if not self.coalesce and d.payloadSize > 0:
+        # Finish the session off so that the next part opens one of its own.
+        # A session with nothing in it yet is left for the next part.
+        self._finishStreamSession(d)
+        stream.session = None
+
+  def _addStreamBlocks(self, d, numberOfBlocks):
+    # Make newly frozen blocks of a stream available to the device.
+    first = d.getNumberOfBlocks() - numberOfBlocks
+    self.queueBlocks += numberOfBlocks
+    self.queueBytes += sum([d.getBlockSize(i) for i in range(first, d.getNumberOfBlocks())])
+    self.condition.notify_all()
+
+  def _closeStream(self, stream):
+    with self.condition:
+      d = stream.session
+      if d is None or d.detached or not d.isOpen:
+        return
+      self._finishStreamSession(d)
+
+    logging.info("_closeStream - done; drawingIds: %s, numBlocks: %d, size: %d",
+        stream.drawingIds, d.getNumberOfBlocks(), d.getSize())
+
+  def _finishStreamSession(self, d):
+    # Add the footer to the session of a stream and make its last block
+    # available.
+    numberOfBlocks = d.finish(self._getFooter())
+    if d.getSize() == 0:
+      # The screen command set used by --mockScreen produces no bytes at all.
+      self.lanes[d.priority].sessions.remove(d)
+      return
+    self._addStreamBlocks(d, numberOfBlocks)
+
+  def _abortStream(self, stream):
+    # Rendering failed part way through.  Take back the drawings of this
+    # stream unless the device has already started on them, in which case
+    # the session is finished off normally.  Without coalescing the drawings
+    # are spread over several sessions.
+    with self.condition:
+      self._closeStream(stream)
+      dropped = self._dropUnstarted(lambda part: part.drawingId in stream.drawingIds,
+          DRAWING_CANCELLED)
+      if len(dropped):
+        logging.info("_abortStream - dropped unsent drawings; dropped: %s", dropped)
+
+  def supersede(self, supersedeKey):
+    # Drop every drawing with this key that the device has not started on.
+    # Called before queueing a newer drawing with the same key so that a board
+    # which has been offline only draws the latest version.
+    with self.condition:
+      dropped = self._dropUnstarted(lambda part: part.supersedeKey == supersedeKey,
+          DRAWING_SUPERSEDED)
+    logging.info("supersede - done; supersedeKey: %s, dropped: %s", supersedeKey, dropped)
+    return dropped
+
+  def cancelDrawing(self, drawingId):
+    # Returns True if the drawing was removed.  A drawing that the device has
+    # already started on can no longer be cancelled.
+    with self.condition:
+      dropped = self._dropUnstarted(lambda part: part.drawingId == drawingId,
+          DRAWING_CANCELLED)
+    logging.info("cancelDrawing - done; drawingId: %d, dropped: %s", drawingId, dropped)
+    return len(dropped) > 0
+
+  def _dropUnstarted(self, shouldDrop, state):
+    # Remove the parts matching shouldDrop from every session that the device
+    # has not started, whether queued or scheduled, and record them as
+    # finished in the given state.
+    dropped = []
+    for lane in self.lanes:
+      newSessions = []
+      for d in lane.sessions:
+        d = self._dropParts(d, shouldDrop, state, dropped)
+        if d is not None:
+          newSessions.append(d)
+      lane.sessions = newSessions
+
+    remaining = []
+    for (notBeforeMs, firstDrawingId, d) in self.scheduled:
+      d = self._dropParts(d, shouldDrop, state, dropped)
+      if d is not None:
+        remaining.append((notBeforeMs, firstDrawingId, d))
+    heapq.heapify(remaining)
+    self.scheduled = remaining
+
+    if len(dropped):
+      self.condition.notify_all()
+    return dropped
+
+  def _dropParts(self, d, shouldDrop, state, dropped):
+    # Sessions are only ever cut at part boundaries and are rebuilt from the
+    # parts that remain.  Returns None when nothing is left.  Sessions that
+    # are still being rendered are left alone.
+    if d.isOpen or not any([shouldDrop(p) for p in d.parts]):
+      return d
+
+    self.queueBlocks -= d.getNumberOfBlocks()
+    self.queueBytes -= d.getBytesRemaining()
+    self._recordFinished(d, [p for p in d.parts if shouldDrop(p)], state)
+    pieces = []
+    for (part, piece) in zip(d.parts, d.getPieces()):
+      if shouldDrop(part):
+        dropped.append(part.drawingId)
+      else:
+        pieces.append(piece)
+    if len(pieces) == 0:
+      return None
+
+    d = self._buildSession(pieces, d.priority, d.enqueuedMs)
+    self.queueBlocks += d.getNumberOfBlocks()
+    self.queueBytes += d.getBytesRemaining()
+    return d
+
+  def _getHeader(self, isFirst, blockNumber):
+    result  = self.bbcs.packetStart()
+    result += self.bbcs.blockIdentifier(blockNumber)
+
+    if isFirst:
+      result += self.bbcs.startDrawing()
+      result += self.bbcs.liftPen()
+
+    return result
+
+  def _getFooter(self):
+    result  = self.bbcs.liftPen()
+    result += self.bbcs.moveTo(0,0)
+    result += self.bbcs.stopDrawing()
+    return result
+
+  def _nextSession(self):
+    # Start on the session at the head of the highest priority lane with work
+    # and give its blocks their sequence numbers.  A session still being
+    # rendered that has no blocks yet holds up its lane and those below it;
+    # it will have blocks shortly.  nextSequence moves past the session once
+    # the device is done with it, see popQueueUntilBlockNumber.
+    for lane in self.lanes:
+      if len(lane.sessions):
+        if lane.sessions[0].getNumberOfBlocks() == 0:
+          return None
+        d = lane.sessions.pop(0)
+        d.firstSequence = self.nextSequence
+        self.log.logStart(self.clientId, d.firstSequence, [p.drawingId for p in d.parts])
+        lane.numberDispatched += 1
+        lane.totalWaitMs += round(time.time() * 1000) - d.enqueuedMs
+        logging.info("_nextSession - starting session; priority: %s, firstSequence: %d, numBlocks: %d",
+            PRIORITY_NAMES[lane.priority], d.firstSequence, d.getNumberOfBlocks())
+        return d
+    return None
+
+  def getNextBlock(self, timeoutSeconds):
+    # Returns the block number along with the header and body of the block.
+    # The body is a view into the session so the caller should send it
+    # rather than hold on to it.
+    deadline = time.time() + timeoutSeconds
+    with self.condition:
+      while True:
+        (result, dueSeconds) = self._pollNextBlock()
+        if result is not None:
+          return result
+
+        # Wait for new work, or the next block of a session still being
+        # rendered, but no longer than it takes for the next
+        # scheduled drawing to become due.
+        waitSeconds = deadline - time.time()
+        if waitSeconds <= 0:
+          logging.info("getNextResult - no work available; timeoutSeconds: %d", timeoutSeconds)
+          raise NoWorkException()
+        if dueSeconds is not None:
+          waitSeconds = min(waitSeconds, dueSeconds)
+        self.condition.wait(waitSeconds)
+
+  def pollNextBlock(self):
+    # getNextBlock without the waiting.  Returns (block, dueSeconds) where
+    # block is None if there is nothing to send yet and dueSeconds is how
+    # long until the next scheduled drawing is due, if there is one.
+    with self.condition:
+      return self._pollNextBlock()
+
+  def _pollNextBlock(self):
+    if self.current is None:
+      self._releaseScheduled(round(time.time() * 1000))
+      self.current = self._nextSession()
+
+    d = self.current
+    if d is None or d.getNumberOfBlocksRemaining() == 0:
+      dueSeconds = None
+      if len(self.scheduled):
+        dueSeconds = max(0, self.scheduled[0][0] / 1000 - time.time())
+      return (None, dueSeconds)
+
+    index = d.numberOfBlocksAcked
+    blockNumber = toBlockNumber(d.firstSequence + index)
+    if self.sentSequence != d.firstSequence + index:
+      # Only the first time a block goes out counts towards how long the
+      # board takes to draw it.
+      self.sentSequence = d.firstSequence + index
+      self.sentTime = time.time()
+    logging.info("getNextBlock - found a block; blockNumber: %d", blockNumber)
+    return ((blockNumber, self._getHeader(index == 0, blockNumber), d.getBlock(index)), None)
+
+  def getDrawingStatus(self, drawingId):
+    with self.condition:
+      return self._getDrawingStatus(drawingId)
+
+  def _getDrawingStatus(self, drawingId):
+    # Work out where the drawing is and how many blocks the board has to get
+    # through, including those of everything ahead of it, before it is done.
+    result = {"drawingId": drawingId, "state": DRAWING_UNKNOWN, "blocks": 0,
+        "blocksAcked": 0, "estimatedSecondsRemaining": 0}
+
+    if drawingId in self.finished:
+      (state, numberOfBlocks) = self.finished[drawingId]
+      result["state"] = state
+      result["blocks"] = numberOfBlocks
+      if state == DRAWING_DONE:
+        result["blocksAcked"] = numberOfBlocks
+      return result
+
+    blocksAhead = 0
+    d = self.current
+    if d is not None:
+      for part in d.parts:
+        if part.drawingId == drawingId:
+          (first, last) = d.getPartBlocks(part)
+          result["blocks"] = last - first + 1
+          result["blocksAcked"] = min(max(0, d.numberOfBlocksAcked - first), result["blocks"])
+          result["state"] = DRAWING_DRAWING
+          if result["blocksAcked"] == result["blocks"] and d.isPartAvailable(part):
+            result["state"] = DRAWING_DONE
+          result["estimatedSecondsRemaining"] = round(self.secondsPerBlock * (last + 1 - d.numberOfBlocksAcked), 1)
+          return result
+      blocksAhead += d.getNumberOfBlocksRemaining()
+
+    for lane in self.lanes:
+      for d in lane.sessions:
+        for part in d.parts:
+          if part.drawingId == drawingId:
+            (first, last) = d.getPartBlocks(part)
+            result["state"] = DRAWING_QUEUED
+            result["blocks"] = last - first + 1
+            result["estimatedSecondsRemaining"] = round(self.secondsPerBlock * (blocksAhead + last + 1), 1)
+            return result
+        blocksAhead += d.getNumberOfBlocks()
+
+    # Anything already queued is not counted for scheduled drawings, it may
+    # well be done by the time they are due.
+    for (notBeforeMs, firstDrawingId, d) in self.scheduled:
+      for part in d.parts:
+        if part.drawingId == drawingId:
+          (first, last) = d.getPartBlocks(part)
+          result["state"] = DRAWING_SCHEDULED
+          result["blocks"] = last - first + 1
+          result["notBeforeMs"] = notBeforeMs
+          result["estimatedSecondsRemaining"] = round(max(0, notBeforeMs / 1000 - time.time()) +
+              self.secondsPerBlock * (last + 1), 1)
+          return result
+
+    return result
+
+  def waitForDrawings(self, drawingIds, timeoutSeconds):
+    # Block until every one of the drawings has reached a final state or the
+    # timeout expires.  Returns (complete, [status of each drawing]).
+    deadline = time.time() + timeoutSeconds
+    with self.condition:
+      while True:
+        statuses = [self._getDrawingStatus(i) for i in drawingIds]
+        complete = all([s["state"] in FINAL_DRAWING_STATES for s in statuses])
+        waitSeconds = deadline - time.time()
+        if complete or waitSeconds <= 0:
+          return (complete, statuses)
+        self.condition.wait(waitSeconds)
+
+  def getSecondsPerBlock(self):
+    return self.secondsPerBlock
+
+  def getBoardModel(self):
+    # A copy of the model of what is on the board, to query without holding
+    # up the board.
+    with self.condition:
+      if self.board is None:
+        return boardmodel.BoardModel()
+      return self.board.copy()
+
+  def getPlannedBoardModel(self):
+    # The model as it will be once the board has drawn everything queued for
+    # it, or None while a drawing is still being rendered and there is no
+    # telling where it will draw.  Queued erases are left out, they may
+    # end up drawn before the drawings they were meant to clear.
+    with self.condition:
+      sessions = [d for lane in self.lanes for d in lane.sessions]
+      sessions += [d for (notBeforeMs, firstDrawingId, d) in self.scheduled]
+      if any([d.isOpen for d in sessions + [self.current] if d is not None]):
+        return None
+      board = boardmodel.BoardModel() if self.board is None else self.board.copy()
+      d = self.current
+      if d is not None:
+        for index in range(d.numberOfBlocksAcked, d.getNumberOfBlocks()):
+          board.apply(d.getBlock(index), erase=False)
+      for d in sessions:
+        board.apply(d.getPayload(), erase=False)
+    return board
+
+  def forgetBoardModel(self):
+    # Go back to knowing nothing about what is on the board, when it has been
+    # wiped by hand say.
+    with self.condition:
+      self.board = None
+
+  def getQueueSize(self):
+    with self.condition:
+      return self.queueBlocks
+
+  def getQueueBytes(self):
+    with self.condition:
+      return self.queueBytes
+
+  def getLaneStatus(self):
+    with self.condition:
+      nowMs = round(time.time() * 1000)
+      return dict([(PRIORITY_NAMES[lane.priority], lane.getStatus(nowMs)) for lane in self.lanes])
+
+  def getScheduledStatus(self):
+    with self.condition:
+      return [{"drawingIds": [p.drawingId for p in d.parts], "notBeforeMs": notBeforeMs,
+          "priority": PRIORITY_NAMES[d.priority], "blocks": d.getNumberOfBlocks()}
+          for (notBeforeMs, firstDrawingId, d) in sorted(self.scheduled, key=lambda e: e[:2])]
+
+  def getCoalesceStats(self):
+    with self.condition:
+      return dict(self.coalesceStats)
+
+  def getNextWeatherSlot(self):
+      return self.nextWeatherSlot
+
+  def setNextWeatherSlot(self, slot):
+      self.nextWeatherSlot = slot
+
+
+class GroupStream(object):
+  # The DrawingStream of a ClientGroup.  Every drawing is rendered once and
+  # they are all published to the boards, as one shared session, when the
+  # stream is closed.
+  def __init__(self, group, priority):
+    self.group = group
+    self.priority = priority
+    self.pieces = []
+
+  def addDrawing(self, chunks, supersedeKey=None):
+    drawingId = next(_drawingIds)
+    self.pieces.append((drawingId, supersedeKey, joinChunks(chunks)))
+    return drawingId
+
+  def close(self):
+    if len(self.pieces):
+      self.group.addShared(self.pieces, self.priority)
+    self.pieces = []
+
+  def abort(self):
+    self.pieces = []
+
+
+class ClientGroup(object):
+  # Stands in for a Client when the same drawings go to several boards.  The
+  # drawings are rendered and packetized once and every board queues a
+  # session over the same buffers, so adding boards costs a few small objects
+  # each rather than another render and another copy of the commands.  A
+  # drawing keeps its id on every board.
+  def __init__(self, clients):
+    self.clients = clients
+    self.clientId = ",".join([c.clientId for c in clients])
+
+  def getQueueSize(self):
+    return sum([c.getQueueSize() for c in self.clients])
+
+  def getNextWeatherSlot(self):
+    # The boards of a group show the same thing so they share the slot of the
+    # first board.
+    return self.clients[0].getNextWeatherSlot()
+
+  def setNextWeatherSlot(self, slot):
+    for c in self.clients:
+      c.setNextWeatherSlot(slot)
+
+  def supersede(self, supersedeKey):
+    return [drawingId for c in self.clients for drawingId in c.supersede(supersedeKey)]
+
+  def openStream(self, priority=PRIORITY_NORMAL):
+    return GroupStream(self, priority)
+
+  def addNewDrawing(self, payload, supersedeKey=None, priority=PRIORITY_NORMAL,
+      notBeforeMs=None):
+    drawingId = next(_drawingIds)
+    self.addShared([(drawingId, supersedeKey, payload)], priority, notBeforeMs)
+    return drawingId
+
+  def addShared(self, pieces, priority, notBeforeMs=None):
+    template = self.clients[0]._buildSession(pieces, priority)
+    if template.getSize() == 0:
+      # The screen command set used by --mockScreen produces no bytes at all.
+      return
+
+    # Refuse the drawings outright if any board is full rather than leave the
+    # boards out of step.
+    for c in self.clients:
+      c.checkCapacity(template.getBytesRemaining(), template.getNumberOfBlocks())
+    for c in self.clients:
+      c.addSharedSession(template, notBeforeMs)
+
+
+class ClientManager(object):
+  def __init__(self, bbcs, maxQueueBytes=DEFAULT_MAX_QUEUE_BYTES,
+      maxQueueBlocks=DEFAULT_MAX_QUEUE_BLOCKS, coalesce=True, groups=None, log=None,
+      clientTtlSeconds=DEFAULT_CLIENT_TTL_SECONDS):
+    self.bbcs = bbcs
+    self.maxQueueBytes = maxQueueBytes
+    self.maxQueueBlocks = maxQueueBlocks
+    self.coalesce = coalesce
+    # clientId -> Client.  Looking a client up takes no lock, adding or
+    # removing one takes the stripe of its id, see _getStripe.
+    self.clientDevices = {}
+    # clientId -> ColdClient for the clients that have been evicted.
+    self.coldClients = {}
+    self.stripes = [threading.Lock() for i in range(CLIENT_LOCK_STRIPES)]
+    self.clientTtlSeconds = clientTtlSeconds
+    self.evictionListeners = []
+    self.numberEvicted = 0
+    self.numberThawed = 0
+    # Group name -> list of client ids, see getClientGroup.
+    self.groups = groups or {}
+    self.log = log if log is not None else wal.NullLog()
+
+  def recover(self):
+    # Open the log and rebuild every client's queue from it.  Must be called
+    # before the server starts taking requests.  The clients are restored
+    # before they are attached to the log since everything they restore is
+    # in it already.
+    global _drawingIds
+    recovery = self.log.open()
+    for (clientId, session) in recovery.sessions.items():
+      c = self.getOrMakeClient(clientId)
+      c.log = wal.NullLog()
+      c.restore(session, recovery.drawings[clientId])
+      c.log = self.log
+    _drawingIds = itertools.count(max(next(_drawingIds), recovery.maxDrawingId + 1))
+    return recovery
+
+  def getGroup(self, name):
+    if not name in self.groups:
+      raise ValueError("Unknown group '{}'".format(name))
+    return self.groups[name]
+
+  def getClientGroup(self, clientIds):
+    return ClientGroup([self.getOrMakeClient(clientId) for clientId in clientIds])
+
+  def getClientIds(self):
+    # The clients in memory, not those in cold storage.
+    return list(self.clientDevices.keys())
+
+  def getQueueSizes(self):
+    # [(clientId, queue size)] of the clients in memory, for the main menu.
+    # Unlike getClient this does not count as an access.
+    return [(clientId, c.getQueueSize()) for (clientId, c) in list(self.clientDevices.items())]
+
+  def _getStripe(self, clientId):
+    return self.stripes[hash(clientId) % len(self.stripes)]
+
+  def _makeClient(self, clientId):
+    return Client(clientId, self.bbcs, self.maxQueueBytes, self.maxQueueBlocks,
+        self.coalesce, self.log)
+
+  def _findClient(self, clientId, make):
+    # The slow path of getClient: take the stripe and bring the client back
+    # from cold storage, or make it, if it is not in memory.
+    with self._getStripe(clientId):
+      c = self.clientDevices.get(clientId)
+      if c is not None:
+        return c
+      cold = self.coldClients.pop(clientId, None)
+      if cold is not None:
+        logging.info("_findClient - restoring client from cold storage; clientId: %s", clientId)
+        c = self._makeClient(clientId)
+        c.fromCold(cold)
+        self.numberThawed += 1
+      elif make:
+        logging.info("getOrMakeClient - creating new client; clientId: %s", clientId);
+        c = self._makeClient(clientId)
+      else:
+        return None
+      self.clientDevices[clientId] = c
+    return c
+
+  def getOrMakeClient(self, clientId):
+    c = self.getClient(clientId)
+    if c is None:
+      c = self._findClient(clientId, True)
+    return c
+
+  def getClient(self, clientId):
+    c = self.clientDevices.get(clientId)
+    if c is not None:
+      c.recordAccess()
+      # evictIdle sets evicted before it looks at lastAccessMs for the last
+      # time and recordAccess moves lastAccessMs on before this looks at
+      # evicted, so one of the two always sees the other.
+      if not c.evicted:
+        return c
+    elif not clientId in self.coldClients:
+      return None
+    c = self._findClient(clientId, False)
+    if c is not None:
+      c.recordAccess()
+    return c
+
+  def addEvictionListener(self, listener):
+    # listener(client) is called for every client put into cold storage.
+    self.evictionListeners.append(listener)
+
+  def evictIdle(self, atMs=None):
+    # Put every client that has been idle for longer than the ttl into cold
+    # storage.  Returns how many were evicted.
+    if not self.clientTtlSeconds:
+      return 0
+    if atMs is None:
+      atMs = round(time.time() * 1000)
+    cutoffMs = atMs - self.clientTtlSeconds * 1000
+    evicted = []
+    for c in list(self.clientDevices.values()):
+      if c.lastAccessMs >= cutoffMs:
+        continue
+      with self._getStripe(c.clientId):
+        if self.clientDevices.get(c.clientId) is not c or not c.isIdle():
+          continue
+        c.evicted = True
+        if c.lastAccessMs >= cutoffMs:
+          c.evicted = False
+          continue
+        # Into cold storage before out of memory so that a lookup without
+        # the stripe finds it in one or the other.
+        self.coldClients[c.clientId] = c.toCold()
+        del self.clientDevices[c.clientId]
+      evicted.append(c)
+
+    self.numberEvicted += len(evicted)
+    for c in evicted:
+      for listener in self.evictionListeners:
+        listener(c)
+    if len(evicted):
+      logging.info("evictIdle - moved clients to cold storage; evicted: %d, inMemory: %d, cold: %d",
+          len(evicted), len(self.clientDevices), len(self.coldClients))
+    return len(evicted)
+
+  def startEvictor(self):
+    # Run evictIdle in the background, a few times per ttl.
+    if not self.clientTtlSeconds:
+      return None
+    intervalSeconds = min(60, self.clientTtlSeconds / 4)
+
+    def run():
+      while True:
+        time.sleep(intervalSeconds)
+        try:
+          self.evictIdle()
+        except Exception:
+          logging.exception("run - eviction failed;")
+
+    t = threading.Thread(target=run, name="evictor", daemon=True)
+    t.start()
+    return t
+
+  def getStats(self):
+    return {
+        "inMemory": len(self.clientDevices),
+        "cold": len(self.coldClients),
+        "evicted": self.numberEvicted,
+        "restored": self.numberThawed,
+        "ttlSeconds": self.clientTtlSeconds,
+        }
@@ -3,3 +3,17 @@
 
 MAX_HEIGHT = 1100
 MAX_WIDTH = 3850
+
+# Travel speeds in board units (mm/10) per second.  These are derived from the
+# steps per second and steps per mm found in the firmware's Configuration.h.
+MOVE_SPEED_X = 20000 * 10 / 80
+MOVE_SPEED_Y = 15000 * 10 / 38
+PAINT_SPEED_X = 4000 * 10 / 80
+PAINT_SPEED_Y = 1905 * 10 / 38
+ERASER_SPEED_X = 10000 * 10 / 80
+ERASER_SPEED_Y = 15000 * 10 / 38
+
+# The eraser is a pad about this many board units across, and the furthest
+# right it is taken, see bbcs.eraseAll.
+ERASER_SIZE = 100
+ERASER_MAX_X = 3580
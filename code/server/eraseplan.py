@@ -0,0 +1,178 @@
+import bbcs
+import boardmodel
+from boardmodel import CELL_SIZE, COLUMNS, ROWS
+from constants import ERASER_MAX_X, ERASER_SIZE, ERASER_SPEED_X, ERASER_SPEED_Y, MAX_HEIGHT
+
+# Planning an erase from what the board model says is on the board, rather
+# than sweeping the whole of it twice the way bbcs.eraseAll is used.
+#
+# The cells to clear, those with ink on them or that are unknown, are swept
+# in passes ERASER_SIZE wide, either along the rows or down the columns,
+# whichever ERASER_SPEED_X and ERASER_SPEED_Y make quicker for this board.
+# Going by those the eraser is three times as fast up and down as across,
+# so most plans go down the columns.  Each pass only runs as far as the
+# cells in its band and the bands with nothing in them are skipped.  The
+# plan is then run through a scratch model and any cell the first path
+# misses, or every cell when a very clean erase is asked for, gets a second
+# path with the passes one cell apart, which is what the second eraseAll
+# does.  The eraser is taken to be a square pad; a cell counts as erased
+# once the pad has been wholly over it, see BoardModel._erase.
+#
+# When the model cannot say where the ink is, the whole board is unknown or
+# a drawing is still being rendered, or when the plan would take no less
+# time, the plan is the old full double erase.
+
+AXIS_X = "x"
+AXIS_Y = "y"
+
+# For simulating the plans and timing them.
+_bbcs = bbcs.Bbcs()
+
+def getBoardCells(board):
+  # (column, row) of every cell of a boardmodel.BoardModel that wants erasing.
+  return set(board.getCells(boardmodel.CELL_INK) + board.getCells(boardmodel.CELL_UNKNOWN))
+
+def getRegionCells(regions):
+  # (column, row) of every cell that overlaps one of regions, each
+  # (x1, y1, x2, y2) in board units.
+  cells = set()
+  for (x1, y1, x2, y2) in regions:
+    if not (x1 < x2 and y1 < y2):
+      raise ValueError("Region {} is empty".format((x1, y1, x2, y2)))
+    (firstColumn, firstRow) = boardmodel.getCell(max(0, x1), max(0, y1))
+    (lastColumn, lastRow) = boardmodel.getCell(max(0, x2 - 1), max(0, y2 - 1))
+    cells.update([(c, r) for c in range(firstColumn, lastColumn + 1)
+        for r in range(firstRow, lastRow + 1)])
+  return cells
+
+def parseRegion(spec):
+  # "x1,y1,x2,y2" as given to /erase.
+  parts = spec.split(",")
+  if len(parts) != 4:
+    raise ValueError("A region is x1,y1,x2,y2, not {}".format(spec))
+  return tuple([int(p) for p in parts])
+
+def planPasses(cells, axis, close=False):
+  # The passes that cover cells sweeping along axis, as (centre, start, end)
+  # with centre the other coordinate of the pass.  The passes are ERASER_SIZE
+  # apart, or a cell apart when close.
+  if axis == AXIS_X:
+    lines = {}
+    for (c, r) in cells:
+      lines.setdefault(r, []).append(c)
+    (maxCentre, maxAlong) = (MAX_HEIGHT - 1, ERASER_MAX_X)
+  else:
+    lines = {}
+    for (c, r) in cells:
+      lines.setdefault(c, []).append(r)
+    (maxCentre, maxAlong) = (ERASER_MAX_X, MAX_HEIGHT - 1)
+
+  linesPerPass = 1 if close else ERASER_SIZE // CELL_SIZE
+  passes = []
+  remaining = sorted(lines)
+  while len(remaining):
+    first = remaining[0]
+    band = [l for l in remaining if l < first + linesPerPass]
+    remaining = remaining[len(band):]
+    if close:
+      centre = first * CELL_SIZE + CELL_SIZE // 2
+    else:
+      centre = first * CELL_SIZE + ERASER_SIZE // 2
+    along = [i for l in band for i in lines[l]]
+    # The pad is wholly over a cell while its centre is anywhere across the
+    # cell, so the pass runs from the near edge of the first to the far edge
+    # of the last.
+    passes.append((min(centre, maxCentre), min(along) * CELL_SIZE,
+        min((max(along) + 1) * CELL_SIZE, maxAlong)))
+  return passes
+
+def getPath(passes, axis, start=(0, 0)):
+  # The points the eraser is taken through for passes: each one out and back
+  # again, the way eraseAll does, starting from whichever end is nearer.
+  path = []
+  position = start
+  for (centre, a, b) in passes:
+    if axis == AXIS_X:
+      ends = [(a, centre), (b, centre)]
+    else:
+      ends = [(centre, a), (centre, b)]
+    if bbcs.travelSeconds(position, ends[1], ERASER_SPEED_X, ERASER_SPEED_Y) < (
+        bbcs.travelSeconds(position, ends[0], ERASER_SPEED_X, ERASER_SPEED_Y)):
+      ends.reverse()
+    path += [ends[0], ends[1], ends[0]]
+    position = ends[0]
+  return path
+
+def estimateSeconds(commands, start=(0, 0)):
+  # How long the eraser takes over commands, going by the moves alone.
+  seconds = 0.0
+  position = start
+  for (code1, code2) in bbcs.decodeCommands(commands):
+    if code1 < bbcs.FIRST_SPECIAL_CODE:
+      seconds += bbcs.travelSeconds(position, (code1, code2), ERASER_SPEED_X, ERASER_SPEED_Y)
+      position = (code1, code2)
+  return seconds
+
+def getMissed(cells, path):
+  # The cells of cells that path does not erase.
+  board = boardmodel.BoardModel()
+  board.cells[:] = bytes(len(board.cells))
+  for (c, r) in cells:
+    board.cells[r * COLUMNS + c] = boardmodel.CELL_INK
+  board.apply(_bbcs.erasePath(path))
+  return set(board.getCells(boardmodel.CELL_INK))
+
+
+class ErasePlan(object):
+  # What to queue for an erase: the paths the eraser takes, or None for the
+  # full double erase.
+  def __init__(self, paths, axis=None, cells=()):
+    self.paths = paths
+    self.axis = axis
+    self.cells = len(cells)
+
+  def isFull(self):
+    return self.paths is None
+
+  def getDrawings(self, b):
+    # The drawings to queue, encoded by b.
+    if self.isFull():
+      return [b.eraseAll(), b.eraseAll(offset=25, moveY=50)]
+    return [b.erasePath(path) for path in self.paths]
+
+  def getSeconds(self):
+    return estimateSeconds(b"".join(self.getDrawings(_bbcs)))
+
+  def getStatus(self):
+    return {
+        "full": self.isFull(),
+        "axis": self.axis,
+        "cells": self.cells,
+        "paths": None if self.isFull() else len(self.paths),
+        "seconds": round(self.getSeconds(), 1),
+        }
+
+def fullPlan():
+  return ErasePlan(None)
+
+def planErase(cells, veryClean=False):
+  # The quickest plan that erases cells.  With veryClean every cell gets a
+  # second pass, otherwise only the cells the first one misses.
+  cells = set(cells)
+  if len(cells) == 0:
+    return ErasePlan([], cells=cells)
+  if len(cells) == COLUMNS * ROWS:
+    return fullPlan()
+
+  best = None
+  for axis in (AXIS_X, AXIS_Y):
+    paths = [getPath(planPasses(cells, axis), axis)]
+    again = cells if veryClean else getMissed(cells, paths[0])
+    if len(again):
+      paths.append(getPath(planPasses(again, axis, close=True), axis, paths[0][-1]))
+    plan = ErasePlan(paths, axis, cells)
+    if best is None or plan.getSeconds() < best.getSeconds():
+      best = plan
+  if best.getSeconds() >= fullPlan().getSeconds():
+    return fullPlan()
+  return best
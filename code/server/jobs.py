@@ -0,0 +1,357 @@
+import collections
+import concurrent.futures
+import functools
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+import bbcs
+import layouts
+import prewarm
+import scheduler
+from clientmanager import PRIORITY_NORMAL, QueueFullException, joinChunks
+
+# Render jobs.  A control plane request that asks for a job is answered with
+# 202 and a job id straight away and the layout is rendered in a pool of
+# worker processes, so renders do not fight each other, or the device
+# requests, for the GIL.  When a render finishes its drawings are queued for
+# the boards just as the request would have queued them and the job records
+# the drawing ids.
+#
+# Requests that render before they answer use the same pool to render the
+# elements of their layout at once, see renderParallel.  Everything goes
+# through a scheduler.FairScheduler so that the boards share the pool fairly,
+# and the workers run at a lower priority than the server so that the device
+# requests are answered promptly however much is being rendered.
+#
+# The workers are started with spawn rather than fork since the server has
+# threads of its own (the write-ahead log, the evictor) by the time the
+# first job comes in.
+
+# How many finished jobs are remembered for /jobStatus.
+MAX_FINISHED_JOBS = 1000
+
+# How much lower the priority of the workers is than the server's.
+DEFAULT_NICENESS = 10
+
+_workerBbcs = None
+_prewarmer = None
+
+def _watchParent(parentPid):
+  # The workers keep both ends of the pool's queues open, so they would not
+  # notice the server going if it were killed.
+  while os.getppid() == parentPid:
+    time.sleep(1)
+  os._exit(0)
+
+def _initWorker(parentPid, prewarmCaches, niceness):
+  global _workerBbcs, _prewarmer
+  if niceness:
+    os.nice(niceness)
+  _workerBbcs = bbcs.Bbcs()
+  threading.Thread(target=_watchParent, args=(parentPid,), name="watchParent",
+      daemon=True).start()
+  # The server leaves OpenCV and freetype until a render needs them, a worker
+  # is only there to render so it loads them straight away, at its lower
+  # priority.
+  layouts.loadModules()
+  if prewarmCaches:
+    # Every worker has caches of its own to fill.
+    _prewarmer = prewarm.Prewarmer(_workerBbcs)
+    _prewarmer.run()
+
+def getWorkerStatus():
+  # Runs in a worker process.  How the prewarm of its caches went and what
+  # is in them now.
+  return {
+      "workerPid": os.getpid(),
+      "prewarm": None if _prewarmer is None else _prewarmer.getStatus(),
+      }
+
+def renderLayout(name, kwargs):
+  # Runs in a worker process.  Renders every drawing of the layout and
+  # reports where and how long it took.
+  startedMs = round(time.time() * 1000)
+  start = time.time()
+  cpuStart = time.process_time()
+  drawings = [joinChunks(d) for d in layouts.render(_workerBbcs, name,
+      layouts.LAYOUTS[name](**kwargs))]
+  return {
+      "drawings": drawings,
+      "workerPid": os.getpid(),
+      "startedMs": startedMs,
+      "renderSeconds": time.time() - start,
+      "cpuSeconds": time.process_time() - cpuStart,
+      }
+
+def getSchedulerKey(clientId):
+  # The renders for a group of boards are scheduled as one client.
+  if isinstance(clientId, list):
+    return ",".join(clientId)
+  return clientId
+
+def cancelAll(futures):
+  for elementFutures in futures:
+    for (elementName, future) in elementFutures:
+      future.cancel()
+
+def renderElement(element):
+  # Runs in a worker process.
+  return layouts.renderElement(_workerBbcs, element)
+
+
+class Job(object):
+  def __init__(self, jobId, layout, clientId, supersedeKey, priority, notBeforeMs,
+      onEnqueued):
+    self.jobId = jobId
+    self.layout = layout
+    self.clientId = clientId
+    self.supersedeKey = supersedeKey
+    self.priority = priority
+    self.notBeforeMs = notBeforeMs
+    self.onEnqueued = onEnqueued
+    self.future = None
+    self.state = "queued"
+    self.submittedMs = round(time.time() * 1000)
+    self.startedMs = None
+    self.finishedMs = None
+    self.renderSeconds = None
+    self.cpuSeconds = None
+    self.workerPid = None
+    self.drawingIds = []
+    self.error = None
+
+  def isFinished(self):
+    return self.state in ("done", "failed")
+
+  def getStatus(self):
+    state = self.state
+    if state == "queued" and self.future is not None and self.future.running():
+      state = "running"
+    queueSeconds = None
+    if self.startedMs is not None:
+      queueSeconds = round((self.startedMs - self.submittedMs) / 1000, 3)
+    return {
+        "jobId": self.jobId,
+        "layout": self.layout,
+        "clientId": self.clientId,
+        "state": state,
+        "submittedMs": self.submittedMs,
+        "startedMs": self.startedMs,
+        "finishedMs": self.finishedMs,
+        "queueSeconds": queueSeconds,
+        "renderSeconds": None if self.renderSeconds is None else round(self.renderSeconds, 3),
+        "cpuSeconds": None if self.cpuSeconds is None else round(self.cpuSeconds, 3),
+        "workerPid": self.workerPid,
+        "drawingIds": self.drawingIds,
+        "error": self.error,
+        }
+
+
+class JobManager(object):
+  def __init__(self, clientManager, processes=None, prewarmCaches=False,
+      niceness=DEFAULT_NICENESS, maxRunningPerClient=scheduler.DEFAULT_MAX_RUNNING,
+      maxQueuedPerClient=scheduler.DEFAULT_MAX_QUEUED, weights=None):
+    self.clientManager = clientManager
+    self.processes = processes or os.cpu_count()
+    self.prewarmCaches = prewarmCaches
+    self.niceness = niceness
+    self.lock = threading.Lock()
+    self.executorLock = threading.Lock()
+    self.executor = None
+    self.scheduler = scheduler.FairScheduler(self._getExecutor, self.processes,
+        maxRunningPerClient, maxQueuedPerClient, weights)
+    self.jobIds = itertools.count(1)
+    self.jobs = collections.OrderedDict()
+    # workerPid -> what that worker has rendered.
+    self.workers = {}
+    # workerPid -> the last getWorkerStatus of that worker.
+    self.workerStatus = {}
+    self.submitted = 0
+    self.failed = 0
+
+  def _getExecutor(self):
+    # The pool is only started by the first render so that a worker process
+    # that is about to be forked has none.
+    with self.executorLock:
+      if self.executor is None:
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.processes,
+            mp_context=multiprocessing.get_context("spawn"), initializer=_initWorker,
+            initargs=(os.getpid(), self.prewarmCaches, self.niceness))
+      return self.executor
+
+  def start(self):
+    # Start every worker now rather than when the first render needs it.
+    self._askWorkerStatus()
+
+  def _askWorkerStatus(self):
+    # One getWorkerStatus per process.  Whichever workers are free answer, so
+    # a worker that is busy, or that another answered for, is caught next
+    # time.
+    executor = self._getExecutor()
+    for i in range(self.processes):
+      executor.submit(getWorkerStatus).add_done_callback(self._gotWorkerStatus)
+
+  def _gotWorkerStatus(self, future):
+    if future.cancelled() or future.exception() is not None:
+      return
+    status = future.result()
+    with self.lock:
+      self.workerStatus[status["workerPid"]] = status
+
+  def getPrewarmStatus(self):
+    # The prewarm of every worker that has reported, None without --prewarm.
+    # The workers are asked again each time, so this is as of the last call.
+    if not self.prewarmCaches:
+      return None
+    if self.executor is not None:
+      self._askWorkerStatus()
+    with self.lock:
+      return {str(pid): status["prewarm"] for (pid, status) in self.workerStatus.items()}
+
+  def renderParallel(self, name, drawings, clientId):
+    # layouts.render with every element of the layout rendered at once in
+    # the workers.  The drawings are still yielded in order and each element
+    # as soon as it, and those before it, are done.
+    start = time.time()
+    key = getSchedulerKey(clientId)
+    futures = []
+    try:
+      for elements in drawings:
+        futures.append([(element.name, self.scheduler.submit(key, renderElement, element))
+            for element in elements])
+    except BaseException:
+      cancelAll(futures)
+      raise
+    elementSeconds = {}
+
+    def renderDrawing(elementFutures):
+      for (elementName, future) in elementFutures:
+        (commands, seconds) = future.result()
+        elementSeconds[elementName] = seconds
+        yield commands
+
+    try:
+      for elementFutures in futures:
+        yield renderDrawing(elementFutures)
+    finally:
+      cancelAll(futures)
+    if len(elementSeconds):
+      layouts.recordRender(name, time.time() - start, elementSeconds)
+
+  def submit(self, layout, clientId, kwargs, supersedeKey=None, priority=PRIORITY_NORMAL,
+      notBeforeMs=None, onEnqueued=None):
+    # Queue a render of one of layouts.LAYOUTS for clientId, a board or a
+    # list of them.  onEnqueued is called with the client once the drawings
+    # are queued.
+    if not layout in layouts.LAYOUTS:
+      raise ValueError("Unknown layout {}".format(layout))
+    with self.lock:
+      job = Job(next(self.jobIds), layout, clientId, supersedeKey, priority, notBeforeMs,
+          onEnqueued)
+    job.future = self.scheduler.submit(getSchedulerKey(clientId), renderLayout, layout, kwargs)
+    with self.lock:
+      self.jobs[job.jobId] = job
+      self.submitted += 1
+      self._forgetFinished()
+    logging.info("submit - queued a job; jobId: %d, layout: %s, clientId: %s", job.jobId,
+        layout, clientId)
+    job.future.add_done_callback(functools.partial(self._finished, job))
+    return job
+
+  def _forgetFinished(self):
+    finished = [j for j in self.jobs.values() if j.isFinished()]
+    for j in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+      del self.jobs[j.jobId]
+
+  def _getClient(self, job):
+    if isinstance(job.clientId, list):
+      clients = [self.clientManager.getOrMakeClient(i) for i in job.clientId]
+      c = self.clientManager.getClientGroup(job.clientId)
+    else:
+      clients = [self.clientManager.getOrMakeClient(job.clientId)]
+      c = clients[0]
+    if job.supersedeKey:
+      for i in clients:
+        i.supersede(job.supersedeKey)
+    return c
+
+  def _enqueue(self, job, drawings):
+    # Queue the drawings the way MyHandler.addDrawing does: one session for
+    # the lot, or one scheduled drawing each when they are held back.
+    c = self._getClient(job)
+    if job.notBeforeMs is not None:
+      drawingIds = [c.addNewDrawing(d, job.supersedeKey, job.priority, job.notBeforeMs)
+          for d in drawings]
+    else:
+      stream = c.openStream(job.priority)
+      try:
+        drawingIds = [stream.addDrawing(d, job.supersedeKey) for d in drawings]
+      except BaseException:
+        stream.abort()
+        raise
+      stream.close()
+    self.clientManager.log.waitDurable()
+    if job.onEnqueued is not None:
+      job.onEnqueued(c)
+    return drawingIds
+
+  def _finished(self, job, future):
+    try:
+      result = future.result()
+      job.startedMs = result["startedMs"]
+      job.renderSeconds = result["renderSeconds"]
+      job.cpuSeconds = result["cpuSeconds"]
+      job.workerPid = result["workerPid"]
+      with self.lock:
+        worker = self.workers.setdefault(job.workerPid,
+            {"jobs": 0, "renderSeconds": 0.0, "cpuSeconds": 0.0})
+        worker["jobs"] += 1
+        worker["renderSeconds"] += job.renderSeconds
+        worker["cpuSeconds"] += job.cpuSeconds
+      job.drawingIds = self._enqueue(job, result["drawings"])
+      job.state = "done"
+    except QueueFullException as e:
+      job.error = "queue full: {}".format(str(e))
+      job.state = "failed"
+    except BaseException as e:
+      logging.exception("_finished - job failed; jobId: %d", job.jobId)
+      job.error = str(e) or type(e).__name__
+      job.state = "failed"
+    job.finishedMs = round(time.time() * 1000)
+    if job.state == "failed":
+      with self.lock:
+        self.failed += 1
+    logging.info("_finished - job finished; jobId: %d, state: %s, drawingIds: %s, "
+        "renderSeconds: %s, cpuSeconds: %s", job.jobId, job.state, job.drawingIds,
+        job.renderSeconds, job.cpuSeconds)
+
+  def getJob(self, jobId):
+    with self.lock:
+      return self.jobs.get(jobId)
+
+  def getStats(self):
+    with self.lock:
+      jobs = list(self.jobs.values())
+      workers = {str(pid): {"jobs": w["jobs"], "renderSeconds": round(w["renderSeconds"], 3),
+          "cpuSeconds": round(w["cpuSeconds"], 3)} for (pid, w) in self.workers.items()}
+      states = collections.Counter([j.getStatus()["state"] for j in jobs])
+      result = {
+          "processes": self.processes,
+          "started": self.executor is not None,
+          "submitted": self.submitted,
+          "failed": self.failed,
+          "queued": states["queued"],
+          "running": states["running"],
+          "workers": workers,
+          }
+    result["scheduler"] = self.scheduler.getStatus()
+    return result
+
+  def shutdown(self):
+    self.scheduler.shutdown()
+    if self.executor is not None:
+      self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,358 @@
+import logging
+import os.path
+import threading
+import time
+
+import bbshape
+import lazy
+from clientmanager import joinChunks
+
+from constants import MAX_HEIGHT, MAX_WIDTH
+
+# Only the draw functions need these, see lazy.py.
+bbfilledtext = lazy.LazyModule("bbfilledtext")
+bbimage = lazy.LazyModule("bbimage")
+bbinversetextbox = lazy.LazyModule("bbinversetextbox")
+bbtext = lazy.LazyModule("bbtext")
+cv2 = lazy.LazyModule("cv2")
+
+def loadModules():
+  # Import everything the layouts draw with now rather than in the first
+  # render.
+  for m in [bbfilledtext, bbimage, bbinversetextbox, bbtext, cv2]:
+    lazy.load(m)
+
+# The layouts drawn by the control plane requests.  A layout is a list of
+# drawings, in the order they are queued, and every drawing is a list of
+# Elements, named uniquely within the layout, whose commands are joined in
+# order.  Elements do not depend on each other so they can be rendered one
+# after another with render(), which streams each one as it is produced, or
+# all at once in the worker processes of jobs.JobManager.renderParallel.
+# Either way the commands come out the same.
+
+FONT_DIR = os.path.join(os.path.dirname(__file__), 'fonts')
+
+class Element(object):
+  # One piece of a layout.  draw is a module level function, so that the
+  # element can be sent to a worker process, and draw(bbcs, *args) returns
+  # the commands or an iterable of chunks of them.
+  def __init__(self, name, draw, *args):
+    self.name = name
+    self.draw = draw
+    self.args = args
+
+  def render(self, bbcs):
+    return self.draw(bbcs, *self.args)
+
+# Timings of the layouts rendered by this process, see recordRender.
+_statsLock = threading.Lock()
+_stats = {}
+
+def recordRender(name, seconds, elementSeconds):
+  # seconds is how long the whole layout took and elementSeconds maps each
+  # element to the CPU time it took.  The speedup is how much faster the
+  # layout was than its elements one after another, which is a little
+  # flattering where rendering waits on something other than the CPU.
+  (slowest, slowestSeconds) = max(elementSeconds.items(), key=lambda i: i[1])
+  speedup = sum(elementSeconds.values()) / max(seconds, 1e-6)
+  logging.info("recordRender - rendered a layout; name: %s, seconds: %.3f, speedup: %.2f, "
+      "slowest: %s, slowestSeconds: %.3f", name, seconds, speedup, slowest, slowestSeconds)
+  with _statsLock:
+    stats = _stats.setdefault(name, {"renders": 0, "totalSpeedup": 0.0})
+    stats["renders"] += 1
+    stats["totalSpeedup"] += speedup
+    stats["last"] = {
+        "seconds": round(seconds, 3),
+        "elementSeconds": round(sum(elementSeconds.values()), 3),
+        "speedup": round(speedup, 2),
+        "slowest": slowest,
+        "slowestSeconds": round(slowestSeconds, 3),
+        }
+
+def getStats():
+  with _statsLock:
+    return {name: {
+        "renders": s["renders"],
+        "meanSpeedup": round(s["totalSpeedup"] / s["renders"], 2),
+        "last": s["last"],
+        } for (name, s) in _stats.items()}
+
+def render(bbcs, name, drawings):
+  # Render the elements one after another in this thread.  Yields each
+  # drawing as an iterable of chunks that are rendered as they are asked for.
+  start = time.time()
+  elementSeconds = {}
+
+  def renderDrawing(elements):
+    for element in elements:
+      # CPU time of this thread, so that queueing the chunks as they are
+      # yielded is counted but other requests are not.
+      elementStart = time.thread_time()
+      result = element.render(bbcs)
+      if isinstance(result, (bytes, bytearray, str)):
+        yield result
+      else:
+        yield from result
+      elementSeconds[element.name] = time.thread_time() - elementStart
+
+  for elements in drawings:
+    yield renderDrawing(elements)
+  if len(elementSeconds):
+    recordRender(name, time.time() - start, elementSeconds)
+
+def renderElement(bbcs, element):
+  # Render an element completely, returning the commands and the CPU time
+  # it took.
+  start = time.thread_time()
+  commands = joinChunks(element.render(bbcs))
+  return (commands, time.thread_time() - start)
+
+# --------
+# Elements
+# --------
+
+def drawVLine(bbcs, height, x, y):
+  l = bbshape.VLine(bbcs)
+  l.setHeight(height)
+  l.gen()
+  return l.getDrawString(x, y)
+
+def drawText(bbcs, font, size, s, position, boxed=False, sizeBetweenCharacters=-1,
+    spaceSize=-1):
+  # position is (x, y) or (x, y, width, height) to center the text in a box.
+  t = bbtext.Text(bbcs)
+  t.setFontCharacteristics(font, size, sizeBetweenCharacters, spaceSize)
+  t.setString(s)
+  t.setBoxed(boxed)
+  t.gen()
+  return t.getDrawString(position)
+
+def drawCenteredText(bbcs, s, x, y, fontFace, size):
+  # Centered on the board along x and y when they are 0.
+  t = bbtext.Text(bbcs)
+  t.setFontCharacteristics(fontFace, size)
+  t.setString(s)
+  t.gen()
+
+  (w, h) = t.getDimensions()
+
+  if y == 0:
+    y = int((MAX_HEIGHT - h) / 2)
+  if x == 0:
+    x = int((MAX_WIDTH - w) / 2)
+
+  return t.getDrawString((x, y))
+
+def drawImage(bbcs, filename, scaleFactor, x, y):
+  i = bbimage.Image(bbcs)
+  i.setImageCharacteristics(scaleFactor)
+  i.genFromFile(filename)
+  return i.getDrawChunks(x, y)
+
+def drawCenteredImage(bbcs, filename, scaleFactor, x, y):
+  # Centered on the board along x and y when they are 0.
+  i = bbimage.Image(bbcs)
+  i.setImageCharacteristics(scaleFactor)
+  i.genFromFile(filename)
+
+  (w, h) = i.getDimensions()
+
+  if y == 0:
+    y = MAX_HEIGHT - int((MAX_HEIGHT - h)/2)
+  if x == 0:
+    x = int((MAX_WIDTH - w) / 2)
+
+  logging.debug("drawCenteredImage - getting string; w: %d, h: %d, x: %d, y: %d",
+      w, h, x, y)
+
+  return i.getDrawChunks(x, y)
+
+def drawSlotIcon(bbcs, iconFilename, x, y):
+  # An icon sitting on y, or a question mark when there is no such icon.
+  i = bbimage.Image(bbcs)
+  i.setImageCharacteristics(1)
+  foundFile = i.genFromFile("imgs/{}".format(iconFilename))
+
+  if not foundFile:
+    logging.info("drawSlotIcon - could not find iconFilename, falling back to question")
+    i.genFromFile("imgs/w/question.png")
+
+  (w, h) = i.getDimensions()
+  return i.getDrawChunks(x, y+h)
+
+def drawDateBox(bbcs, dayOfMonth, width, height, x, y):
+  t = bbinversetextbox.InverseTextBox(bbcs, width, height)
+  t.setRoundedRectangle(True)
+  t.setString(dayOfMonth)
+  t.gen()
+  return t.getDrawChunks(x, y)
+
+def drawCurrentTemperature(bbcs, time, temperature, width, height, x, y):
+  # The temperature filled in and boxed followed by the little circle for
+  # the degrees, which goes wherever the text ended up.
+  t = bbfilledtext.FilledText(bbcs, width, height)
+  t.setBoxed(True)
+  t.setFontCharacteristics(cv2.FONT_HERSHEY_SIMPLEX, 10, 25)
+  t.setString(time + " - " + temperature)
+  t.gen()
+  yield from t.getDrawChunks(x, y)
+
+  logging.info("drawCurrentTemperature - going to draw the circle; t.getDimensions: %s",
+      t.getDimensions())
+
+  circle = bbshape.Circle(bbcs)
+  circle.setRadius(20)
+  circle.gen()
+  yield circle.getDrawString(
+      x + t.getTextLowerLeftX() + t.getDimensions()[0],
+      (y - height) + (t.getDimensions()[1] + 95))
+
+def drawSlotTemperature(bbcs, temperature, x, y):
+  # "- temperature" and the little circle for the degrees after it.
+  t = bbtext.Text(bbcs)
+  t.setFontCharacteristics(os.path.join(FONT_DIR, 'cnc_v.ttf'), size=164, sizeBetweenCharacters=30, spaceSize=15)
+  t.setString("- " + temperature)
+  t.setBoxed(False)
+  t.gen()
+  result = t.getDrawString((x, y))
+
+  circle = bbshape.Circle(bbcs)
+  circle.setRadius(15)
+  circle.gen()
+  result += circle.getDrawString(
+      t.getTextLowerLeftX() + t.getTextDimensions()[0],
+      (y + t.getTextDimensions()[1]))
+  return result
+
+# -------
+# Layouts
+# -------
+
+def image(filename, scaleFactor, x, y):
+  return [[Element("image", drawCenteredImage, filename, scaleFactor, x, y)]]
+
+def text(s, x, y, fontFace, size):
+  return [[Element("text", drawCenteredText, s, x, y, fontFace, size)]]
+
+# weatherStartOfDay is a different type of weather view from the normal
+# 'weather' layout.  In this one at the start of the day a call to clear the
+# board is made and then a call to here is made.  This outlines the weather
+# information available at the start of the day.  As the day progresses then
+# the additional datapoints, however many there are, are added to the same
+# board without clearing the screen, see weatherInfoSlotted.
+def weatherStartOfDay(dayOfWeek, dayOfMonth, time, temperature,
+    minTemperature, maxTemperature, description, iconFilename):
+  # The display is setup in two regions
+  #
+  # +----------------------------------------------------------------------------------+
+  # |    Weds     |                          Time 1 - Temperature  X                   |
+  # |             |                          Time 2 - Temperature  Y                   |
+  # |    DAY      |                                                                    |
+  # |  Of MONTH   |                                                                    |
+  # |             |                                                                    |
+  # |  Min/Max    |                                                                    |
+  # |   Temp      |                                                                    |
+  # +----------------------------------------------------------------------------------+
+  #        middleColumnLeft
+  middleColumnLeft = 1000
+
+  return [
+      # The vertical line separating the regions
+      [Element("separator", drawVLine, 1000, middleColumnLeft, 50)],
+
+      # Left region: the day of the week (e.g., "Wed"), the date and the
+      # estimated range of min and max temperature.  This isn't super
+      # accurate but Kathi likes to see it.
+      [Element("dayOfWeek", drawText, os.path.join(FONT_DIR, 'Exo2-Bold.otf'), 256,
+          dayOfWeek, (200, 850, 700, 250))],
+      [Element("dayOfMonth", drawDateBox, dayOfMonth, 700, 500, 210, 300 + 500)],
+      [Element("minMax", drawText, os.path.join(FONT_DIR, 'cnc_v.ttf'), 128,
+          minTemperature + " / " + maxTemperature, (225, 80, 700, 120), False, 20, 35)],
+
+      # Right region
+      weatherInfoSlotted(slot=0, x=middleColumnLeft, time=time, temperature=temperature,
+          description=description, iconFilename=iconFilename),
+      ]
+
+def weatherInfoSlotted(x, slot, time, temperature, description, iconFilename):
+  # A single 'row' in the slotted information as the day progresses.  It is
+  # one drawing that looks like this:
+  #
+  # +----------------------------------------------------------------------------------+
+  # | Hour | am/pm |  Temperature  | Image | Description (roughly 12 characters)       |
+  # +----------------------------------------------------------------------------------+
+  #
+  hourLeft = x + 100
+  ampmLeft = x + 350
+  temperatureLeft = x + 600
+  imageLeft = x + 1010
+  descriptionLeft = x + 1255
+
+  height = 150
+  y = 950 - (slot * 200)
+
+  hour = time[0:2]
+  ampmString = time[-2:]
+
+  logging.info( "weatherInfoSlotted - going to draw text; x: {x}, y: {y}, slot: {slot}, height: {height}, time: {time}, hour: {hour}, ampmp: {ampmString}, temperature: {temp}, description: {d}".format(x=x, y=y, slot=slot, height=height, time=time, hour=hour, ampmString=ampmString, temp=temperature, d=description))
+
+  font = os.path.join(FONT_DIR, 'cnc_v.ttf')
+  return [
+      Element("hour", drawText, font, 164, hour, (hourLeft, y), False, 30, 45),
+      Element("ampm", drawText, font, 164, ampmString, (ampmLeft, y), False, 30, 45),
+      Element("temperature", drawSlotTemperature, temperature, temperatureLeft, y),
+      Element("icon", drawSlotIcon, iconFilename, imageLeft, y),
+      Element("description", drawText, font, 164, description, (descriptionLeft, y), False,
+          30, 15),
+      ]
+
+def weatherCurrent(time, temperature, minTemperature, maxTemperature, description):
+  # The right hand side of the weather view, as one drawing.
+  rhsX = 1275
+  rhsFullWidth = 2175
+
+  return [
+      # Seperator for the date from the weather
+      Element("separator", drawVLine, 900, 1150, 100),
+      Element("temperature", drawCurrentTemperature, time, temperature, rhsFullWidth, 375,
+          rhsX, 950),
+      Element("minMax", drawText, os.path.join(FONT_DIR, 'Exo2-Bold.otf'), 150,
+          minTemperature + " / " + maxTemperature, (rhsX + 600, 350)),
+      Element("description", drawText, os.path.join(FONT_DIR, 'Exo2-Bold.otf'), 164,
+          description, (rhsX + 600, 90)),
+      ]
+
+def weather(dayOfWeek, dayOfMonth, time, temperature,
+    minTemperature, maxTemperature, description, conditionString):
+  rhsX = 1275
+
+  iconFile = None
+  if conditionString == "SUNNY":
+    iconFile = "imgs/sunny.png"
+  elif conditionString == "CLOUDY":
+    iconFile = "imgs/cloudy.png"
+  elif conditionString == "SNOW":
+    iconFile = "imgs/snow.png"
+  elif conditionString == "RAIN":
+    iconFile = "imgs/rain.png"
+  else:
+    logging.info("weather - unknown condition string; conditionString: %s",
+        conditionString)
+    iconFile = "imgs/question.png"
+
+  return [
+      weatherCurrent(time, temperature, minTemperature, maxTemperature, description),
+      [Element("icon", drawImage, iconFile, 2, rhsX + 50, 490)],
+      [Element("dayOfWeek", drawText, os.path.join(FONT_DIR, 'Exo2-Bold.otf'), 256,
+          dayOfWeek, (250, 800, 700, 250))],
+      # Generate date component of the display
+      [Element("dayOfMonth", drawDateBox, dayOfMonth, 700, 500, 275, 140 + 500)],
+      ]
+
+# The layouts that requests can ask for, by name.
+LAYOUTS = {
+    "image": image,
+    "text": text,
+    "weather": weather,
+    "weatherStartOfDay": weatherStartOfDay,
+    }
@@ -0,0 +1,31 @@
+import importlib
+import sys
+
+# Stand-ins for the modules that are slow to import, OpenCV and freetype
+# above all, so that the server is answering the boards before they have
+# loaded.  A LazyModule imports its module the first time one of its
+# attributes is used, after that it is just a slightly slower way to the
+# module.  Only the modules that render need them, the queues and the device
+# requests never do.
+
+# The modules that are worth putting off, for getLoaded.
+HEAVY_MODULES = ["cv2", "numpy", "freetype"]
+
+class LazyModule(object):
+  def __init__(self, name):
+    self._name = name
+    self._module = None
+
+  def __getattr__(self, attr):
+    return getattr(load(self), attr)
+
+def load(lazyModule):
+  # Import the module now, if it has not been already, and return it.
+  # import_module takes the import lock, so threads racing to load it all
+  # get the one module.
+  if lazyModule._module is None:
+    lazyModule._module = importlib.import_module(lazyModule._name)
+  return lazyModule._module
+
+def getLoaded():
+  return [name for name in HEAVY_MODULES if name in sys.modules]
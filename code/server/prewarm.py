@@ -0,0 +1,115 @@
+import calendar
+import glob
+import importlib.util
+import logging
+import os.path
+import time
+
+import lazy
+
+bbimage = lazy.LazyModule("bbimage")
+bbtext = lazy.LazyModule("bbtext")
+
+# The first weather update after a restart would otherwise pay for loading
+# the freetype faces, pulling out every glyph and vectorizing the icons while
+# the board sits waiting.  The Prewarmer does that work in each rendering
+# process as it starts, see jobs._initWorker, so that the caches in bbtext and
+# bbimage are already full.  The server process itself only renders for the
+# walls and is left alone, it has no need of OpenCV or freetype until then.
+
+FONT_DIR = os.path.join(os.path.dirname(__file__), 'fonts')
+
+# (font, size) pairs used by the weather layouts in layouts.py.
+WEATHER_FONTS = [
+    (os.path.join(FONT_DIR, 'Exo2-Bold.otf'), 150),
+    (os.path.join(FONT_DIR, 'Exo2-Bold.otf'), 164),
+    (os.path.join(FONT_DIR, 'Exo2-Bold.otf'), 256),
+    (os.path.join(FONT_DIR, 'cnc_v.ttf'), 128),
+    (os.path.join(FONT_DIR, 'cnc_v.ttf'), 164),
+    ]
+
+# Icons used by the addWeather condition strings and the fallbacks.
+WEATHER_ICONS = [
+    "imgs/sunny.png",
+    "imgs/cloudy.png",
+    "imgs/snow.png",
+    "imgs/rain.png",
+    "imgs/w/question.png",
+    ]
+
+OPENWEATHER_FILENAME = os.path.join(os.path.dirname(__file__), '..',
+    'weatherClient', 'openweather.py')
+
+def weatherStrings():
+  result = [str(d) for d in range(10)]
+  result += ["AM", "PM", " / ", "- "]
+  for d in calendar.day_abbr:
+    result.append(d.upper())
+    result.append(d)
+  return result
+
+def weatherIcons():
+  # The weather client maps every OpenWeather condition to one of the icons
+  # under imgs/.  Use its table when it is available alongside the server and
+  # otherwise fall back to everything in imgs/w.
+  result = list(WEATHER_ICONS)
+  try:
+    spec = importlib.util.spec_from_file_location("openweather", OPENWEATHER_FILENAME)
+    openweather = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(openweather)
+    filenames = [w.icon_filename for w in openweather.allWeatherTypes]
+  except Exception as e:
+    logging.info("weatherIcons - unable to load openweather, using imgs/w; e: %s", str(e))
+    filenames = [os.path.relpath(f, os.path.join(os.path.dirname(__file__), 'imgs'))
+        for f in glob.glob(os.path.join(os.path.dirname(__file__), 'imgs', 'w', '*.png'))]
+
+  for f in filenames:
+    f = "imgs/{}".format(f)
+    if not f in result:
+      result.append(f)
+  return result
+
+
+class Prewarmer(object):
+  def __init__(self, bbcs):
+    self.bbcs = bbcs
+    self.state = "idle"
+    self.startedMs = None
+    self.durationMs = None
+    self.error = None
+
+  def run(self):
+    self.state = "running"
+    self.startedMs = round(time.time() * 1000)
+    start = time.time()
+    try:
+      for (font, size) in WEATHER_FONTS:
+        t = bbtext.Text(self.bbcs)
+        t.setFontCharacteristics(font, size)
+        for s in weatherStrings():
+          t.setString(s)
+          t.gen()
+
+      for f in weatherIcons():
+        i = bbimage.Image(self.bbcs)
+        i.genFromFile(f)
+
+      self.state = "done"
+    except Exception as e:
+      logging.exception("run - prewarm failed;")
+      self.state = "failed"
+      self.error = str(e)
+
+    self.durationMs = round((time.time() - start) * 1000)
+    logging.info("run - prewarm finished; state: %s, durationMs: %d", self.state,
+        self.durationMs)
+
+  def getStatus(self):
+    return {
+        "state": self.state,
+        "startedMs": self.startedMs,
+        "durationMs": self.durationMs,
+        "error": self.error,
+        "text": bbtext.getCacheStats(),
+        "images": bbimage.getCacheStats(),
+        }
@@ -0,0 +1,212 @@
+import collections
+import concurrent.futures
+import functools
+import threading
+import time
+
+# Weighted fair scheduling of render work.  Renders are queued per client and
+# only handed to the worker pool when a worker is free, so the pool's own
+# first come first served queue never builds up.  The next render always comes
+# from the client that has had the least render time, divided by its weight,
+# of those with work waiting.  A client that was idle starts level with those
+# that are busy rather than with credit for the time it was idle, and no client may
+# have more than maxRunning renders in flight, so one board queueing a pile of
+# big images waits on itself and not on the others.
+#
+# The results are handed back on a thread pool of the scheduler's own rather
+# than on the executor's thread, since whoever is waiting on a render may do
+# a lot with it (queue the drawings and wait for the log, for a job) and the
+# executor delivers every result on the one thread.  A client's queue, and
+# what it says about the client's renders, is kept until the client has had
+# nothing to render for IDLE_SECONDS.
+
+DEFAULT_MAX_RUNNING = 2
+DEFAULT_MAX_QUEUED = 256
+IDLE_SECONDS = 300
+
+class RenderBacklogException(Exception):
+  def __init__(self, key, queued):
+    super(RenderBacklogException, self).__init__(
+        "{} already has {} renders waiting".format(key, queued))
+    self.key = key
+
+
+class Task(object):
+  def __init__(self, fn, args):
+    self.fn = fn
+    self.args = args
+    self.future = concurrent.futures.Future()
+    self.queuedTime = time.time()
+
+
+class ClientQueue(object):
+  def __init__(self, key, weight):
+    self.key = key
+    self.weight = weight
+    self.tasks = collections.deque()
+    self.running = 0
+    # Render seconds used, divided by the weight.
+    self.vruntime = 0.0
+    self.rendered = 0
+    self.renderSeconds = 0.0
+    self.totalDelay = 0.0
+    self.maxDelay = 0.0
+    self.lastDelay = 0.0
+    # When the client last ran out of renders.
+    self.idleTime = None
+
+  def isActive(self):
+    return len(self.tasks) > 0 or self.running > 0
+
+  def getStatus(self):
+    return {
+        "weight": self.weight,
+        "queued": len(self.tasks),
+        "running": self.running,
+        "rendered": self.rendered,
+        "renderSeconds": round(self.renderSeconds, 3),
+        "meanDelayMs": round(self.totalDelay / max(1, self.rendered + self.running) * 1000, 1),
+        "maxDelayMs": round(self.maxDelay * 1000, 1),
+        "lastDelayMs": round(self.lastDelay * 1000, 1),
+        }
+
+
+class FairScheduler(object):
+  def __init__(self, getExecutor, slots, maxRunning=DEFAULT_MAX_RUNNING,
+      maxQueued=DEFAULT_MAX_QUEUED, weights=None):
+    # getExecutor returns the executor to run on and slots is how many tasks
+    # it runs at once.  weights maps a client key to its share, 1 otherwise.
+    self.getExecutor = getExecutor
+    self.slots = slots
+    self.maxRunning = maxRunning
+    self.maxQueued = maxQueued
+    self.weights = weights or {}
+    self.lock = threading.RLock()
+    self.queues = {}
+    self.running = 0
+    self.minVruntime = 0.0
+    self.completions = concurrent.futures.ThreadPoolExecutor(max_workers=slots,
+        thread_name_prefix="renderDone")
+
+  def submit(self, key, fn, *args):
+    # Queue fn(*args) for the client key and return a Future for its result.
+    # Raises RenderBacklogException when the client has too much waiting.
+    with self.lock:
+      q = self.queues.get(key)
+      if q is None:
+        q = ClientQueue(key, self.weights.get(key, 1))
+        self.queues[key] = q
+      if len(q.tasks) >= self.maxQueued:
+        raise RenderBacklogException(key, len(q.tasks))
+      if not q.isActive():
+        q.vruntime = max(q.vruntime, self.minVruntime)
+      task = Task(fn, args)
+      q.tasks.append(task)
+      q.idleTime = None
+      self._dispatch()
+    return task.future
+
+  def _dispatch(self):
+    while self.running < self.slots:
+      ready = [q for q in self.queues.values() if len(q.tasks) and q.running < self.maxRunning]
+      if len(ready) == 0:
+        return
+      q = min(ready, key=lambda q: (q.vruntime, q.key))
+      self.minVruntime = max(self.minVruntime, q.vruntime)
+      task = q.tasks.popleft()
+      if not task.future.set_running_or_notify_cancel():
+        continue
+
+      delay = time.time() - task.queuedTime
+      q.totalDelay += delay
+      q.maxDelay = max(q.maxDelay, delay)
+      q.lastDelay = delay
+      q.running += 1
+      self.running += 1
+      try:
+        f = self.getExecutor().submit(task.fn, *task.args)
+      except BaseException as e:
+        q.running -= 1
+        self.running -= 1
+        task.future.set_exception(e)
+        continue
+      f.add_done_callback(functools.partial(self._done, q, task, time.time()))
+
+  def _done(self, q, task, startTime, f):
+    # Called on the executor's thread, which is only held long enough to
+    # account for the render and start the next one.
+    seconds = time.time() - startTime
+    with self.lock:
+      q.running -= 1
+      self.running -= 1
+      q.rendered += 1
+      q.renderSeconds += seconds
+      q.vruntime += seconds / q.weight
+      if not q.isActive():
+        q.idleTime = time.time()
+      self._dispatch()
+      self._forgetIdle()
+
+    try:
+      self.completions.submit(self._complete, task, f)
+    except RuntimeError:
+      # The interpreter is on its way out.
+      self._complete(task, f)
+
+  def _complete(self, task, f):
+    # Pass the outcome of the render on to whoever asked for it, whatever it
+    # was, so that nobody is left waiting.
+    if f.cancelled():
+      task.future.set_exception(concurrent.futures.CancelledError())
+    elif f.exception() is not None:
+      task.future.set_exception(f.exception())
+    else:
+      task.future.set_result(f.result())
+
+  def _forgetIdle(self):
+    # A client that comes back after its queue has gone starts level with
+    # the busy ones, as it would have anyway.
+    now = time.time()
+    idle = []
+    for (key, q) in self.queues.items():
+      if q.isActive():
+        continue
+      if q.idleTime is None:
+        # Its renders were all cancelled.
+        q.idleTime = now
+      elif q.idleTime < now - IDLE_SECONDS:
+        idle.append(key)
+    for key in idle:
+      del self.queues[key]
+
+  def shutdown(self):
+    # Cancel the renders that have not been handed to the executor, the
+    # executor cancels its own.
+    with self.lock:
+      for q in self.queues.values():
+        while len(q.tasks):
+          q.tasks.popleft().future.cancel()
+
+  def getClientStatus(self, key):
+    with self.lock:
+      q = self.queues.get(key)
+      return q.getStatus() if q else None
+
+  def getStatus(self):
+    with self.lock:
+      return {
+          "slots": self.slots,
+          "running": self.running,
+          "queued": sum([len(q.tasks) for q in self.queues.values()]),
+          "maxRunningPerClient": self.maxRunning,
+          "clients": {key: q.getStatus() for (key, q) in self.queues.items()},
+          }
+
+def parseWeights(specs):
+  # ID=WEIGHT, a board or a comma separated list of them as the drawings of a
+  # group are scheduled together.
+  weights = {}
+  for spec in specs:
+    (key, weight) = spec.rsplit("=", 1)
+    weights[key] = float(weight)
+  return weights
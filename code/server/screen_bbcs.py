@@ -4,7 +4,7 @@ import struct
 import numpy as np
 import cv2
 
-from constants import MAX_HEIGHT, MAX_WIDTH
+from constants import ERASER_SIZE, MAX_HEIGHT, MAX_WIDTH
 
 # screen-bbcs = This is a screen rendering boardbot command set.
 # Instead of sending the commands to the board bot they are displayed.
@@ -73,6 +73,17 @@ class Bbcs(object):
       self.width, 3), np.uint8)
     return ""
 
+  def erasePath(self, points):
+    # Black out what the eraser passes over.
+    half = ERASER_SIZE // 2
+    for (start, end) in zip(points, points[1:]):
+      cv2.rectangle(
+          self.mat,
+          (self._scale(min(start[0], end[0]) - half), self._scale(MAX_HEIGHT - max(start[1], end[1]) - half)),
+          (self._scale(max(start[0], end[0]) + half), self._scale(MAX_HEIGHT - min(start[1], end[1]) + half)),
+          (0,0,0), -1)
+    return ""
+
   def _scale(self, value):
     return int(value * self.scaleFactor)
 
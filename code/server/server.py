@@ -17,41 +17,150 @@ except:
     from http.server import HTTPServer
 
 from functools import partial
+import hashlib
 import urllib.parse
 import threading
 import os.path
+import signal
 
 import bbcs
-import bbimage
-import bbinversetextbox
-import bbshape
-import freetype
-import bbtext
-import bbfilledtext
-import cv2
+import jobs
+import layouts
+import boardmodel
+import bbwall
+import eraseplan
+import lazy
+import scheduler
+import sharedstore
+import wal
+from clientmanager import ClientManager, NoWorkException, QueueFullException, parsePriority, joinChunks
+import clientmanager
 import socket
 
 import json
 
-from constants import MAX_HEIGHT, MAX_WIDTH
+
+# Only the wall requests need these, and only --asyncio needs asyncio, see
+# lazy.py.
+asyncserver = lazy.LazyModule("asyncserver")
+bbimage = lazy.LazyModule("bbimage")
+bbtext = lazy.LazyModule("bbtext")
 
 parser = argparse.ArgumentParser(description='Server for iBoardBot')
 parser.add_argument('--port', type=int, help='Port to listen on', default=80)
 parser.add_argument('--mockScreen', default=False, action = "store_true", help='Use a fake board')
-config = parser.parse_args()
-
-if config.mockScreen:
-  from screen_bbcs import Bbcs
-else:
-  from bbcs import Bbcs
-
-bbcs = Bbcs()
+parser.add_argument('--maxQueueBytes', type=int, default=clientmanager.DEFAULT_MAX_QUEUE_BYTES,
+    help='Maximum number of bytes that can be queued for a single board, 0 for no limit')
+parser.add_argument('--maxQueueBlocks', type=int, default=clientmanager.DEFAULT_MAX_QUEUE_BLOCKS,
+    help='Maximum number of blocks that can be queued for a single board, 0 for no limit')
+parser.add_argument('--clientTtl', type=int, default=clientmanager.DEFAULT_CLIENT_TTL_SECONDS,
+    help='Seconds a board with nothing queued may go without a request before it is moved to cold '
+    'storage, 0 to keep every board in memory')
+parser.add_argument('--noCoalesce', default=False, action = "store_true",
+    help='Do not merge drawings that are queued back to back into a single drawing session')
+parser.add_argument('--prewarm', default=False, action = "store_true",
+    help='Load the fonts, glyphs and icons used by the weather layouts in every rendering process as it starts')
+parser.add_argument('--boardGroup', default=[], action = "append",
+    help='A group of boards as NAME=ID1,ID2,...  Control plane requests with group=NAME draw on all of them. '
+    'May be given more than once')
+parser.add_argument('--wall', default=[], action = "append",
+    help='A wall of boards used as one large canvas as NAME=COLUMNSxROWS:ID1,ID2,... with the boards '
+    'listed row by row from the upper left.  May be given more than once')
+parser.add_argument('--walDir', default=None,
+    help='Directory for the write-ahead log that keeps the queues across restarts.  Without it the '
+    'queues are only held in memory')
+parser.add_argument('--walSegmentBytes', type=int, default=wal.DEFAULT_SEGMENT_BYTES,
+    help='Size at which the write-ahead log moves on to a new segment')
+parser.add_argument('--walCommitDelayMs', type=float, default=0,
+    help='How long the write-ahead log waits for more records before each fsync')
+parser.add_argument('--store', default=None,
+    help='SQLite database holding the boards and their queues, shared by every worker process')
+parser.add_argument('--workers', type=int, default=1,
+    help='Number of server processes accepting requests on the port.  More than one needs --store')
+parser.add_argument('--asyncio', default=False, action = "store_true",
+    help='Wait for device requests on an asyncio event loop rather than a thread per request')
+parser.add_argument('--keepAliveTimeout', type=float, default=15,
+    help='Seconds a persistent connection may sit idle between requests before it is closed')
+parser.add_argument('--asyncioThreads', type=int, default=4,
+    help='Threads rendering control plane requests with --asyncio')
+parser.add_argument('--jobProcesses', type=int, default=None,
+    help='Worker processes rendering the layouts of the control plane requests.  Defaults to the '
+    'number of CPUs, shared out between the --workers')
+parser.add_argument('--renderNice', type=int, default=jobs.DEFAULT_NICENESS,
+    help='How much lower the priority of the rendering processes is than the server')
+parser.add_argument('--maxRendersPerClient', type=int, default=scheduler.DEFAULT_MAX_RUNNING,
+    help='Most renders for one board, or group, that run at the same time')
+parser.add_argument('--maxQueuedRenders', type=int, default=scheduler.DEFAULT_MAX_QUEUED,
+    help='Most renders one board, or group, may have waiting before requests are refused')
+parser.add_argument('--renderWeight', default=[], action = "append",
+    help='The share of the rendering processes a board gets as ID=WEIGHT, 1 by default.  May be '
+    'given more than once')
+
+def parseConfig(argv=None):
+  # The options the server was started with, from sys.argv unless argv is
+  # given.
+  config = parser.parse_args(argv)
+  if config.workers > 1 and not config.store:
+    parser.error("--workers needs --store so that the processes can share the queues")
+  if config.store and config.walDir:
+    parser.error("--walDir is not needed with --store, the store keeps the queues")
+  if config.asyncio and config.store:
+    parser.error("--asyncio cannot be used with --store")
+  if config.workers > 1 and config.jobProcesses is None:
+    # Every worker has a rendering pool of its own.
+    config.jobProcesses = max(1, os.cpu_count() // config.workers)
+  if 0 < config.clientTtl < 60:
+    parser.error("--clientTtl must be 0 or at least 60 seconds, longer than any request holds a board")
+  return config
+
+def parseBoardGroups(specs):
+  groups = {}
+  for spec in specs:
+    (name, ids) = spec.split("=", 1)
+    groups[name] = [i for i in ids.split(",") if i]
+  return groups
+
+def parseWalls(specs):
+  walls = {}
+  for spec in specs:
+    wall = bbwall.parseWall(spec)
+    walls[wall.name] = wall
+  return walls
 
 DEVICE_URL_PREFIX = "/ibb-device/"
 CLIENT_ID = "ID_IWBB"
 
-# Return the primary IP address for this box.  
+# How long a device request waits for work before it is sent an empty result.
+DEVICE_WAIT_SECONDS = 10
+
+# Bounds on how long a /waitDrawing long poll is held open.
+DEFAULT_WAIT_DRAWING_SECONDS = 30
+MAX_WAIT_DRAWING_SECONDS = 300
+
+# How many strokes /boardState lists for a region unless asked for more.
+DEFAULT_MAX_STROKES = 100
+
+# The address of the box only changes when it moves network, so it is looked
+# up again at most this often rather than on every hit of the main menu.
+IP_CACHE_SECONDS = 300
+
+# Responses are collected in a buffer this big and sent with one write when
+# the request is done, rather than a write for the headers and another for
+# the body.
+WRITE_BUFFER_SIZE = 64 * 1024
+
+_ip = (0, None)
+
 def getIP():
+  global _ip
+  (expires, ip) = _ip
+  if ip is None or time.time() >= expires:
+    ip = lookupIP()
+    _ip = (time.time() + IP_CACHE_SECONDS, ip)
+  return ip
+
+# Return the primary IP address for this box.  
+def lookupIP():
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     try:
         # doesn't even have to be reachable
@@ -64,7 +173,7 @@ def getIP():
     return IP
 
 
-def mockDrawData(size = 0):
+def mockDrawData(bbcs, size = 0):
   if size == 0:
     result  = bbcs.liftPen()
     result += bbcs.moveTo(0,0)
@@ -86,166 +195,110 @@ def mockDrawData(size = 0):
   return result
 
 
-class NoWorkException(Exception):
-  pass
-
-class Client(object):
-
-  HEADER_COMMANDS_FOR_FIRST_PACKET = 4
-  SIZE_OF_COMMAND = 3
-  HEADER_COMMANDS_FOR_SUBSEQUENT_PACKET = 2
-
-  def __init__(self, clientId):
-    self.numberOfAccesses = 1
-    self.clientId = clientId
-    self.createdMs = round(time.time() * 1000)
-    self.lastAccessMs = round(time.time() * 1000)
-    self.lock = threading.Lock()
-    self.condition = threading.Condition()
-    self.queue = []
-    self.nextBlockNumber = 0
-    self.nextWeatherSlot = 0
-
-  def recordAccess(self):
-    self.numberOfAccesses += 1
-    self.lastAccessMs = round(time.time() * 1000)
-
-  def popQueueUntilBlockNumber(self, blockNumber):
-    logging.info("popQueueUntilBlockNumber - onEnter; blockNumber: %d", blockNumber)
-    numPopped = 0
-    with self.condition:
-      while len(self.queue):
-        logging.info("popQueueUntilBlockNumber - queue has more items; len: %d", len(self.queue))
-        (qBlockNumber, qItem) = self.queue[0]
-        logging.info("popQueueUntilBlockNumber - top of queue; qBlockNumber: %d", qBlockNumber)
-        if qBlockNumber <= blockNumber:
-          numPopped += 1
-          self.queue = self.queue[1:]
-        else:
-          break
-      logging.info("popQueueUntilBlockNumber - done with work; numPopped: %d, size of Queue remaining: %d", numPopped, len(self.queue))
-
-  def clearQueue(self):
-    with self.condition:
-      self.queue = []
+class BufferedResponse(object):
+  # The answer to a control plane request, held until the request has been
+  # handled and then sent in one write with its length.
+  def __init__(self, code, message):
+    self.code = code
+    self.message = message
+    self.headers = []
+    self.body = []
+    # Pages that only change when what they show does are sent with an
+    # ETag, so a caller that already has them gets a 304 instead.
+    self.cacheable = False
 
-  def addNewDrawing(self, payload):
-    # The data can be arbitrary size and we need to break it up into sizes at
-    # most 768 - HEADER_SIZE bytes long at a maximum that can be transferred in
-    # a single chunk.
 
-    # First add the footer to the payload
-    data = self._addFooterToData(payload)
-
-    numBlocks = 0;
-    headerSize = Client.HEADER_COMMANDS_FOR_FIRST_PACKET * Client.SIZE_OF_COMMAND
-    isFirst = True
-
-    with self.condition:
-      while len(data) > 0:
-        numBlocks+=1
-        dataSize = len(data)
-        if dataSize + headerSize > 768:
-          dataSize = 768 - headerSize
-
-        self._addNewBlock(isFirst, data[:dataSize])
-        data = data[dataSize:]
-
-        headerSize = Client.HEADER_COMMANDS_FOR_SUBSEQUENT_PACKET * Client.SIZE_OF_COMMAND
-        isFirst = False
-      self.condition.notify()
-
-    logging.info("addNewDrawing - done; numBlocks: %d", numBlocks)
-
-  def _addHeaderToData(self, isFirst, blockNumber, payload):
-    result  = bbcs.packetStart()
-    result += bbcs.blockIdentifier(blockNumber) 
-
-    if isFirst:
-      result += bbcs.startDrawing()
-      result += bbcs.liftPen()
-
-    result += payload
-    return result
-
-  def _addFooterToData(self, payload):
-    result  = payload 
-    result += bbcs.liftPen()
-    result += bbcs.moveTo(0,0)
-    result += bbcs.stopDrawing()
-    return result
-
-  def _addNewBlock(self, isFirst, data):
-    if len(self.queue) == 0:
-      self.nextBlockNumber = 0
-
-    self.nextBlockNumber += 1
-    data = self._addHeaderToData(isFirst, self.nextBlockNumber, data)
-
-    logging.info("addNewBlock - enqueue; nextBlockNumber: %d, size: %d, isFirst: %s", self.nextBlockNumber, len(data), str(isFirst))
-
-    entry = (self.nextBlockNumber, data)
-    self.queue.append(entry)
-
-  def getNextBlock(self, timeoutSeconds):
-    with self.condition:
-      while len(self.queue) == 0:
-        result = self.condition.wait(timeoutSeconds)
-        if result == False:
-          logging.info("getNextResult - no work available; timeoutSeconds: %d", timeoutSeconds)
-          raise NoWorkException()
-
-      (blockNumber, data) = self.queue[0]
-      logging.info("getNextBlock - found a block; blockNumber: %d", blockNumber)
-      return (blockNumber, data)
-
-  def getQueueSize(self):
-    with self.condition:
-      return len(self.queue)
-
-  def getNextWeatherSlot(self):
-      return self.nextWeatherSlot
-
-  def setNextWeatherSlot(self, slot):
-      self.nextWeatherSlot = slot
-
-
-class ClientManager(object):
-  def __init__(self):
-    self.clientDevices = {}
-
-  def getClientIds(self):
-    return self.clientDevices.keys()
-
-  def getOrMakeClient(self, clientId):
-    c = self.getClient(clientId)
-    if c is None:
-      logging.info("getOrMakeClient - creating new client; clientId: %s", clientId);
-      c = Client(clientId)
-      self.clientDevices[clientId] = c
-    return c
+class MyHandler(BaseHTTPRequestHandler):
+  # Connections are kept open between requests, unless the client asks
+  # otherwise as the boards do, so every response has to give its length.
+  protocol_version = "HTTP/1.1"
+  wbufsize = WRITE_BUFFER_SIZE
 
-  def getClient(self, clientId):
-    if clientId in self.clientDevices.keys():
-      c = self.clientDevices[clientId]
-      c.recordAccess()
-      return c
-    else:
-      return None
+  # A BufferedResponse while a control plane request is being handled, see
+  # flushResponse.  Device requests are written straight out.
+  response = None
 
+  # The App being served, set on the subclass that createApp makes.
+  app = None
 
-class MyHandler(BaseHTTPRequestHandler):
   def __init__(self, clientManager, *args, **kwargs):
     self.clientManager = clientManager
     super(MyHandler, self).__init__(*args, **kwargs)
 
   def sendText(self, s):
-    self.wfile.write(bytes(s,"utf-8"))
+    self.sendBytes(bytes(s,"utf-8"))
+
+  def sendBytes(self, b):
+    if self.response is not None:
+      self.response.body.append(b)
+    else:
+      self.wfile.write(b)
+
+  def startResponse(self):
+    self.response = BufferedResponse(None, None)
+
+  def send_response(self, code, message=None):
+    if self.response is None:
+      super(MyHandler, self).send_response(code, message)
+    else:
+      # Only the last answer is sent if a request gives more than one.
+      self.response = BufferedResponse(code, message)
+
+  def send_header(self, keyword, value):
+    if self.response is None:
+      super(MyHandler, self).send_header(keyword, value)
+    elif keyword.lower() != "content-length":
+      self.response.headers.append((keyword, value))
+
+  def send_error(self, code, message=None, explain=None):
+    # Whatever was buffered is dropped, BaseHTTPRequestHandler writes the
+    # error itself.
+    self.response = None
+    super(MyHandler, self).send_error(code, message, explain)
+
+  def setCacheable(self):
+    self.response.cacheable = True
+
+  def isNotModified(self, etag):
+    ifNoneMatch = self.headers.get("If-None-Match")
+    if ifNoneMatch is None:
+      return False
+    tags = [t.strip() for t in ifNoneMatch.split(",")]
+    return "*" in tags or etag in tags or "W/" + etag in tags
+
+  def flushResponse(self):
+    response = self.response
+    if response is None:
+      return
+    if response.code is None:
+      # Every request needs an answer to keep the connection in step.
+      self.send_error(500, "No response")
+      return
+    self.response = None
+    body = b"".join(response.body)
+    code = response.code
+    headers = response.headers
+    if response.cacheable and code == 200:
+      etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+      headers = headers + [("ETag", etag), ("Cache-Control", "no-cache")]
+      if self.isNotModified(etag):
+        code = 304
+        body = b""
+    self.send_response(code, response.message if code == response.code else None)
+    for (keyword, value) in headers:
+      self.send_header(keyword, value)
+    if code != 304:
+      self.send_header("Content-Length", str(len(body)))
+    self.sendDrawingIdsHeader()
+    super(MyHandler, self).end_headers()
+    self.wfile.write(body)
+    self.wfile.flush()
 
   def showAddTextScreen(self, clientId):
     logging.info("showAddTextScreen")
 
     self.send_response(200)
+    self.setCacheable()
     self.send_header('Content-type', 'text/html')
     self.end_headers()
 
@@ -271,6 +324,7 @@ class MyHandler(BaseHTTPRequestHandler):
     logging.info("showAddImageScreen")
 
     self.send_response(200)
+    self.setCacheable()
     self.send_header('Content-type', 'text/html')
     self.end_headers()
 
@@ -304,6 +358,32 @@ class MyHandler(BaseHTTPRequestHandler):
         "createdMs": c.createdMs,
         "lastAccessMs": c.lastAccessMs,
         "queueSize": c.getQueueSize(),
+        "queueBytes": c.getQueueBytes(),
+        "maxQueueBlocks": c.maxQueueBlocks,
+        "maxQueueBytes": c.maxQueueBytes,
+        "coalesce": c.getCoalesceStats(),
+        "lanes": c.getLaneStatus(),
+        "scheduled": c.getScheduledStatus(),
+        "render": self.app.renderJobs.scheduler.getClientStatus(clientId),
+        }
+
+    self.sendText(json.dumps(data))
+
+  def getServerStatus(self):
+    logging.info("getServerStatus")
+    self.send_response(200)
+    self.send_header('Content-type', 'application/json')
+    self.end_headers()
+
+    data = {
+        "numberOfClients": len(self.clientManager.getClientIds()),
+        "clients": self.clientManager.getStats(),
+        "prewarm": self.app.renderJobs.getPrewarmStatus(),
+        "wal": self.clientManager.log.getStats(),
+        "workerPid": os.getpid(),
+        "jobs": self.app.renderJobs.getStats(),
+        "layouts": layouts.getStats(),
+        "startup": self.app.getStartupStatus(),
         }
 
     self.sendText(json.dumps(data))
@@ -311,6 +391,8 @@ class MyHandler(BaseHTTPRequestHandler):
   def showMainMenu(self, message = None):
     logging.info("showMainMenu")
     self.send_response(200)
+    if message is None:
+      self.setCacheable()
     self.send_header('Content-type', 'text/html')
     self.end_headers()
     self.sendText("<html>")
@@ -335,12 +417,11 @@ class MyHandler(BaseHTTPRequestHandler):
     self.sendText("Clients<br>")
     self.sendText("<table style=\"width:100%\">")
     self.sendText("<tr><th>ID</th><th>Queue Size</th><th>Actions</th></tr>")
-    clientIds = self.clientManager.getClientIds()
-    for c in clientIds:
+    for (c, queueSize) in self.clientManager.getQueueSizes():
       self.sendText("<tr><td>")
       self.sendText(c)
       self.sendText("</td><td>")
-      self.sendText(str(self.clientManager.getClient(c).getQueueSize() ))
+      self.sendText(str(queueSize))
       self.sendText("</td><td>")
       urlEncodedArgs = urllib.parse.urlencode({CLIENT_ID:c, "size":0 })
       self.sendText("[")
@@ -380,12 +461,250 @@ class MyHandler(BaseHTTPRequestHandler):
     logging.debug("do_GET - pulled apart path and args; path: %s, args: %s",
         self.path, self.args)
 
+    # Drawings queued by a control plane request can carry a supersede key,
+    # a priority and a time (in seconds since the epoch) that they should not
+    # be drawn before.  See getClientForDrawing and addDrawing.
+    self.supersedeKey = self.args.get("supersede", [None])[0]
+    self.supersededClients = set()
+    self.drawingIds = []
+    self.streams = {}
+
     if self.isDeviceRequest():
       logging.debug("do_GET - this is a device request;")
-      self.handleDeviceRequest()
+      try:
+        self.handleDeviceRequest()
+      except (KeyError, ValueError) as e:
+        logging.info("do_GET - bad device request; e: %s", str(e))
+        self.send_error(400, "Bad device request: {}".format(str(e)))
     else:
       logging.debug("do_GET - this is (potentially) a control plane request;")
-      self.handleControlPlaneRequest()
+      self.startResponse()
+      try:
+        self.priority = parsePriority(self.args.get("priority", [None])[0])
+        notBefore = self.args.get("notBefore", [None])[0]
+        self.notBeforeMs = None
+        if notBefore is not None:
+          self.notBeforeMs = round(float(notBefore) * 1000)
+        self.handleControlPlaneRequest()
+      except (QueueFullException, scheduler.RenderBacklogException) as e:
+        self.abortStreams()
+        self.sendQueueFull(e)
+      except ValueError as e:
+        # Bad arguments: a priority, time, group or number that does not parse.
+        logging.info("do_GET - bad request; e: %s", str(e))
+        self.abortStreams()
+        self.send_error(400, str(e))
+      except KeyError as e:
+        logging.info("do_GET - missing argument; e: %s", str(e))
+        self.abortStreams()
+        self.send_error(400, "Missing argument {}".format(str(e)))
+      except Exception as e:
+        logging.exception("do_GET - failed;")
+        self.abortStreams()
+        self.send_error(500, str(e) or type(e).__name__)
+      except BaseException:
+        self.response = None
+        self.abortStreams()
+        raise
+      else:
+        self.closeStreams()
+      self.flushResponse()
+
+  def sendQueueFull(self, e):
+    # The board has too much work queued up already, to draw or to render.
+    # Tell the caller to back off and try again later rather than letting the
+    # queue grow without bound.
+    logging.info("sendQueueFull - rejecting request; e: %s", str(e))
+    self.send_response(503)
+    self.send_header('Content-type', 'application/json')
+    self.send_header('Retry-After', '60')
+    self.end_headers()
+    self.sendText(json.dumps({"error": "queue full", "message": str(e)}))
+
+  def getDrawingTarget(self):
+    # The board, or boards, that the drawings of this request go to.  ID_IWBB
+    # can be repeated or comma separated and group names a --boardGroup.
+    clientIds = []
+    for arg in self.args.get(CLIENT_ID, []):
+      clientIds += [i for i in arg.split(",") if i]
+    for name in self.args.get("group", []):
+      clientIds += self.clientManager.getGroup(name)
+    clientIds = list(dict.fromkeys(clientIds))
+
+    if len(clientIds) == 0:
+      raise ValueError("No {} or group given".format(CLIENT_ID))
+    if len(clientIds) == 1:
+      return clientIds[0]
+    return clientIds
+
+  def getClientForDrawing(self, clientId):
+    # Fetch the client that the drawings for this request are going to, or a
+    # clientmanager.ClientGroup when there is a list of them.  When the
+    # request carries a supersede key the older drawings with that key which
+    # the board has not started on are dropped first.
+    if isinstance(clientId, list):
+      for i in clientId:
+        self.getClientForDrawing(i)
+      return self.clientManager.getClientGroup(clientId)
+
+    c = self.clientManager.getOrMakeClient(clientId)
+    if self.supersedeKey and not clientId in self.supersededClients:
+      c.supersede(self.supersedeKey)
+      self.supersededClients.add(clientId)
+    return c
+
+  def addDrawing(self, c, payload):
+    # The payload is either the commands or an iterable of chunks of commands
+    # that are rendered as they are asked for.  The drawings of a request are
+    # streamed to the board as they are rendered, see
+    # clientmanager.DrawingStream, unless they are scheduled for later.
+    if self.notBeforeMs is not None:
+      drawingId = c.addNewDrawing(joinChunks(payload), self.supersedeKey,
+          self.priority, self.notBeforeMs)
+    else:
+      if not c.clientId in self.streams:
+        self.streams[c.clientId] = c.openStream(self.priority)
+      drawingId = self.streams[c.clientId].addDrawing(payload, self.supersedeKey)
+    self.drawingIds.append(drawingId)
+    return drawingId
+
+  def closeStreams(self):
+    for stream in self.streams.values():
+      stream.close()
+    self.streams = {}
+
+  def abortStreams(self):
+    for stream in self.streams.values():
+      stream.abort()
+    self.streams = {}
+
+  def end_headers(self):
+    # A buffered response has its headers ended by flushResponse.
+    if self.response is None:
+      self.sendDrawingIdsHeader()
+      super(MyHandler, self).end_headers()
+
+  def sendDrawingIdsHeader(self):
+    # Every response to a request that queued drawings carries their ids so
+    # that the caller can follow them with /drawingStatus and /waitDrawing.
+    # The drawings are only acknowledged once they are safely in the log.
+    drawingIds = getattr(self, "drawingIds", [])
+    if len(drawingIds):
+      self.clientManager.log.waitDurable()
+      self.send_header("X-Drawing-Ids", ",".join([str(i) for i in drawingIds]))
+
+  def getDrawingIdsArg(self):
+    # Drawing ids may be given as repeated drawingId args, comma separated or
+    # both.
+    result = []
+    for arg in self.args["drawingId"]:
+      result += [int(i) for i in arg.split(",") if i.strip()]
+    return result
+
+  def getDrawingStatus(self, clientId, drawingIds):
+    c = self.clientManager.getOrMakeClient(clientId)
+    data = {
+        "clientId": clientId,
+        "secondsPerBlock": round(c.getSecondsPerBlock(), 2),
+        "drawings": [c.getDrawingStatus(i) for i in drawingIds],
+        }
+
+    self.send_response(200)
+    self.send_header('Content-type', 'application/json')
+    self.end_headers()
+    self.sendText(json.dumps(data))
+
+  def waitDrawing(self, clientId, drawingIds, timeoutSeconds):
+    # Long poll until every drawing is finished.  The caller can tell from
+    # 'complete' whether the wait timed out and should be repeated.
+    c = self.clientManager.getOrMakeClient(clientId)
+    timeoutSeconds = min(max(0, timeoutSeconds), MAX_WAIT_DRAWING_SECONDS)
+    (complete, statuses) = c.waitForDrawings(drawingIds, timeoutSeconds)
+    data = {
+        "clientId": clientId,
+        "complete": complete,
+        "drawings": statuses,
+        }
+
+    self.send_response(200)
+    self.send_header('Content-type', 'application/json')
+    self.end_headers()
+    self.sendText(json.dumps(data))
+
+  def cancelDrawing(self, clientId, drawingId):
+    c = self.clientManager.getOrMakeClient(clientId)
+    cancelled = c.cancelDrawing(drawingId)
+
+    self.send_response(200)
+    self.send_header('Content-type', 'application/json')
+    self.end_headers()
+    self.sendText(json.dumps({"drawingId": drawingId, "cancelled": cancelled}))
+
+  def getBoardState(self, clientId):
+    # What the server thinks is on the board, see boardmodel.  regions=CxR
+    # adds the coverage of the board split into C by R regions, and x1, y1,
+    # x2 and y2 the coverage of that region and the strokes in it.
+    board = self.clientManager.getOrMakeClient(clientId).getBoardModel()
+    data = {"clientId": clientId}
+    data.update(board.getStatus())
+
+    regions = self.args.get("regions", [None])[0]
+    if regions is not None:
+      (columns, rows) = [int(i) for i in regions.split("x")]
+      if not (0 < columns <= boardmodel.COLUMNS and 0 < rows <= boardmodel.ROWS):
+        raise ValueError("regions must be between 1x1 and {}x{}".format(boardmodel.COLUMNS,
+          boardmodel.ROWS))
+      data["regions"] = board.getRegions(columns, rows)
+    if "x1" in self.args:
+      bounds = tuple([int(self.args[name][0]) for name in ["x1", "y1", "x2", "y2"]])
+      maxStrokes = int(self.args.get("maxStrokes", [DEFAULT_MAX_STROKES])[0])
+      data["region"] = board.getCoverage(bounds)
+      data["region"]["strokes"] = [s.getStatus() for s in board.getStrokes(bounds, maxStrokes)]
+
+    self.send_response(200)
+    self.send_header('Content-type', 'application/json')
+    self.end_headers()
+    self.sendText(json.dumps(data))
+
+  def checkJobsAvailable(self):
+    # A job is only known to the worker that took it, and the next request
+    # may go to any of them.
+    if self.app.config.workers > 1:
+      raise ValueError("Jobs are not available with --workers")
+
+  def isJobRequest(self):
+    if not "job" in self.args:
+      return False
+    self.checkJobsAvailable()
+    return True
+
+  def submitJob(self, layout, clientId, onEnqueued=None, **kwargs):
+    # Render one of layouts.LAYOUTS in the job pool and answer with 202 and
+    # the job, which /jobStatus follows.
+    job = self.app.renderJobs.submit(layout, clientId, kwargs, self.supersedeKey, self.priority,
+        self.notBeforeMs, onEnqueued)
+    self.send_response(202)
+    self.send_header('Content-type', 'application/json')
+    self.send_header('Location', "/jobStatus?jobId={}".format(job.jobId))
+    self.end_headers()
+    self.sendText(json.dumps(job.getStatus()))
+
+  def getJobIdsArg(self):
+    result = []
+    for arg in self.args["jobId"]:
+      result += [int(i) for i in arg.split(",") if i.strip()]
+    return result
+
+  def getJobStatus(self, jobIds):
+    statuses = []
+    for jobId in jobIds:
+      job = self.app.renderJobs.getJob(jobId)
+      statuses.append(job.getStatus() if job else {"jobId": jobId, "state": "unknown"})
+
+    self.send_response(200)
+    self.send_header('Content-type', 'application/json')
+    self.end_headers()
+    self.sendText(json.dumps({"jobs": statuses}))
 
   def isDeviceRequest(self):
     return self.path.startswith(DEVICE_URL_PREFIX)
@@ -394,53 +713,112 @@ class MyHandler(BaseHTTPRequestHandler):
     c = self.clientManager.getClient(clientId)
     c.clearQueue()
 
-  def erase(self, clientId, veryClean=False):
-    c = self.clientManager.getOrMakeClient(clientId)
+  def erase(self, clientId, veryClean=False, regions=None, full=False):
+    # Erase what the board model says is on the board, or the regions given,
+    # see eraseplan.  Each board of a group gets its own plan.
+    if isinstance(clientId, list):
+      for i in clientId:
+        self.erase(i, veryClean, regions, full)
+      return
+
+    c = self.getClientForDrawing(clientId)
     logging.info("erase - received a request; clientId: %s, queue size: %d, veryClean: %s", clientId,
         c.getQueueSize(), str(veryClean))
-    c.addNewDrawing(bbcs.eraseAll())
-    c.addNewDrawing(bbcs.eraseAll(offset=25, moveY=50))
+    if full:
+      plan = eraseplan.fullPlan()
+    elif regions:
+      plan = eraseplan.planErase(eraseplan.getRegionCells(regions), veryClean)
+    else:
+      board = c.getPlannedBoardModel()
+      if board is None:
+        plan = eraseplan.fullPlan()
+      else:
+        plan = eraseplan.planErase(eraseplan.getBoardCells(board), veryClean)
+    logging.info("erase - planned; clientId: %s, plan: %s", clientId, plan.getStatus())
+    for d in plan.getDrawings(self.app.bbcs):
+      self.addDrawing(c, d)
     logging.info("erase - done enqueueing work; queue size: %d", c.getQueueSize())
 
   def erasePortion(self, clientId, x1, y1, x2, y2, finalSweep):
     if not x1 < x2:
-      raise "X1 must be less than x2"
+      raise ValueError("X1 must be less than x2")
     if not y1 < y2:
-      raise "Y1 must be less than Y2"
+      raise ValueError("Y1 must be less than Y2")
 
-    c = self.clientManager.getClient(clientId)
-    c.addNewDrawing(bbcs.erasePortion(x1,y1,x2,y2,finalSweep))
+    c = self.getClientForDrawing(clientId)
+    self.addDrawing(c, self.app.bbcs.erasePortion(x1,y1,x2,y2,finalSweep))
 
   def addMockDrawing(self, clientId, size):
-    c = self.clientManager.getOrMakeClient(clientId)
-    c.addNewDrawing(mockDrawData(size))
+    c = self.getClientForDrawing(clientId)
+    self.addDrawing(c, mockDrawData(self.app.bbcs, size))
+
+  def renderLayout(self, name, drawings, clientId):
+    # The elements of a layout are rendered at once in the job pool, taking
+    # their turn with the renders for other boards.  The screen command set
+    # draws as it renders so --mockScreen renders here.
+    if self.app.config.mockScreen:
+      return layouts.render(self.app.bbcs, name, drawings)
+    return self.app.renderJobs.renderParallel(name, drawings, clientId)
+
+  def addLayout(self, clientId, name, drawings):
+    # Queue the drawings of one of the layouts in layouts.py.
+    c = self.getClientForDrawing(clientId)
+    for d in self.renderLayout(name, drawings, clientId):
+      self.addDrawing(c, d)
+    return c
 
   def addImage(self, clientId, filename, scaleFactor, x, y):
-    c = self.clientManager.getOrMakeClient(clientId)
+    self.addLayout(clientId, "image", layouts.image(filename, scaleFactor, x, y))
+
+  def getWall(self):
+    name = self.args["wall"][0]
+    if not name in self.app.walls:
+      raise ValueError("Unknown wall {}".format(name))
+    return self.app.walls[name]
+
+  def addWallDrawing(self, wall, recording):
+    # Every board of the wall gets its part of the drawing in this request so
+    # that they all start plotting at once.
+    for (clientId, commands) in wall.split(recording, self.app.bbcs):
+      self.addDrawing(self.getClientForDrawing(clientId), commands)
+
+  def addWallImage(self, wall, filename, scaleFactor, x, y):
+    (width, height) = wall.getDimensions()
 
-    i = bbimage.Image(bbcs)
+    i = bbimage.Image(bbwall.RecordingBbcs())
     i.setImageCharacteristics(scaleFactor)
+    i.setCanvasSize(width, height)
     i.genFromFile(filename)
 
     (w, h) = i.getDimensions()
 
     if y == 0:
-      y = MAX_HEIGHT - int((MAX_HEIGHT - h)/2)
+      y = height - int((height - h)/2)
     if x == 0:
-      x = int((MAX_WIDTH - w) / 2)
+      x = int((width - w) / 2)
 
-    logging.debug("addImage - getting string; w: %d, h: %d, x: %d, y: %d", 
-        w, h, x, y)
+    self.addWallDrawing(wall, i.getDrawString(x, y))
 
-    c.addNewDrawing(i.getDrawString(x, y))
+  def addWallText(self, wall, s, x, y, fontFace, size):
+    (width, height) = wall.getDimensions()
 
+    t = bbtext.Text(bbwall.RecordingBbcs())
+    t.setFontCharacteristics(fontFace, size)
+    t.setString(s)
+    t.gen()
+
+    (w, h) = t.getDimensions()
+
+    if y == 0:
+      y = int((height - h) / 2)
+    if x == 0:
+      x = int((width - w) / 2)
+
+    self.addWallDrawing(wall, t.getDrawString((x, y)))
 
   # addWeatherStartOfDay is a different type of weather view from the normal
-  # 'addWeather' mechanism.  In this one at the start of the day a call to
-  # clear the board is made and then a call to here is made.  This outlines the
-  # weather information available at the start of the day.  As the day
-  # progresses then the additional datapoints, however many there are, are
-  # added to the same board without clearing the screen.  
+  # 'addWeather' mechanism, see layouts.weatherStartOfDay.  As the day
+  # progresses addWeatherDatapoint adds a row at a time.
   #
   # Here is an example URL invocation:
   #   http://localhost:8080/weatherStartOfDay?ID_IWBB=111&dayOfWeek=Wed&dayOfMonth=2&time=12&temperature=101&minTemperature=32&maxTemperature=132&description=Cloudy&condition=CLOUDY&iconFilename=w/rain.png
@@ -449,151 +827,10 @@ class MyHandler(BaseHTTPRequestHandler):
       minTemperature, maxTemperature, description, iconFilename):
     logging.info("addWeatherStartOfDay - received the request to add the weather")
 
-    c = self.clientManager.getOrMakeClient(clientId)
-    s = ""
-
-    # The display is setup in two regions
-    #
-    # +----------------------------------------------------------------------------------+
-    # |    Weds     |                          Time 1 - Temperature  X                   |
-    # |             |                          Time 2 - Temperature  Y                   |
-    # |    DAY      |                                                                    |
-    # |  Of MONTH   |                                                                    |
-    # |             |                                                                    |
-    # |  Min/Max    |                                                                    |
-    # |   Temp      |                                                                    |
-    # +----------------------------------------------------------------------------------+
-    #        middleColumnLeft     
-    middleColumnLeft = 1000
-
-    # ---------------------------------------------
-    # Draw the vertical line separating the regions
-    # ---------------------------------------------
-    l = bbshape.VLine(bbcs)
-    l.setHeight(1000)
-    l.gen()
-    s = l.getDrawString(offsetX=middleColumnLeft, offsetY=50)
-    c.addNewDrawing(s)
-    s = ""
-
-    # ------------------
-    # Draw Left region
-    # ------------------
-
-    # Draw the day of the week (e.g., "Wed").
-    y = 850
-    x = 200
-    width = 700
-    height = 250
-    t = bbtext.Text(bbcs)
-    t.setFontCharacteristics(os.path.join(os.path.dirname(__file__),'fonts','Exo2-Bold.otf'), 256)
-    t.setString(dayOfWeek)
-    t.gen()
-    c.addNewDrawing(t.getDrawString((x, y, width, height)))
-
-    # Generate date component of the display
-    width = 700
-    height = 500
-    y = 300 + height
-    x = 210
-    
-    t = bbinversetextbox.InverseTextBox(bbcs, width, height)
-    t.setRoundedRectangle(True)
-    t.setString(dayOfMonth)
-    t.gen()
-    c.addNewDrawing(t.getDrawString(x, y))
-
-    # Draw the estimated range of min and max temperature.  
-    # This isn't super accurate but Kathi likes to see it.
-    y = 80
-    x = 225
-    width = 700
-    height = 120
-    
-    t = bbtext.Text(bbcs)
-    t.setFontCharacteristics(os.path.join(os.path.dirname(__file__),'fonts','cnc_v.ttf'), size=128, sizeBetweenCharacters=20, spaceSize=35)
-    t.setString(minTemperature + " / " + maxTemperature)
-    t.setBoxed(False)
-    t.gen()
-    c.addNewDrawing(t.getDrawString((x, y, width, height)))
-
-    # -----------------
-    # Draw right region
-    # -----------------
-    s = self.drawWeatherInfoSlotted(slot=0, x=middleColumnLeft, time=time, temperature=temperature, description=description, iconFilename=iconFilename)
-
-    c.addNewDrawing(s)
+    c = self.addLayout(clientId, "weatherStartOfDay", layouts.weatherStartOfDay(dayOfWeek,
+        dayOfMonth, time, temperature, minTemperature, maxTemperature, description, iconFilename))
     c.setNextWeatherSlot(1)
 
-    self.send_response(200)
-    self.send_header('Content-type', 'text/html')
-    self.end_headers()
-
-  def drawWeatherInfoSlotted(self, x, slot, time, temperature, description, iconFilename):
-    # Draw a single 'row' in the slotted information as the day progresses.
-    # Overall it looks like this:
-    #
-    # +----------------------------------------------------------------------------------+
-    # | Hour | am/pm |  Temperature  | Image | Description (roughly 12 characters)       |
-    # +----------------------------------------------------------------------------------+
-    #
-    hourLeft = x + 100
-    ampmLeft = x + 350
-    temperatureLeft = x + 600 
-    imageLeft = x + 1010
-    descriptionLeft = x + 1255
-
-    height = 150
-    y = 950 - (slot * 200) 
-
-    hour = time[0:2]
-    ampmString = time[-2:]
-
-    logging.info( "drawWeatherInfoSlotted - going to draw text; x: {x}, y: {y}, slot: {slot}, height: {height}, time: {time}, hour: {hour}, ampmp: {ampmString}, temperature: {temp}, description: {d}".format(x=x, y=y, slot=slot, height=height, time=time, hour=hour, ampmString=ampmString, temp=temperature, d=description))
-
-    t = bbtext.Text(bbcs)
-    t.setFontCharacteristics(os.path.join(os.path.dirname(__file__),'fonts','cnc_v.ttf'), size=164, sizeBetweenCharacters=30, spaceSize=45)
-    t.setString(hour)
-    t.setBoxed(False)
-    t.gen()
-    result = t.getDrawString((hourLeft, y))
-
-    t.setString(ampmString)
-    t.gen()
-    result += t.getDrawString((ampmLeft, y))
-
-    t.setString("- " + temperature) 
-    t.setSpaceSize(15)
-    t.gen()
-    result += t.getDrawString((temperatureLeft, y))
-
-    # Add the little circle for the degrees
-    circle = bbshape.Circle(bbcs)
-    circle.setRadius(15)
-    circle.gen()
-    result += circle.getDrawString(
-        t.getTextLowerLeftX() + t.getTextDimensions()[0], 
-        (y + t.getTextDimensions()[1]))
-
-    i = bbimage.Image(bbcs)
-    i.setImageCharacteristics(1)
-    foundFile = i.genFromFile("imgs/{}".format(iconFilename))
-
-    if not foundFile:
-      logging.info("drawWeatherInfoSlotted - could not find iconFilename, falling back to question")
-      i.genFromFile("imgs/w/question.png")
-
-    (w, h) = i.getDimensions()
-    result += i.getDrawString(imageLeft, y+h)
-
-    # Add the description
-    t.setString(description)
-    t.setBoxed(False)
-    t.gen()
-    result += t.getDrawString((descriptionLeft, y))
-
-    return result
-
   # addWeatherDatapoint will add a new datapoint to the existing weather
   # display.  This is purely addative and requires the first call to
   # addWeatherStartOfDay to be called to establish the base view and the first
@@ -601,143 +838,22 @@ class MyHandler(BaseHTTPRequestHandler):
   def addWeatherDatapoint(self, clientId, time, temperature, description, iconFilename):
     logging.info("addWeatherDatapoint - received the request to add the next line to the weather display")
 
-    c = self.clientManager.getOrMakeClient(clientId) 
+    c = self.getClientForDrawing(clientId)
     slot = c.getNextWeatherSlot()
 
     middleColumnLeft = 1000
 
-    c.addNewDrawing( self.drawWeatherInfoSlotted(slot=slot, x=middleColumnLeft, time=time, temperature=temperature, description=description, iconFilename=iconFilename))
+    self.addLayout(clientId, "weatherDatapoint", [layouts.weatherInfoSlotted(slot=slot, x=middleColumnLeft, time=time, temperature=temperature, description=description, iconFilename=iconFilename)])
     c.setNextWeatherSlot(slot+1)
 
-    self.send_response(200)
-    self.send_header('Content-type', 'text/html')
-    self.end_headers()
-
   def addWeather(self, clientId, dayOfWeek, dayOfMonth, time, temperature,
       minTemperature, maxTemperature, description, conditionString):
     logging.info("addWeather - received the request to add the weather")
-    c = self.clientManager.getOrMakeClient(clientId)
-
-    # Seperator for the date from the weather
-    l = bbshape.VLine(bbcs)
-    l.setHeight(900)
-    l.gen()
-    s = l.getDrawString(1150, 100)
-
-    rhsX = 1275
-    rhsFullWidth = 2175
-
-    # Current temperature
-    width = rhsFullWidth
-    height = 375
-    x = rhsX
-    y = 950
-    t = bbfilledtext.FilledText(bbcs, width, height)
-    t.setBoxed(True)
-    t.setFontCharacteristics(cv2.FONT_HERSHEY_SIMPLEX, 10, 25)
-    t.setString(time + " - " + temperature)
-    t.gen()
-    s += t.getDrawString(x, y)
-
-    logging.info("addWeather - going to draw the circle; t.getDimensions: %s",
-        t.getDimensions())
-
-    circle = bbshape.Circle(bbcs)
-    circle.setRadius(20)
-    circle.gen()
-    s += circle.getDrawString(
-        x + t.getTextLowerLeftX() + t.getDimensions()[0], 
-        (y - height) + (t.getDimensions()[1] + 95))
-
-    width = rhsFullWidth - 700
-    height = 225
-    x = rhsX + 600
-    y = 350
-    t = bbtext.Text(bbcs)
-    t.setFontCharacteristics(os.path.join(os.path.dirname(__file__),'fonts','Exo2-Bold.otf'), 150)
-    t.setString(minTemperature + " / " + maxTemperature)
-    t.setBoxed(False)
-    t.gen()
-    s += t.getDrawString((x, y))
-
-    width = rhsFullWidth - 700
-    height = 275
-    x = rhsX + 600
-    y = 90
-    t = bbtext.Text(bbcs)
-    t.setFontCharacteristics(os.path.join(os.path.dirname(__file__),'fonts','Exo2-Bold.otf'), 164)
-    t.setString(description)
-    t.setBoxed(False)
-    t.gen()
-    s += t.getDrawString((x, y))
-
-    c.addNewDrawing(s)
-
-    iconFile = None
-    if conditionString == "SUNNY":
-      iconFile = "imgs/sunny.png"
-    elif conditionString == "CLOUDY":
-      iconFile = "imgs/cloudy.png"
-    elif conditionString == "SNOW":
-      iconFile = "imgs/snow.png"
-    elif conditionString == "RAIN":
-      iconFile = "imgs/rain.png"
-    else:
-      logging.info("addWeather - unknown condition string; conditionString: %s",
-          conditionString)
-      iconFile = "imgs/question.png"
-
-    i = bbimage.Image(bbcs)
-    i.setImageCharacteristics(2)
-    i.genFromFile(iconFile)
-    (w, h) = i.getDimensions()
-
-    x = rhsX + 50
-    y = 490
-    c.addNewDrawing(i.getDrawString(x, y))
-
-    y = 800
-    x = 250
-    width = 700
-    height = 250
-    t = bbtext.Text(bbcs)
-    t.setFontCharacteristics(os.path.join(os.path.dirname(__file__),'fonts','Exo2-Bold.otf'), 256)
-    t.setString(dayOfWeek)
-    t.gen()
-    c.addNewDrawing(t.getDrawString((x, y, width, height)))
-
-    # Generate date component of the display
-    width = 700
-    height = 500
-    y = 140 + height
-    x = 275
-    
-    t = bbinversetextbox.InverseTextBox(bbcs, width, height)
-    t.setRoundedRectangle(True)
-    t.setString(dayOfMonth)
-    t.gen()
-    c.addNewDrawing(t.getDrawString(x, y))
-
-    self.send_response(200)
-    self.send_header('Content-type', 'text/html')
-    self.end_headers()
+    self.addLayout(clientId, "weather", layouts.weather(dayOfWeek, dayOfMonth, time,
+        temperature, minTemperature, maxTemperature, description, conditionString))
 
   def addText(self, clientId, s, x, y, fontFace, size):
-    c = self.clientManager.getOrMakeClient(clientId)
-
-    t = bbtext.Text(bbcs)
-    t.setFontCharacteristics(fontFace, size)
-    t.setString(s)
-    t.gen()
-
-    (w, h) = t.getDimensions()
-
-    if y == 0:
-      y = int((MAX_HEIGHT - h) / 2)
-    if x == 0:
-      x = int((MAX_WIDTH - w) / 2)
-
-    c.addNewDrawing(t.getDrawString((x, y)))
+    self.addLayout(clientId, "text", layouts.text(s, x, y, fontFace, size))
 
   def handleDeviceRequest(self):
     clientId = self.args[CLIENT_ID][0]
@@ -762,7 +878,7 @@ class MyHandler(BaseHTTPRequestHandler):
       self.clearQueue(clientId)
       self.showMainMenu("Queue cleared!")
     elif self.path == "/erase":
-      clientId = self.args[CLIENT_ID][0]
+      clientId = self.getDrawingTarget()
       veryClean = False
       if "VERY_CLEAN" in self.args:
         veryClean = True
@@ -772,13 +888,14 @@ class MyHandler(BaseHTTPRequestHandler):
         x2 = int(self.args["x2"][0])
         y1 = int(self.args["y1"][0])
         y2 = int(self.args["y2"][0])
-        self.erasePortion(clientId, x1, y1, x2, y2, false)
+        self.erasePortion(clientId, x1, y1, x2, y2, "finalSweep" in self.args)
       else:
-        self.erase(clientId, veryClean)
+        regions = [eraseplan.parseRegion(r) for r in self.args.get("region", [])]
+        self.erase(clientId, veryClean, regions, "full" in self.args)
 
       self.showMainMenu("Erased!")
     elif self.path == "/addMockDrawing":
-      clientId = self.args[CLIENT_ID][0]
+      clientId = self.getDrawingTarget()
       size = int(self.args["size"][0])
       self.addMockDrawing(clientId, size)
       self.showMainMenu("Mock drawing added!")
@@ -797,8 +914,12 @@ class MyHandler(BaseHTTPRequestHandler):
         filename = self.args["filename"][0]
         x = int(self.args["x"][0])
         y = int(self.args["y"][0])
-        self.addImage(clientId, filename, scaleFactor, x, y)
-        self.showMainMenu("Image added!")
+        if self.isJobRequest():
+          self.submitJob("image", self.getDrawingTarget(), filename=filename,
+              scaleFactor=scaleFactor, x=x, y=y)
+        else:
+          self.addImage(self.getDrawingTarget(), filename, scaleFactor, x, y)
+          self.showMainMenu("Image added!")
 
     elif self.path == "/addTextScreen":
       clientId = self.args[CLIENT_ID][0]
@@ -813,11 +934,31 @@ class MyHandler(BaseHTTPRequestHandler):
         s = self.args["s"][0]
         x = int(self.args["x"][0])
         y = int(self.args["y"][0])
-        self.addText(clientId, s, x, y, f, size)
-        self.showMainMenu("Text added!")
+        if self.isJobRequest():
+          self.submitJob("text", self.getDrawingTarget(), s=s, x=x, y=y, fontFace=f, size=size)
+        else:
+          self.addText(self.getDrawingTarget(), s, x, y, f, size)
+          self.showMainMenu("Text added!")
+
+    elif self.path == "/wallImage":
+      scaleFactor = float(self.args.get("scaleFactor", [0])[0])
+      filename = self.args["filename"][0]
+      x = int(self.args.get("x", [0])[0])
+      y = int(self.args.get("y", [0])[0])
+      self.addWallImage(self.getWall(), filename, scaleFactor, x, y)
+      self.showMainMenu("Image added to the wall!")
+
+    elif self.path == "/wallText":
+      size = int(self.args["size"][0])
+      f = self.args["f"][0]
+      s = self.args["s"][0]
+      x = int(self.args.get("x", [0])[0])
+      y = int(self.args.get("y", [0])[0])
+      self.addWallText(self.getWall(), s, x, y, f, size)
+      self.showMainMenu("Text added to the wall!")
 
     elif self.path == "/weather":
-      clientId = self.args[CLIENT_ID][0]
+      clientId = self.getDrawingTarget()
       dayOfWeek = self.args["dayOfWeek"][0]
       dayOfMonth = self.args["dayOfMonth"][0]
       time = self.args["time"][0]
@@ -826,13 +967,18 @@ class MyHandler(BaseHTTPRequestHandler):
       maxTemperature = self.args["maxTemperature"][0]
       description = self.args["description"][0]
       condition = self.args["condition"][0]
-      self.addWeather(clientId, dayOfWeek, dayOfMonth, time, temperature,
-          minTemperature, maxTemperature, description, condition)
+      if self.isJobRequest():
+        self.submitJob("weather", clientId, dayOfWeek=dayOfWeek, dayOfMonth=dayOfMonth,
+            time=time, temperature=temperature, minTemperature=minTemperature,
+            maxTemperature=maxTemperature, description=description, conditionString=condition)
+      else:
+        self.addWeather(clientId, dayOfWeek, dayOfMonth, time, temperature,
+            minTemperature, maxTemperature, description, condition)
 
-      self.showMainMenu("Showed weather")
+        self.showMainMenu("Showed weather")
 
     elif self.path == "/weatherStartOfDay":
-      clientId = self.args[CLIENT_ID][0]
+      clientId = self.getDrawingTarget()
       dayOfWeek = self.args["dayOfWeek"][0]
       dayOfMonth = self.args["dayOfMonth"][0]
       time = self.args["time"][0]
@@ -841,13 +987,19 @@ class MyHandler(BaseHTTPRequestHandler):
       maxTemperature = self.args["maxTemperature"][0]
       description = self.args["description"][0]
       iconFilename = self.args["iconFilename"][0]
-      self.addWeatherStartOfDay(clientId, dayOfWeek, dayOfMonth, time, temperature,
-          minTemperature, maxTemperature, description, iconFilename)
+      if self.isJobRequest():
+        self.submitJob("weatherStartOfDay", clientId, lambda c: c.setNextWeatherSlot(1),
+            dayOfWeek=dayOfWeek, dayOfMonth=dayOfMonth, time=time, temperature=temperature,
+            minTemperature=minTemperature, maxTemperature=maxTemperature,
+            description=description, iconFilename=iconFilename)
+      else:
+        self.addWeatherStartOfDay(clientId, dayOfWeek, dayOfMonth, time, temperature,
+            minTemperature, maxTemperature, description, iconFilename)
 
-      self.showMainMenu("Showed weather start of day")
+        self.showMainMenu("Showed weather start of day")
 
     elif self.path == "/weatherDatapoint":
-      clientId = self.args[CLIENT_ID][0]
+      clientId = self.getDrawingTarget()
       time = self.args["time"][0]
       temperature = self.args["temperature"][0]
       description = self.args["description"][0]
@@ -862,6 +1014,28 @@ class MyHandler(BaseHTTPRequestHandler):
       text = self.args["TEXT"][0]
 
       self.enqueueText(clientId, text)
+    elif self.path == "/cancel":
+      clientId = self.args[CLIENT_ID][0]
+      drawingId = int(self.args["drawingId"][0])
+      self.cancelDrawing(clientId, drawingId)
+    elif self.path == "/jobStatus":
+      self.checkJobsAvailable()
+      self.getJobStatus(self.getJobIdsArg())
+    elif self.path == "/drawingStatus":
+      clientId = self.args[CLIENT_ID][0]
+      self.getDrawingStatus(clientId, self.getDrawingIdsArg())
+    elif self.path == "/waitDrawing":
+      clientId = self.args[CLIENT_ID][0]
+      timeoutSeconds = float(self.args.get("timeout", [DEFAULT_WAIT_DRAWING_SECONDS])[0])
+      self.waitDrawing(clientId, self.getDrawingIdsArg(), timeoutSeconds)
+    elif self.path == "/boardState":
+      self.getBoardState(self.args[CLIENT_ID][0])
+    elif self.path == "/forgetBoardState":
+      clientId = self.args[CLIENT_ID][0]
+      self.clientManager.getOrMakeClient(clientId).forgetBoardModel()
+      self.getBoardState(clientId)
+    elif self.path == "/serverStatus":
+      self.getServerStatus()
     elif self.path.startswith("/status"):
       clientId = self.args[CLIENT_ID][0]
 
@@ -880,8 +1054,8 @@ class MyHandler(BaseHTTPRequestHandler):
       c.popQueueUntilBlockNumber(ackBlockNumber)
 
     try:
-      (blockNumber, data) = c.getNextBlock(timeoutSeconds=10)
-      self.sendDeviceResult(data)
+      (blockNumber, header, body) = c.getNextBlock(timeoutSeconds=DEVICE_WAIT_SECONDS)
+      self.sendDeviceResult(header, body)
     except NoWorkException:
       self.sendDeviceEmptyResult()
 
@@ -897,18 +1071,23 @@ class MyHandler(BaseHTTPRequestHandler):
       self.send_header("Content-Length", "2")
       self.end_headers()
       self.sendText("OK")
+      self.wfile.flush()
     except BaseException as e:
       logging.warn("sendingDeviceEmptyResult - got an exception; e: %s", str(e))
 
-  def sendDeviceResult(self, data):
+  def sendDeviceResult(self, header, body):
     logging.info("sendDeviceResult - onEnter;")
 
+    # The header is only a few bytes and the body is a view straight into the
+    # queued drawing so neither is copied into a combined buffer.
     try:
       self.send_response(200)
       self.send_header('Content-type', 'text/html')
-      self.send_header("Content-Length", str(len(data)))
+      self.send_header("Content-Length", str(len(header) + len(body)))
       self.end_headers()
-      self.wfile.write(data)
+      self.wfile.write(header)
+      self.wfile.write(body)
+      self.wfile.flush()
     except BaseException as e:
       logging.warn("sendDeviceResult - got an exception; e: %s", str(e))
 
@@ -916,18 +1095,112 @@ class MyHandler(BaseHTTPRequestHandler):
   def do_POST(self):
     # TODO: I need to accept post requests for images and other 
     # use cases.  Must extend/write this.
-    body = self.rfile.read(int(self.headers.getheader('Content-Length')))
+    # The body is read, even though it is not used yet, so that the next
+    # request on the connection starts in the right place.
+    body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
 
     self.send_response(200)
     self.send_header("Content-Type", "text/ascii")
     self.send_header("Content-Length", "2")
     self.end_headers()
-    self.wfile.write("OK")
+    self.wfile.write(b"OK")
   
-def main():
-  clientManager = ClientManager()
+class App(object):
+  # One server: its options, the boards and their queues, the render pool and
+  # the handler class that answers the requests for them.
+  def __init__(self, config, bbcs, clientManager, renderJobs, walls):
+    self.config = config
+    self.bbcs = bbcs
+    self.clientManager = clientManager
+    self.renderJobs = renderJobs
+    self.walls = walls
+    self.createdTime = time.time()
+    self.startedTime = None
+    # A class of its own so that the handlers of one App never see another's.
+    self.handler = type("MyHandler", (MyHandler,), {"app": self})
+
+  def start(self):
+    # Start the threads and processes the server needs.  Threads do not
+    # survive a fork so with --workers this is done in every worker.
+    if self.config.store:
+      self.clientManager.start()
+    self.clientManager.startEvictor()
+    if not self.config.mockScreen:
+      self.renderJobs.start()
+    self.startedTime = time.time()
+
+  def shutdown(self):
+    self.renderJobs.shutdown()
+
+  def getStartupStatus(self):
+    return {
+        "createdMs": round(self.createdTime * 1000),
+        "startedMs": None if self.startedTime is None else round(self.startedTime * 1000),
+        # The slow modules this process has had to import so far.  Until a
+        # request needs one the boards are served without them.
+        "loaded": lazy.getLoaded(),
+        }
+
+def createApp(config):
+  # Build the server for config, as returned by parseConfig, without
+  # serving anything.  The queues are recovered from the log or the store so
+  # the boards can be sent their work as soon as the App is served.  Nothing
+  # here imports OpenCV or freetype, the renders do that when they first
+  # need them.
+  if config.mockScreen:
+    # The screen command set draws in an OpenCV window.
+    import screen_bbcs
+    b = screen_bbcs.Bbcs()
+  else:
+    b = bbcs.Bbcs()
+  if config.store:
+    clientManager = sharedstore.SharedClientManager(config.store, b, config.maxQueueBytes,
+        config.maxQueueBlocks, not config.noCoalesce, parseBoardGroups(config.boardGroup),
+        config.clientTtl)
+  else:
+    log = None
+    if config.walDir:
+      log = wal.WriteAheadLog(config.walDir, config.walSegmentBytes, config.walCommitDelayMs)
+    clientManager = ClientManager(b, config.maxQueueBytes, config.maxQueueBlocks,
+        not config.noCoalesce, parseBoardGroups(config.boardGroup), log, config.clientTtl)
+  clientManager.recover()
+  renderJobs = jobs.JobManager(clientManager, config.jobProcesses, config.prewarm,
+      config.renderNice, config.maxRendersPerClient, config.maxQueuedRenders,
+      scheduler.parseWeights(config.renderWeight))
+  return App(config, b, clientManager, renderJobs, parseWalls(config.wall))
+
+def watchParent(parentPid):
+  # A worker process goes when the process that forked it does, however that
+  # process ended.
+  while os.getppid() == parentPid:
+    time.sleep(1)
+  logging.info("watchParent - parent has exited, stopping; parentPid: %d", parentPid)
+  os._exit(0)
+
+def main(argv=None):
+  config = parseConfig(argv)
+  app = createApp(config)
+
+  if config.asyncio:
+    app.start()
+    server = asyncserver.AsyncServer(app.clientManager, app.handler, config.port,
+        DEVICE_URL_PREFIX, CLIENT_ID, DEVICE_WAIT_SECONDS, config.asyncioThreads,
+        config.keepAliveTimeout)
+    try:
+      server.serve()
+    except KeyboardInterrupt:
+      logging.info("^C received, shutting down server")
+    finally:
+      app.shutdown()
+    logging.info("Stopping...")
+    return
+
+  workers = []
   try:
-    handler = partial(MyHandler, clientManager)
+    # The socket timeout closes a persistent connection that sits idle, so
+    # that it does not keep its thread.
+    app.handler.timeout = config.keepAliveTimeout
+    handler = partial(app.handler, app.clientManager)
     if use_threaded_server:
         logging.info(f"Using threading HTTP Server")
         server = ThreadingHTTPServer(('', config.port), handler)
@@ -935,11 +1208,28 @@ def main():
         logging.info(f"Using standard HTTP Server")
         server = HTTPServer(('', config.port), handler)
 
+    # Pre-fork: every worker accepts connections on the socket bound above.
+    # Threads do not survive a fork so anything with a thread of its own is
+    # started afterwards.
+    for i in range(config.workers - 1):
+      pid = os.fork()
+      if pid == 0:
+        workers = []
+        threading.Thread(target=watchParent, args=(os.getppid(),), name="watchParent",
+            daemon=True).start()
+        break
+      workers.append(pid)
+    app.start()
+
     logging.info(f"Starting httpserver on port {config.port}...")
     server.serve_forever()
   except KeyboardInterrupt:
     logging.info("^C received, shutting down server")
     server.socket.close()
+  finally:
+    app.shutdown()
+    for pid in workers:
+      os.kill(pid, signal.SIGTERM)
   logging.info("Stopping...")
 
 if __name__ == '__main__':
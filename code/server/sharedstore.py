@@ -0,0 +1,802 @@
+import contextlib
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+import boardmodel
+import wal
+from clientmanager import (Client, ClientManager, NoWorkException, QueueFullException,
+    ACCESS_RESOLUTION_MS, DEFAULT_CLIENT_TTL_SECONDS, PRIORITY_NAMES, PRIORITY_NORMAL, BLOCK_NUMBER_WINDOW, DEFAULT_SECONDS_PER_BLOCK,
+    MAX_FINISHED_DRAWINGS, DRAWING_CANCELLED, DRAWING_CLEARED, DRAWING_DONE, DRAWING_DRAWING,
+    DRAWING_QUEUED, DRAWING_SCHEDULED, DRAWING_SUPERSEDED, DRAWING_UNKNOWN,
+    FINAL_DRAWING_STATES, applyBlocks, blockNumberDistance, joinChunks, nextDrawingId,
+    toBlockNumber, useDrawingIds)
+
+# Lets several server processes share the boards and their queues so that a
+# long render in one of them does not hold up the device requests handled by
+# the others.  The queues live in an SQLite database in WAL mode, which the
+# processes read and write with short transactions, and a Waker replaces the
+# Condition that device requests wait on in the single process server.
+#
+# Drawings are kept one row each.  Which drawings make up the session a board
+# is drawing, and how far it has got, is kept with the board.  Each process
+# turns the drawings of a session into blocks itself, the same way
+# ClientManager does, and keeps the result for as long as the board is on
+# that session.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS clients (
+  clientId TEXT PRIMARY KEY,
+  createdMs INTEGER NOT NULL,
+  lastAccessMs INTEGER NOT NULL,
+  numberOfAccesses INTEGER NOT NULL DEFAULT 1,
+  nextSequence INTEGER NOT NULL DEFAULT 1,
+  firstSequence INTEGER,
+  sessionIds TEXT,
+  sessionPriority INTEGER,
+  sessionBlocks INTEGER NOT NULL DEFAULT 0,
+  sessionBytes INTEGER NOT NULL DEFAULT 0,
+  blocksAcked INTEGER NOT NULL DEFAULT 0,
+  sentSequence INTEGER,
+  sentMs INTEGER,
+  secondsPerBlock REAL NOT NULL DEFAULT {secondsPerBlock},
+  measuredBlocks INTEGER NOT NULL DEFAULT 0,
+  nextWeatherSlot INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS drawings (
+  seq INTEGER PRIMARY KEY AUTOINCREMENT,
+  clientId TEXT NOT NULL,
+  drawingId INTEGER NOT NULL,
+  supersedeKey TEXT,
+  priority INTEGER NOT NULL,
+  notBeforeMs INTEGER,
+  enqueuedMs INTEGER NOT NULL,
+  blocks INTEGER NOT NULL,
+  bytes INTEGER NOT NULL,
+  state TEXT NOT NULL,
+  payload BLOB
+);
+CREATE UNIQUE INDEX IF NOT EXISTS drawingsById ON drawings (clientId, drawingId);
+CREATE INDEX IF NOT EXISTS drawingsByState ON drawings (clientId, state, priority, seq);
+CREATE TABLE IF NOT EXISTS lanes (
+  clientId TEXT NOT NULL,
+  priority INTEGER NOT NULL,
+  dispatched INTEGER NOT NULL DEFAULT 0,
+  totalWaitMs INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY (clientId, priority)
+);
+CREATE TABLE IF NOT EXISTS counters (
+  name TEXT PRIMARY KEY,
+  value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS boards (
+  clientId TEXT PRIMARY KEY,
+  model BLOB NOT NULL
+);
+""".format(secondsPerBlock=DEFAULT_SECONDS_PER_BLOCK)
+
+# How many drawing ids a process takes from the store at a time.
+DRAWING_ID_BATCH = 64
+
+# How long a process waits on a locked database before giving up.
+BUSY_TIMEOUT_SECONDS = 10
+
+# The longest client id, encoded, that the store takes.  A wakeup carries
+# the client id so it has to fit in one datagram of this size.
+MAX_CLIENT_ID_BYTES = 1024
+
+# How long notify waits on a process that is behind on its wakeups.
+SEND_TIMEOUT_SECONDS = 0.5
+
+def nowMs():
+  return round(time.time() * 1000)
+
+
+class Store(object):
+  # The database along with a connection per thread.
+  def __init__(self, path):
+    self.path = path
+    self.local = threading.local()
+
+  def initialize(self):
+    # Create the tables.  Uses a connection of its own that is closed again
+    # so that nothing is carried across a fork.
+    db = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT_SECONDS, isolation_level=None)
+    try:
+      db.execute("PRAGMA journal_mode=WAL")
+      db.executescript(SCHEMA)
+    finally:
+      db.close()
+
+  def connect(self):
+    db = getattr(self.local, "db", None)
+    if db is None:
+      db = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT_SECONDS, isolation_level=None)
+      db.row_factory = sqlite3.Row
+      db.execute("PRAGMA synchronous=NORMAL")
+      self.local.db = db
+    return db
+
+  @contextlib.contextmanager
+  def transaction(self):
+    # Takes the write lock up front so that read-modify-write sequences from
+    # different processes do not interleave.
+    db = self.connect()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+      yield db
+    except BaseException:
+      db.execute("ROLLBACK")
+      raise
+    db.execute("COMMIT")
+
+  @contextlib.contextmanager
+  def readTransaction(self):
+    # A consistent view of the database without the write lock, for lookups
+    # that usually find nothing to change.
+    db = self.connect()
+    db.execute("BEGIN")
+    try:
+      yield db
+    except BaseException:
+      db.execute("ROLLBACK")
+      raise
+    db.execute("COMMIT")
+
+  def reserveDrawingIds(self, count):
+    # Returns the first of count drawing ids that no other process will hand
+    # out.
+    with self.transaction() as db:
+      row = db.execute("SELECT value FROM counters WHERE name = 'drawingId'").fetchone()
+      first = row["value"] if row else 1
+      db.execute("INSERT OR REPLACE INTO counters (name, value) VALUES ('drawingId', ?)",
+          (first + count,))
+    return first
+
+
+class DrawingIds(object):
+  # Stands in for the drawing id counter of clientmanager.  Ids are taken
+  # from the store a batch at a time so they are unique across processes,
+  # though not in order across them.
+  def __init__(self, store):
+    self.store = store
+    self.lock = threading.Lock()
+    self.next = 0
+    self.end = 0
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    with self.lock:
+      if self.next == self.end:
+        self.next = self.store.reserveDrawingIds(DRAWING_ID_BATCH)
+        self.end = self.next + DRAWING_ID_BATCH
+      self.next += 1
+      return self.next - 1
+
+
+class Waker(object):
+  # Wakes up the threads of every worker process that are waiting for a
+  # client to change, such as a device request waiting for work.  Each
+  # process binds a unix datagram socket in the directory and notify sends the
+  # client id to all of them, where only the threads waiting on that client
+  # are woken.  Waiting is on a generation number per client so that a wakeup
+  # that arrives between checking for work and waiting is not missed.
+  def __init__(self, directory):
+    self.directory = directory
+    self.lock = threading.Lock()
+    # clientId -> generation.
+    self.generations = {}
+    # clientId -> [Condition, number of threads waiting] while any are.
+    self.waiting = {}
+    self.path = None
+    self.listener = None
+    self.sender = None
+
+  def start(self):
+    os.makedirs(self.directory, exist_ok=True)
+    self.path = os.path.join(self.directory, str(os.getpid()))
+    if os.path.exists(self.path):
+      os.remove(self.path)
+    self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    self.listener.bind(self.path)
+    self.sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    # A wakeup that cannot be sent is lost, so wait a little for a process
+    # that is behind on them rather than give up straight away.
+    self.sender.settimeout(SEND_TIMEOUT_SECONDS)
+    threading.Thread(target=self.run, name="waker", daemon=True).start()
+
+  def run(self):
+    # Nothing may stop this thread, every device request in the process
+    # would wait out its full timeout from then on.
+    while True:
+      try:
+        self._wake(self.listener.recv(MAX_CLIENT_ID_BYTES).decode("utf-8", errors="replace"))
+      except Exception:
+        logging.exception("run - failed to handle a wakeup;")
+
+  def _wake(self, clientId):
+    with self.lock:
+      self.generations[clientId] = self.generations.get(clientId, 0) + 1
+      entry = self.waiting.get(clientId)
+      if entry is not None:
+        entry[0].notify_all()
+
+  def notify(self, clientId):
+    self._wake(clientId)
+    message = clientId.encode("utf-8")
+    for name in os.listdir(self.directory):
+      path = os.path.join(self.directory, name)
+      if path == self.path:
+        continue
+      try:
+        self.sender.sendto(message, path)
+      except socket.timeout:
+        logging.info("notify - dropped a wakeup; path: %s, clientId: %s", path, clientId)
+      except (ConnectionRefusedError, FileNotFoundError):
+        # Left behind by a process that has exited.
+        logging.info("notify - removing stale waker; path: %s", path)
+        try:
+          os.remove(path)
+        except FileNotFoundError:
+          pass
+
+  def getGeneration(self, clientId):
+    with self.lock:
+      return self.generations.get(clientId, 0)
+
+  def wait(self, clientId, generation, timeoutSeconds):
+    with self.lock:
+      if self.generations.get(clientId, 0) != generation:
+        return
+      entry = self.waiting.get(clientId)
+      if entry is None:
+        entry = [threading.Condition(self.lock), 0]
+        self.waiting[clientId] = entry
+      entry[1] += 1
+      try:
+        entry[0].wait(timeoutSeconds)
+      finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+          del self.waiting[clientId]
+
+
+class BufferedStream(object):
+  # The DrawingStream of a SharedClient.  Blocks can only be handed out once
+  # a drawing is in the store so each drawing is queued once it is rendered
+  # rather than while it is being rendered.
+  def __init__(self, client, priority):
+    self.client = client
+    self.priority = priority
+    self.drawingIds = []
+
+  def addDrawing(self, chunks, supersedeKey=None):
+    drawingId = self.client.addNewDrawing(joinChunks(chunks), supersedeKey, self.priority)
+    self.drawingIds.append(drawingId)
+    return drawingId
+
+  def close(self):
+    pass
+
+  def abort(self):
+    for drawingId in self.drawingIds:
+      self.client.cancelDrawing(drawingId)
+
+
+class SharedClient(Client):
+  # A Client whose queue is in the Store.  Only what is needed to turn
+  # drawings into blocks and to count merges is kept in the process.
+  __slots__ = ("store", "waker", "cachedSession", "pendingAccesses")
+
+  def __init__(self, manager, clientId, row):
+    super(SharedClient, self).__init__(clientId, manager.bbcs, manager.maxQueueBytes,
+        manager.maxQueueBlocks, manager.coalesce)
+    self.store = manager.store
+    self.waker = manager.waker
+    self.createdMs = row["createdMs"]
+    self.lastAccessMs = row["lastAccessMs"]
+    self.numberOfAccesses = row["numberOfAccesses"]
+    # Lookups not yet counted in the row.
+    self.pendingAccesses = 0
+    # ((firstSequence, drawingIds), Session) for the session being drawn.
+    self.cachedSession = None
+
+  def _getRow(self, db):
+    return db.execute("SELECT * FROM clients WHERE clientId = ?", (self.clientId,)).fetchone()
+
+  def recordAccess(self):
+    # The row is only written when lastAccessMs moves on, along with the
+    # lookups since the last write, rather than a transaction per lookup.
+    self.numberOfAccesses += 1
+    self.pendingAccesses += 1
+    now = nowMs()
+    if now - self.lastAccessMs < ACCESS_RESOLUTION_MS:
+      return False
+    (self.lastAccessMs, pending, self.pendingAccesses) = (now, self.pendingAccesses, 0)
+    with self.store.transaction() as db:
+      db.execute("UPDATE clients SET lastAccessMs = ?, numberOfAccesses = numberOfAccesses + ? "
+          "WHERE clientId = ?", (now, pending, self.clientId))
+    return True
+
+  def _getSession(self, row):
+    # The blocks of the session the board is drawing, built from its
+    # drawings the first time this process needs them.
+    drawingIds = json.loads(row["sessionIds"])
+    key = (row["firstSequence"], tuple(drawingIds))
+    if self.cachedSession is not None and self.cachedSession[0] == key:
+      return self.cachedSession[1]
+
+    db = self.store.connect()
+    rows = dict([(r["drawingId"], r) for r in db.execute(
+      "SELECT drawingId, supersedeKey, payload FROM drawings WHERE clientId = ? AND state = ?",
+      (self.clientId, DRAWING_DRAWING))])
+    pieces = [(i, rows[i]["supersedeKey"], rows[i]["payload"]) for i in drawingIds if i in rows]
+    d = self._buildSession(pieces, row["sessionPriority"])
+    d.firstSequence = row["firstSequence"]
+    self.cachedSession = (key, d)
+    return d
+
+  def _getQueueTotals(self, db):
+    # (blocks, bytes) of everything queued, scheduled or still to be drawn
+    # of the current session.
+    row = self._getRow(db)
+    totals = db.execute("SELECT COALESCE(SUM(blocks), 0), COALESCE(SUM(bytes), 0) FROM drawings "
+        "WHERE clientId = ? AND state = ?", (self.clientId, DRAWING_QUEUED)).fetchone()
+    blocks = totals[0]
+    numBytes = totals[1]
+    if row["firstSequence"] is not None and row["sessionBlocks"]:
+      remaining = row["sessionBlocks"] - row["blocksAcked"]
+      blocks += remaining
+      numBytes += row["sessionBytes"] * remaining // row["sessionBlocks"]
+    return (blocks, numBytes)
+
+  def _checkStoreCapacity(self, db, numBytes, numBlocks):
+    (queueBlocks, queueBytes) = self._getQueueTotals(db)
+    overBytes = self.maxQueueBytes and queueBytes + numBytes > self.maxQueueBytes
+    overBlocks = self.maxQueueBlocks and queueBlocks + numBlocks > self.maxQueueBlocks
+    if overBytes or overBlocks:
+      logging.info("_checkStoreCapacity - rejecting drawing; clientId: %s, numBytes: %d, numBlocks: %d",
+          self.clientId, numBytes, numBlocks)
+      raise QueueFullException(self.clientId, queueBytes, queueBlocks, numBytes, numBlocks)
+
+  def checkCapacity(self, numBytes, numBlocks):
+    self._checkStoreCapacity(self.store.connect(), numBytes, numBlocks)
+
+  def _insertDrawing(self, db, drawingId, supersedeKey, priority, notBeforeMs, payload):
+    d = self._buildSession([(drawingId, supersedeKey, payload)], priority)
+    self._checkStoreCapacity(db, d.getBytesRemaining(), d.getNumberOfBlocks())
+    db.execute("INSERT INTO drawings (clientId, drawingId, supersedeKey, priority, notBeforeMs, "
+        "enqueuedMs, blocks, bytes, state, payload) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (self.clientId, drawingId, supersedeKey, priority, notBeforeMs, nowMs(),
+          d.getNumberOfBlocks(), d.getBytesRemaining(), DRAWING_QUEUED, bytes(payload)))
+    return d
+
+  def addNewDrawing(self, payload, supersedeKey=None, priority=PRIORITY_NORMAL,
+      notBeforeMs=None, drawingId=None):
+    if drawingId is None:
+      drawingId = nextDrawingId()
+    if len(payload) + len(self._getFooter()) == 0:
+      # The screen command set used by --mockScreen produces no bytes at all.
+      return drawingId
+
+    with self.store.transaction() as db:
+      d = self._insertDrawing(db, drawingId, supersedeKey, priority, notBeforeMs, payload)
+    self.waker.notify(self.clientId)
+
+    logging.info("addNewDrawing - done; drawingId: %d, priority: %s, numBlocks: %d, size: %d",
+        drawingId, PRIORITY_NAMES[priority], d.getNumberOfBlocks(), d.getSize())
+    return drawingId
+
+  def addSharedSession(self, template, notBeforeMs=None):
+    # The drawings of a ClientGroup.  Each board gets rows of its own.
+    with self.store.transaction() as db:
+      for (drawingId, supersedeKey, payload) in template.getPieces():
+        self._insertDrawing(db, drawingId, supersedeKey, template.priority, notBeforeMs, payload)
+    self.waker.notify(self.clientId)
+
+  def openStream(self, priority=PRIORITY_NORMAL):
+    return BufferedStream(self, priority)
+
+  def _finishDrawings(self, db, drawingIds, state):
+    # Drawings that are finished keep their row, without the commands, so
+    # that their state can be looked up.
+    if len(drawingIds) == 0:
+      return
+    db.execute("UPDATE drawings SET state = ?, payload = NULL WHERE clientId = ? AND drawingId IN ({})".format(
+      ",".join(["?"] * len(drawingIds))), [state, self.clientId] + list(drawingIds))
+    finalStates = ",".join(["?"] * len(FINAL_DRAWING_STATES))
+    db.execute("DELETE FROM drawings WHERE clientId = ? AND state IN ({0}) AND seq <= "
+        "(SELECT seq FROM drawings WHERE clientId = ? AND state IN ({0}) ORDER BY seq DESC "
+        "LIMIT 1 OFFSET ?)".format(finalStates),
+        [self.clientId] + FINAL_DRAWING_STATES + [self.clientId] + FINAL_DRAWING_STATES +
+        [MAX_FINISHED_DRAWINGS])
+
+  def _dropQueued(self, where, args, state):
+    with self.store.transaction() as db:
+      dropped = [r["drawingId"] for r in db.execute(
+        "SELECT drawingId FROM drawings WHERE clientId = ? AND state = ? AND " + where,
+        [self.clientId, DRAWING_QUEUED] + args)]
+      self._finishDrawings(db, dropped, state)
+    if len(dropped):
+      self.waker.notify(self.clientId)
+    return dropped
+
+  def supersede(self, supersedeKey):
+    dropped = self._dropQueued("supersedeKey = ?", [supersedeKey], DRAWING_SUPERSEDED)
+    logging.info("supersede - done; supersedeKey: %s, dropped: %s", supersedeKey, dropped)
+    return dropped
+
+  def cancelDrawing(self, drawingId):
+    dropped = self._dropQueued("drawingId = ?", [drawingId], DRAWING_CANCELLED)
+    logging.info("cancelDrawing - done; drawingId: %d, dropped: %s", drawingId, dropped)
+    return len(dropped) > 0
+
+  def clearQueue(self):
+    with self.store.transaction() as db:
+      row = self._getRow(db)
+      cleared = [r["drawingId"] for r in db.execute(
+        "SELECT drawingId FROM drawings WHERE clientId = ? AND state IN (?, ?)",
+        (self.clientId, DRAWING_QUEUED, DRAWING_DRAWING))]
+      self._finishDrawings(db, cleared, DRAWING_CLEARED)
+      if row["firstSequence"] is not None:
+        self._endSession(db, row["firstSequence"] + row["sessionBlocks"])
+    self.waker.notify(self.clientId)
+
+  def _endSession(self, db, nextSequence):
+    db.execute("UPDATE clients SET nextSequence = ?, firstSequence = NULL, sessionIds = NULL, "
+        "sessionPriority = NULL, sessionBlocks = 0, sessionBytes = 0, blocksAcked = 0 "
+        "WHERE clientId = ?", (nextSequence, self.clientId))
+
+  def _startSession(self, db, row):
+    # Make a session out of the drawings at the head of the highest priority
+    # lane that has drawings due, merging them when coalescing, and give it
+    # the next block sequence numbers.  Returns False if there is nothing to
+    # do.
+    now = nowMs()
+    due = ("clientId = ? AND state = ? AND (notBeforeMs IS NULL OR notBeforeMs <= ?)")
+    priority = db.execute("SELECT MIN(priority) FROM drawings WHERE " + due,
+        (self.clientId, DRAWING_QUEUED, now)).fetchone()[0]
+    if priority is None:
+      return False
+
+    rows = db.execute("SELECT drawingId, supersedeKey, payload, enqueuedMs, blocks FROM drawings "
+        "WHERE " + due + " AND priority = ? ORDER BY seq" + ("" if self.coalesce else " LIMIT 1"),
+        (self.clientId, DRAWING_QUEUED, now, priority)).fetchall()
+    drawingIds = [r["drawingId"] for r in rows]
+    enqueuedMs = min([r["enqueuedMs"] for r in rows])
+    d = self._buildSession([(r["drawingId"], r["supersedeKey"], r["payload"]) for r in rows],
+        priority, enqueuedMs)
+    d.firstSequence = row["nextSequence"]
+    if len(rows) > 1:
+      self.coalesceStats["drawingsMerged"] += len(rows) - 1
+      self.coalesceStats["blocksSaved"] += sum([r["blocks"] for r in rows]) - d.getNumberOfBlocks()
+
+    db.execute("UPDATE drawings SET state = ? WHERE clientId = ? AND drawingId IN ({})".format(
+      ",".join(["?"] * len(drawingIds))), [DRAWING_DRAWING, self.clientId] + drawingIds)
+    db.execute("UPDATE clients SET firstSequence = ?, sessionIds = ?, sessionPriority = ?, "
+        "sessionBlocks = ?, sessionBytes = ?, blocksAcked = 0 WHERE clientId = ?",
+        (d.firstSequence, json.dumps(drawingIds), priority, d.getNumberOfBlocks(),
+          d.getBytesRemaining(), self.clientId))
+    db.execute("INSERT OR IGNORE INTO lanes (clientId, priority) VALUES (?, ?)",
+        (self.clientId, priority))
+    db.execute("UPDATE lanes SET dispatched = dispatched + 1, totalWaitMs = totalWaitMs + ? "
+        "WHERE clientId = ? AND priority = ?", (now - enqueuedMs, self.clientId, priority))
+    self.cachedSession = ((d.firstSequence, tuple(drawingIds)), d)
+
+    logging.info("_startSession - starting session; priority: %s, firstSequence: %d, numBlocks: %d",
+        PRIORITY_NAMES[priority], d.firstSequence, d.getNumberOfBlocks())
+    return True
+
+  def _findBlock(self, db, write):
+    # The block to send the board next, as getNextBlock returns it, or None
+    # and when the next scheduled drawing is due.  Without write returns None
+    # instead if the store has to change first.
+    row = self._getRow(db)
+    if row["firstSequence"] is None and self._hasDueDrawings(db):
+      if not write:
+        return None
+      if self._startSession(db, row):
+        row = self._getRow(db)
+    if row["firstSequence"] is None or row["blocksAcked"] >= row["sessionBlocks"]:
+      nextDueMs = db.execute("SELECT MIN(notBeforeMs) FROM drawings WHERE clientId = ? AND state = ?",
+          (self.clientId, DRAWING_QUEUED)).fetchone()[0]
+      return (None, nextDueMs)
+
+    index = row["blocksAcked"]
+    sequence = row["firstSequence"] + index
+    if row["sentSequence"] != sequence:
+      if not write:
+        return None
+      # Only the first time a block goes out counts towards how long the
+      # board takes to draw it.
+      db.execute("UPDATE clients SET sentSequence = ?, sentMs = ? WHERE clientId = ?",
+          (sequence, nowMs(), self.clientId))
+    # The drawings are read in the same transaction as the row, another
+    # process may clear them as soon as it is over.
+    d = self._getSession(row)
+    blockNumber = toBlockNumber(sequence)
+    logging.info("getNextBlock - found a block; blockNumber: %d", blockNumber)
+    return ((blockNumber, self._getHeader(index == 0, blockNumber), d.getBlock(index)), None)
+
+  def _hasDueDrawings(self, db):
+    return db.execute("SELECT 1 FROM drawings WHERE clientId = ? AND state = ? AND "
+        "(notBeforeMs IS NULL OR notBeforeMs <= ?) LIMIT 1",
+        (self.clientId, DRAWING_QUEUED, nowMs())).fetchone() is not None
+
+  def getNextBlock(self, timeoutSeconds):
+    deadline = time.time() + timeoutSeconds
+    while True:
+      generation = self.waker.getGeneration(self.clientId)
+      # Most polls find a block that has been sent already, or nothing to
+      # do, so the write lock is only taken when there is something to change.
+      with self.store.readTransaction() as db:
+        result = self._findBlock(db, False)
+      if result is None:
+        with self.store.transaction() as db:
+          result = self._findBlock(db, True)
+      (block, nextDueMs) = result
+      if block is not None:
+        return block
+
+      waitSeconds = deadline - time.time()
+      if waitSeconds <= 0:
+        logging.info("getNextResult - no work available; timeoutSeconds: %d", timeoutSeconds)
+        raise NoWorkException()
+      if nextDueMs is not None:
+        waitSeconds = min(waitSeconds, max(0, nextDueMs / 1000 - time.time()))
+      self.waker.wait(self.clientId, generation, waitSeconds)
+
+  def popQueueUntilBlockNumber(self, blockNumber):
+    logging.info("popQueueUntilBlockNumber - onEnter; blockNumber: %d", blockNumber)
+    with self.store.transaction() as db:
+      row = self._getRow(db)
+      if row["firstSequence"] is None:
+        return
+
+      blocksAcked = row["blocksAcked"]
+      qBlockNumber = toBlockNumber(row["firstSequence"] + blocksAcked)
+      distance = blockNumberDistance(qBlockNumber, blockNumber)
+      if distance >= BLOCK_NUMBER_WINDOW:
+        logging.info("popQueueUntilBlockNumber - ignoring stale acknowledgement; qBlockNumber: %d, distance: %d",
+            qBlockNumber, distance)
+        return
+
+      numPopped = min(distance + 1, row["sessionBlocks"] - blocksAcked)
+      if numPopped > 0:
+        board = self._getBoardModel(db)
+        applyBlocks(board, self._getSession(row), blocksAcked, blocksAcked + numPopped)
+        db.execute("INSERT OR REPLACE INTO boards (clientId, model) VALUES (?, ?)",
+            (self.clientId, board.toBytes()))
+      blocksAcked += numPopped
+      if numPopped > 0 and row["sentMs"] is not None:
+        seconds = (nowMs() - row["sentMs"]) / 1000 / numPopped
+        secondsPerBlock = seconds
+        if row["measuredBlocks"]:
+          secondsPerBlock = 0.8 * row["secondsPerBlock"] + 0.2 * seconds
+        db.execute("UPDATE clients SET secondsPerBlock = ?, measuredBlocks = measuredBlocks + 1, "
+            "sentMs = NULL WHERE clientId = ?", (secondsPerBlock, self.clientId))
+
+      if blocksAcked >= row["sessionBlocks"]:
+        self._finishDrawings(db, json.loads(row["sessionIds"]), DRAWING_DONE)
+        self._endSession(db, row["firstSequence"] + row["sessionBlocks"])
+      else:
+        db.execute("UPDATE clients SET blocksAcked = ? WHERE clientId = ?",
+            (blocksAcked, self.clientId))
+    self.waker.notify(self.clientId)
+    logging.info("popQueueUntilBlockNumber - done with work; numPopped: %d", numPopped)
+
+  def getDrawingStatus(self, drawingId):
+    # Read in one transaction so that the session the board is drawing and
+    # its drawings agree.
+    with self.store.readTransaction() as db:
+      return self._getDrawingStatus(db, drawingId)
+
+  def _getDrawingStatus(self, db, drawingId):
+    result = {"drawingId": drawingId, "state": DRAWING_UNKNOWN, "blocks": 0,
+        "blocksAcked": 0, "estimatedSecondsRemaining": 0}
+    drawing = db.execute("SELECT * FROM drawings WHERE clientId = ? AND drawingId = ?",
+        (self.clientId, drawingId)).fetchone()
+    if drawing is None:
+      return result
+
+    row = self._getRow(db)
+    secondsPerBlock = row["secondsPerBlock"]
+    state = drawing["state"]
+    result["blocks"] = drawing["blocks"]
+    if state in FINAL_DRAWING_STATES:
+      result["state"] = state
+      if state == DRAWING_DONE:
+        result["blocksAcked"] = drawing["blocks"]
+      return result
+
+    if state == DRAWING_DRAWING and row["firstSequence"] is not None:
+      d = self._getSession(row)
+      for part in d.parts:
+        if part.drawingId == drawingId:
+          (first, last) = d.getPartBlocks(part)
+          result["blocks"] = last - first + 1
+          result["blocksAcked"] = min(max(0, row["blocksAcked"] - first), result["blocks"])
+          result["state"] = DRAWING_DRAWING
+          result["estimatedSecondsRemaining"] = round(secondsPerBlock * (last + 1 - row["blocksAcked"]), 1)
+      return result
+
+    notBeforeMs = drawing["notBeforeMs"]
+    if notBeforeMs is not None and notBeforeMs > nowMs():
+      result["state"] = DRAWING_SCHEDULED
+      result["notBeforeMs"] = notBeforeMs
+      result["estimatedSecondsRemaining"] = round(max(0, notBeforeMs / 1000 - time.time()) +
+          secondsPerBlock * drawing["blocks"], 1)
+      return result
+
+    blocksAhead = row["sessionBlocks"] - row["blocksAcked"]
+    blocksAhead += db.execute("SELECT COALESCE(SUM(blocks), 0) FROM drawings WHERE clientId = ? "
+        "AND state = ? AND (notBeforeMs IS NULL OR notBeforeMs <= ?) AND "
+        "(priority < ? OR (priority = ? AND seq < ?))",
+        (self.clientId, DRAWING_QUEUED, nowMs(), drawing["priority"], drawing["priority"],
+          drawing["seq"])).fetchone()[0]
+    result["state"] = DRAWING_QUEUED
+    result["estimatedSecondsRemaining"] = round(secondsPerBlock * (blocksAhead + drawing["blocks"]), 1)
+    return result
+
+  def waitForDrawings(self, drawingIds, timeoutSeconds):
+    deadline = time.time() + timeoutSeconds
+    while True:
+      generation = self.waker.getGeneration(self.clientId)
+      statuses = [self.getDrawingStatus(i) for i in drawingIds]
+      complete = all([s["state"] in FINAL_DRAWING_STATES for s in statuses])
+      waitSeconds = deadline - time.time()
+      if complete or waitSeconds <= 0:
+        return (complete, statuses)
+      self.waker.wait(self.clientId, generation, waitSeconds)
+
+  def _getBoardModel(self, db):
+    row = db.execute("SELECT model FROM boards WHERE clientId = ?", (self.clientId,)).fetchone()
+    if row is None:
+      return boardmodel.BoardModel()
+    return boardmodel.fromBytes(row["model"])
+
+  def getBoardModel(self):
+    return self._getBoardModel(self.store.connect())
+
+  def getPlannedBoardModel(self):
+    # See Client.getPlannedBoardModel.  The session being drawn is counted
+    # whole, which only errs further towards ink.
+    db = self.store.connect()
+    board = self._getBoardModel(db)
+    for r in db.execute("SELECT payload FROM drawings WHERE clientId = ? AND state IN (?, ?) "
+        "ORDER BY seq", (self.clientId, DRAWING_DRAWING, DRAWING_QUEUED)):
+      board.apply(r["payload"], erase=False)
+    return board
+
+  def forgetBoardModel(self):
+    with self.store.transaction() as db:
+      db.execute("DELETE FROM boards WHERE clientId = ?", (self.clientId,))
+
+  def getSecondsPerBlock(self):
+    return self._getRow(self.store.connect())["secondsPerBlock"]
+
+  def getQueueSize(self):
+    return self._getQueueTotals(self.store.connect())[0]
+
+  def getQueueBytes(self):
+    return self._getQueueTotals(self.store.connect())[1]
+
+  def getLaneStatus(self):
+    db = self.store.connect()
+    now = nowMs()
+    result = {}
+    for priority in range(len(PRIORITY_NAMES)):
+      queued = db.execute("SELECT COUNT(*), COALESCE(SUM(blocks), 0), MIN(enqueuedMs) FROM drawings "
+          "WHERE clientId = ? AND state = ? AND priority = ? AND (notBeforeMs IS NULL OR notBeforeMs <= ?)",
+          (self.clientId, DRAWING_QUEUED, priority, now)).fetchone()
+      lane = db.execute("SELECT dispatched, totalWaitMs FROM lanes WHERE clientId = ? AND priority = ?",
+          (self.clientId, priority)).fetchone()
+      (dispatched, totalWaitMs) = (lane[0], lane[1]) if lane else (0, 0)
+      result[PRIORITY_NAMES[priority]] = {
+          "sessions": queued[0],
+          "blocks": queued[1],
+          "oldestWaitMs": now - queued[2] if queued[2] is not None else 0,
+          "averageWaitMs": round(totalWaitMs / dispatched) if dispatched else 0,
+          "dispatched": dispatched,
+          }
+    return result
+
+  def getScheduledStatus(self):
+    db = self.store.connect()
+    return [{"drawingIds": [r["drawingId"]], "notBeforeMs": r["notBeforeMs"],
+        "priority": PRIORITY_NAMES[r["priority"]], "blocks": r["blocks"]}
+        for r in db.execute("SELECT drawingId, notBeforeMs, priority, blocks FROM drawings "
+          "WHERE clientId = ? AND state = ? AND notBeforeMs > ? ORDER BY notBeforeMs, drawingId",
+          (self.clientId, DRAWING_QUEUED, nowMs()))]
+
+  def getNextWeatherSlot(self):
+    return self._getRow(self.store.connect())["nextWeatherSlot"]
+
+  def setNextWeatherSlot(self, slot):
+    with self.store.transaction() as db:
+      db.execute("UPDATE clients SET nextWeatherSlot = ? WHERE clientId = ?", (slot, self.clientId))
+
+
+class SharedClientManager(ClientManager):
+  # A ClientManager for running several worker processes.  Create it before
+  # forking the workers and call start() in each of them afterwards.
+  def __init__(self, path, bbcs, maxQueueBytes, maxQueueBlocks, coalesce=True, groups=None,
+      clientTtlSeconds=DEFAULT_CLIENT_TTL_SECONDS):
+    super(SharedClientManager, self).__init__(bbcs, maxQueueBytes, maxQueueBlocks, coalesce, groups,
+        clientTtlSeconds=clientTtlSeconds)
+    self.store = Store(path)
+    self.store.initialize()
+    self.waker = Waker(path + ".wake")
+    self.lock = threading.Lock()
+
+  def start(self):
+    self.waker.start()
+    useDrawingIds(DrawingIds(self.store))
+
+  def recover(self):
+    # The store is the record, there is nothing to replay.
+    return wal.Recovery()
+
+  def getClientIds(self):
+    return [r[0] for r in self.store.connect().execute("SELECT clientId FROM clients ORDER BY clientId")]
+
+  def getQueueSizes(self):
+    # SharedClient._getQueueTotals for every client in one query.
+    return [(r[0], r[1]) for r in self.store.connect().execute(
+        "SELECT clientId, "
+        "  (SELECT COALESCE(SUM(blocks), 0) FROM drawings "
+        "    WHERE drawings.clientId = clients.clientId AND state = ?) + "
+        "  CASE WHEN firstSequence IS NOT NULL AND sessionBlocks THEN sessionBlocks - blocksAcked "
+        "    ELSE 0 END "
+        "FROM clients ORDER BY clientId", (DRAWING_QUEUED,))]
+
+  def _getClient(self, row):
+    with self.lock:
+      c = self.clientDevices.get(row["clientId"])
+      if c is None:
+        c = SharedClient(self, row["clientId"], row)
+        self.clientDevices[row["clientId"]] = c
+      return c
+
+  def getOrMakeClient(self, clientId):
+    c = self.getClient(clientId)
+    if c is None:
+      if len(clientId.encode("utf-8")) > MAX_CLIENT_ID_BYTES:
+        raise ValueError("Client id is longer than {} bytes".format(MAX_CLIENT_ID_BYTES))
+      logging.info("getOrMakeClient - creating new client; clientId: %s", clientId);
+      with self.store.transaction() as db:
+        db.execute("INSERT OR IGNORE INTO clients (clientId, createdMs, lastAccessMs) VALUES (?, ?, ?)",
+            (clientId, nowMs(), nowMs()))
+      c = self.getClient(clientId)
+    return c
+
+  def getClient(self, clientId):
+    row = self.store.connect().execute("SELECT * FROM clients WHERE clientId = ?",
+        (clientId,)).fetchone()
+    if row is None:
+      return None
+    c = self._getClient(row)
+    c.recordAccess()
+    return c
+
+  def evictIdle(self, atMs=None):
+    # The store is the cold storage.  A client that has not been looked up
+    # for the ttl is just dropped from this process and read back from its
+    # row the next time it is needed.
+    if not self.clientTtlSeconds:
+      return 0
+    if atMs is None:
+      atMs = nowMs()
+    cutoffMs = atMs - self.clientTtlSeconds * 1000
+    with self.lock:
+      idle = [i for (i, c) in self.clientDevices.items() if c.lastAccessMs < cutoffMs]
+      for i in idle:
+        del self.clientDevices[i]
+    self.numberEvicted += len(idle)
+    return len(idle)
@@ -0,0 +1,487 @@
+import collections
+import json
+import logging
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+
+# The write-ahead log keeps the queues of the ClientManager across restarts.
+# It is a logical log: every drawing is written once, as its commands, when
+# it is queued and the rest of its life is a few small records.  How drawings
+# are merged into sessions and split into blocks is not logged since it can
+# be worked out again from the drawings, except for the session the board is
+# in the middle of, whose drawings and progress are logged so that the board
+# can carry on where it was after a restart.
+#
+# Records go to numbered segment files in a directory.  Appending a record
+# only buffers it; a writer thread writes whatever has built up and fsyncs it
+# in one go (group commit) and waitDurable blocks until a record is on disk.
+# Each segment starts with a checkpoint of the session state of every client
+# and once every drawing in the oldest segments is finished those segments
+# are deleted.  Drawings still waiting in an old segment, scheduled far in
+# the future say, are copied forward so that they do not hold on to it.
+
+DEFAULT_SEGMENT_BYTES = 16 * 1024 * 1024
+DEFAULT_MAX_SEGMENTS = 4
+
+# Each record is the length of what follows the crc, the crc32 of that, the
+# record type and the length of the JSON metadata.  The metadata is followed
+# by the payload, if any.
+RECORD_HEADER = struct.Struct(">IIBI")
+CRC_START = 8
+
+RECORD_ADD = 1
+RECORD_FINISH = 2
+RECORD_START = 3
+RECORD_ACK = 4
+RECORD_END = 5
+RECORD_CHECKPOINT = 6
+
+SEGMENT_PATTERN = re.compile(r"^wal-(\d{8})\.log$")
+
+def segmentFilename(directory, index):
+  return os.path.join(directory, "wal-{:08d}.log".format(index))
+
+def encodeRecord(recordType, meta, payload=b""):
+  metaBytes = json.dumps(meta, separators=(",", ":")).encode("utf-8")
+  body = struct.pack(">BI", recordType, len(metaBytes)) + metaBytes + bytes(payload)
+  return struct.pack(">II", len(body) - 5, zlib.crc32(body)) + body
+
+def readSegment(filename):
+  # Yields (offset, length, recordType, meta, payload) for every record up to
+  # the end of the segment or the first record that was not completely
+  # written.
+  with open(filename, "rb") as f:
+    data = f.read()
+
+  offset = 0
+  while offset + RECORD_HEADER.size <= len(data):
+    (length, crc, recordType, metaLength) = RECORD_HEADER.unpack_from(data, offset)
+    end = offset + RECORD_HEADER.size + length
+    if end > len(data) or zlib.crc32(data[offset + CRC_START:end]) != crc:
+      logging.warning("readSegment - torn record, ignoring the rest of the segment; filename: %s, offset: %d",
+          filename, offset)
+      return
+    metaStart = offset + RECORD_HEADER.size
+    meta = json.loads(data[metaStart:metaStart + metaLength].decode("utf-8"))
+    yield (offset, end - offset, recordType, meta, data[metaStart + metaLength:end])
+    offset = end
+
+
+class SessionState(object):
+  # What the log knows about the session a client is drawing: the sequence
+  # number of its first block, its drawings and how many blocks are acked.
+  def __init__(self):
+    self.nextSequence = 1
+    self.firstSequence = None
+    self.drawingIds = []
+    self.blocksAcked = 0
+
+  def start(self, firstSequence, drawingIds):
+    self.firstSequence = firstSequence
+    self.drawingIds = list(drawingIds)
+    self.blocksAcked = 0
+
+  def end(self, nextSequence):
+    self.nextSequence = nextSequence
+    self.firstSequence = None
+    self.drawingIds = []
+    self.blocksAcked = 0
+
+  def join(self, drawingId):
+    # A drawing streamed into the session after the board started on it.
+    if self.firstSequence is not None and not drawingId in self.drawingIds:
+      self.drawingIds.append(drawingId)
+
+  def toMeta(self, clientId):
+    return {"clientId": clientId, "nextSequence": self.nextSequence,
+        "firstSequence": self.firstSequence, "drawingIds": self.drawingIds,
+        "blocksAcked": self.blocksAcked}
+
+  def fromMeta(self, meta):
+    self.nextSequence = meta["nextSequence"]
+    self.firstSequence = meta["firstSequence"]
+    self.drawingIds = list(meta["drawingIds"])
+    self.blocksAcked = meta["blocksAcked"]
+
+
+# A drawing that was waiting when the log was last written.
+RecoveredDrawing = collections.namedtuple("RecoveredDrawing",
+    ["drawingId", "supersedeKey", "priority", "notBeforeMs", "payload"])
+
+class Recovery(object):
+  # Everything read back from the log: the session state of every client and
+  # the drawings, in the order they were queued, that are not finished.
+  def __init__(self):
+    self.sessions = collections.OrderedDict()
+    self.drawings = collections.OrderedDict()
+    self.maxDrawingId = 0
+    self.stats = {"segments": 0, "records": 0, "bytes": 0, "drawings": 0,
+        "seconds": 0.0}
+
+  def getSession(self, clientId):
+    if not clientId in self.sessions:
+      self.sessions[clientId] = SessionState()
+      self.drawings[clientId] = collections.OrderedDict()
+    return self.sessions[clientId]
+
+
+class Segment(object):
+  def __init__(self, index):
+    self.index = index
+    # How many of the drawings whose newest copy is in this segment are not
+    # finished yet.
+    self.live = 0
+    # Set once the live drawings have been copied to a newer segment; the
+    # segment can go once that copy is durable.
+    self.movedLsn = None
+
+
+class NullLog(object):
+  # Used when the server is run without a log directory.
+  def open(self):
+    return Recovery()
+
+  def close(self):
+    pass
+
+  def logAdd(self, clientId, drawingId, supersedeKey, priority, notBeforeMs, payload,
+      current=False):
+    return 0
+
+  def logFinished(self, clientId, drawingIds, state):
+    return 0
+
+  def logStart(self, clientId, firstSequence, drawingIds):
+    return 0
+
+  def logAck(self, clientId, blocksAcked):
+    return 0
+
+  def logEnd(self, clientId, nextSequence):
+    return 0
+
+  def waitDurable(self, lsn=None):
+    pass
+
+  def getStats(self):
+    return None
+
+
+class WriteAheadLog(object):
+  def __init__(self, directory, segmentBytes=DEFAULT_SEGMENT_BYTES, commitDelayMs=0,
+      maxSegments=DEFAULT_MAX_SEGMENTS, fsync=True):
+    self.directory = directory
+    self.segmentBytes = segmentBytes
+    self.commitDelaySeconds = commitDelayMs / 1000
+    self.maxSegments = maxSegments
+    self.fsync = fsync
+    self.condition = threading.Condition()
+    # (segment index, record) waiting for the writer thread.
+    self.buffer = []
+    self.appendedLsn = 0
+    self.durableLsn = 0
+    self.segments = collections.OrderedDict()
+    self.activeIndex = 0
+    self.activeSize = 0
+    # (clientId, drawingId) -> (segment index, offset, length) of the newest
+    # copy of every drawing that is not finished.
+    self.locations = {}
+    self.sessions = {}
+    self.closed = False
+    self.thread = None
+    # Only touched by the writer thread.
+    self.file = None
+    self.fileIndex = None
+    self.stats = {
+        "records": 0,
+        "bytes": 0,
+        "commits": 0,
+        "maxRecordsPerCommit": 0,
+        "commitSeconds": 0.0,
+        "copiedRecords": 0,
+        "deletedSegments": 0,
+        "recovery": None,
+        }
+
+  def open(self):
+    # Read back every segment, start a new one and start the writer thread.
+    # Returns the Recovery for ClientManager.recover.
+    start = time.time()
+    os.makedirs(self.directory, exist_ok=True)
+    recovery = Recovery()
+    finished = set()
+    indexes = sorted([int(m.group(1)) for m in
+        [SEGMENT_PATTERN.match(f) for f in os.listdir(self.directory)] if m])
+    for index in indexes:
+      segment = Segment(index)
+      self.segments[index] = segment
+      filename = segmentFilename(self.directory, index)
+      recovery.stats["segments"] += 1
+      recovery.stats["bytes"] += os.path.getsize(filename)
+      for (offset, length, recordType, meta, payload) in readSegment(filename):
+        recovery.stats["records"] += 1
+        self._replay(recovery, finished, segment, offset, length, recordType, meta, payload)
+
+    self.sessions = recovery.sessions
+    with self.condition:
+      self._rotate(max(indexes + [0]) + 1)
+
+    recovery.stats["drawings"] = sum([len(d) for d in recovery.drawings.values()])
+    recovery.stats["seconds"] = round(time.time() - start, 3)
+    self.stats["recovery"] = recovery.stats
+    logging.info("open - replayed the log; directory: %s, stats: %s", self.directory,
+        recovery.stats)
+
+    self.thread = threading.Thread(target=self.run, name="wal", daemon=True)
+    self.thread.start()
+    return recovery
+
+  def _replay(self, recovery, finished, segment, offset, length, recordType, meta, payload):
+    clientId = meta["clientId"]
+    session = recovery.getSession(clientId)
+    drawings = recovery.drawings[clientId]
+    if recordType == RECORD_ADD:
+      key = (clientId, meta["drawingId"])
+      recovery.maxDrawingId = max(recovery.maxDrawingId, meta["drawingId"])
+      if key in finished:
+        # A copy made while the drawing was being finished.
+        return
+      drawings[meta["drawingId"]] = RecoveredDrawing(meta["drawingId"], meta["supersedeKey"],
+          meta["priority"], meta["notBeforeMs"], bytes(payload))
+      self._moveLocation(key, (segment.index, offset, length))
+      if meta.get("current"):
+        session.join(meta["drawingId"])
+    elif recordType == RECORD_FINISH:
+      for drawingId in meta["drawingIds"]:
+        recovery.maxDrawingId = max(recovery.maxDrawingId, drawingId)
+        finished.add((clientId, drawingId))
+        drawings.pop(drawingId, None)
+        self._moveLocation((clientId, drawingId), None)
+    elif recordType == RECORD_START:
+      session.start(meta["firstSequence"], meta["drawingIds"])
+    elif recordType == RECORD_ACK:
+      session.blocksAcked = meta["blocksAcked"]
+    elif recordType == RECORD_END:
+      session.end(meta["nextSequence"])
+    elif recordType == RECORD_CHECKPOINT:
+      session.fromMeta(meta)
+
+  def _moveLocation(self, key, location):
+    # Record where the newest copy of a drawing is, None once it is finished.
+    previous = self.locations.pop(key, None)
+    if previous is not None:
+      self.segments[previous[0]].live -= 1
+    if location is not None:
+      self.locations[key] = location
+      self.segments[location[0]].live += 1
+
+  def _getSession(self, clientId):
+    if not clientId in self.sessions:
+      self.sessions[clientId] = SessionState()
+    return self.sessions[clientId]
+
+  def _append(self, record):
+    # Returns the location of the record.
+    if self.activeSize > 0 and self.activeSize + len(record) > self.segmentBytes:
+      self._rotate(self.activeIndex + 1)
+    location = (self.activeIndex, self.activeSize, len(record))
+    self.buffer.append((self.activeIndex, record))
+    self.activeSize += len(record)
+    self.appendedLsn += 1
+    self.stats["records"] += 1
+    self.stats["bytes"] += len(record)
+    self.condition.notify_all()
+    return location
+
+  def _rotate(self, index):
+    # Start a new segment with a checkpoint of every session so that none of
+    # the older segments are needed for them.
+    self.activeIndex = index
+    self.activeSize = 0
+    self.segments[index] = Segment(index)
+    for (clientId, session) in self.sessions.items():
+      self._append(encodeRecord(RECORD_CHECKPOINT, session.toMeta(clientId)))
+
+  def logAdd(self, clientId, drawingId, supersedeKey, priority, notBeforeMs, payload,
+      current=False):
+    # current is set for a drawing that is streamed into the session that the
+    # board has already started on.
+    meta = {"clientId": clientId, "drawingId": drawingId, "supersedeKey": supersedeKey,
+        "priority": priority, "notBeforeMs": notBeforeMs}
+    if current:
+      meta["current"] = True
+    record = encodeRecord(RECORD_ADD, meta, payload)
+    with self.condition:
+      self._moveLocation((clientId, drawingId), self._append(record))
+      if current:
+        self._getSession(clientId).join(drawingId)
+      return self.appendedLsn
+
+  def logFinished(self, clientId, drawingIds, state):
+    record = encodeRecord(RECORD_FINISH, {"clientId": clientId,
+      "drawingIds": drawingIds, "state": state})
+    with self.condition:
+      self._append(record)
+      for drawingId in drawingIds:
+        self._moveLocation((clientId, drawingId), None)
+      return self.appendedLsn
+
+  def logStart(self, clientId, firstSequence, drawingIds):
+    record = encodeRecord(RECORD_START, {"clientId": clientId,
+      "firstSequence": firstSequence, "drawingIds": drawingIds})
+    with self.condition:
+      self._getSession(clientId).start(firstSequence, drawingIds)
+      self._append(record)
+      return self.appendedLsn
+
+  def logAck(self, clientId, blocksAcked):
+    record = encodeRecord(RECORD_ACK, {"clientId": clientId, "blocksAcked": blocksAcked})
+    with self.condition:
+      self._getSession(clientId).blocksAcked = blocksAcked
+      self._append(record)
+      return self.appendedLsn
+
+  def logEnd(self, clientId, nextSequence):
+    record = encodeRecord(RECORD_END, {"clientId": clientId, "nextSequence": nextSequence})
+    with self.condition:
+      self._getSession(clientId).end(nextSequence)
+      self._append(record)
+      return self.appendedLsn
+
+  def waitDurable(self, lsn=None):
+    # Block until the record with this lsn, or everything appended so far,
+    # has been written and synced.
+    with self.condition:
+      if lsn is None:
+        lsn = self.appendedLsn
+      while self.durableLsn < lsn and not self.closed:
+        self.condition.wait()
+
+  def close(self):
+    with self.condition:
+      self.closed = True
+      self.condition.notify_all()
+    if self.thread is not None:
+      self.thread.join()
+    if self.file is not None:
+      self.file.close()
+      self.file = None
+
+  def run(self):
+    while True:
+      with self.condition:
+        while len(self.buffer) == 0 and not self.closed:
+          self.condition.wait()
+        if len(self.buffer) == 0:
+          return
+        if self.commitDelaySeconds and not self.closed:
+          # Give other requests a moment to add to this commit.
+          self.condition.wait(self.commitDelaySeconds)
+        batch = self.buffer
+        self.buffer = []
+        lsn = self.appendedLsn
+
+      start = time.time()
+      self._write(batch)
+      with self.condition:
+        self.durableLsn = lsn
+        self.stats["commits"] += 1
+        self.stats["maxRecordsPerCommit"] = max(self.stats["maxRecordsPerCommit"], len(batch))
+        self.stats["commitSeconds"] += time.time() - start
+        self.condition.notify_all()
+      self._compact()
+
+  def _write(self, batch):
+    i = 0
+    while i < len(batch):
+      index = batch[i][0]
+      records = []
+      while i < len(batch) and batch[i][0] == index:
+        records.append(batch[i][1])
+        i += 1
+      if index != self.fileIndex:
+        self._sync()
+        if self.file is not None:
+          self.file.close()
+        self.file = open(segmentFilename(self.directory, index), "ab")
+        self.fileIndex = index
+        self._syncDirectory()
+      self.file.write(b"".join(records))
+    self._sync()
+
+  def _sync(self):
+    if self.file is not None:
+      self.file.flush()
+      if self.fsync:
+        os.fsync(self.file.fileno())
+
+  def _syncDirectory(self):
+    if self.fsync and hasattr(os, "O_DIRECTORY"):
+      fd = os.open(self.directory, os.O_RDONLY | os.O_DIRECTORY)
+      try:
+        os.fsync(fd)
+      finally:
+        os.close(fd)
+
+  def _compact(self):
+    # Delete the oldest segments once nothing in them is needed and copy the
+    # live drawings out of the oldest segment when there are too many.
+    deletable = []
+    toCopy = []
+    with self.condition:
+      for segment in list(self.segments.values()):
+        if segment.index >= self.fileIndex:
+          break
+        if segment.live > 0:
+          if len(self.segments) > self.maxSegments and segment.movedLsn is None:
+            toCopy = [(key, location) for (key, location) in self.locations.items()
+                if location[0] == segment.index]
+            segment.movedLsn = self.appendedLsn
+          break
+        if segment.movedLsn is not None and segment.movedLsn > self.durableLsn:
+          break
+        deletable.append(segment.index)
+        del self.segments[segment.index]
+      self.stats["deletedSegments"] += len(deletable)
+
+    for index in deletable:
+      os.remove(segmentFilename(self.directory, index))
+    if len(deletable):
+      self._syncDirectory()
+      logging.info("_compact - deleted segments; indexes: %s", deletable)
+
+    if len(toCopy):
+      self._copyForward(toCopy)
+
+  def _copyForward(self, toCopy):
+    records = []
+    with open(segmentFilename(self.directory, toCopy[0][1][0]), "rb") as f:
+      for (key, (index, offset, length)) in toCopy:
+        f.seek(offset)
+        records.append((key, (index, offset, length), f.read(length)))
+
+    with self.condition:
+      for (key, location, record) in records:
+        # Drawings finished while this was being read are left behind.
+        if self.locations.get(key) == location:
+          self._moveLocation(key, self._append(record))
+          self.stats["copiedRecords"] += 1
+      self.segments[toCopy[0][1][0]].movedLsn = self.appendedLsn
+    logging.info("_compact - copied live drawings forward; segment: %d, drawings: %d",
+        toCopy[0][1][0], len(records))
+
+  def getStats(self):
+    with self.condition:
+      result = dict(self.stats)
+      result["commitSeconds"] = round(result["commitSeconds"], 3)
+      result["appendedLsn"] = self.appendedLsn
+      result["durableLsn"] = self.durableLsn
+      result["segments"] = len(self.segments)
+      result["liveDrawings"] = len(self.locations)
+      if self.stats["commits"]:
+        result["recordsPerCommit"] = round(self.stats["records"] / self.stats["commits"], 1)
+      return result
@@ -38,6 +38,10 @@ FORECAST_WEATHER = "data/2.5/forecast/"
 CITY_ID = "5809844"
 CLIENT_ID = "2C3AE83E11C6"
 
+# Requests to the board server share a connection rather than opening one
+# each.
+boardSession = requests.Session()
+
 logging.basicConfig(level=logging.DEBUG, 
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
@@ -83,6 +87,12 @@ parser.add_argument('--weatherAPIKey',
         help='The weather API Key to use',
         required=True)
 
+parser.add_argument('--leadSeconds', 
+        type=int, 
+        help='Send scheduled updates this many seconds early and have the server hold them until the top of the hour.  '
+             'The server renders them ahead of time so the board starts drawing right on the hour.  Defaults to 0 (send on the hour).',
+        default = 0)
+
 parser.add_argument('--immediate', 
         help='Run once immediately and then according to the schedule',
         default = False, 
@@ -160,7 +170,7 @@ class WeatherManager(object):
     logging.info("determineSleepTime - all times as (hour, secondsToSleep): %s", str(results))
     return min(results, key=lambda x: x[1])
 
-  def _addWeatherDatapoint(self):
+  def _addWeatherDatapoint(self, notBefore = None):
     data = None
     self.lastFullRefresh = time.time()
     self.priorHour = time.localtime()[3]
@@ -175,7 +185,7 @@ class WeatherManager(object):
     condition = int(data["weather"][0]["id"])
     description = data["weather"][0]["description"]
 
-    (hour, hourModifier, day, dayName) = self.getDateAndTimeInformation()
+    (hour, hourModifier, day, dayName) = self.getDateAndTimeInformation(notBefore)
     timeString = "{:02d} {}".format(hour, hourModifier)
     dayString = "{:02d}".format(day)
 
@@ -212,10 +222,12 @@ class WeatherManager(object):
           'temperature': int(currentTemp),
           'iconFilename': self._mapConditionCodeToIconFile(condition),
           'description': self._mapConditionAndDescriptionToStandardDescription(condition, description.upper())}
+      if notBefore != None:
+        boardBotParams['notBefore'] = notBefore
       
       logging.info("Making request to http://{url}:{port}/weatherDatapoint - params: {params}".format(
           url=config.serverName, port=config.serverPort, params=pprint.pformat(boardBotParams)))
-      boardRequest = requests.get(
+      boardRequest = boardSession.get(
           url = "http://{url}:{port}/weatherDatapoint".format(url=config.serverName, port=config.serverPort),
           params = boardBotParams)
       return boardRequest.ok
@@ -271,23 +283,30 @@ class WeatherManager(object):
       logging.info("_runForever - going to Sleep; nextReportHour: %d, secondsToSleep: %d", 
           nextReportHour, sleepSeconds)
 
+      # With a lead time the update is sent early and the server holds on to
+      # it until the top of the hour.
+      notBefore = None
+      if config.leadSeconds > 0:
+        notBefore = int(time.time()) + sleepSeconds
+        sleepSeconds = max(0, sleepSeconds - config.leadSeconds)
+
       time.sleep(sleepSeconds)
 
       if config.doIncrementalDaily:
         logging.info("_runForever - going to do incremental daily refresh")
         t = time.time()
-        isNewDay = self.trackDayChanges()
+        isNewDay = self.trackDayChanges(notBefore)
         if isNewDay:
           logging.info("_runForever - incremental daily refresh is a new day!")
-          self.fullRefresh(resource="/weatherStartOfDay", includeIconFilename=True)
+          self.fullRefresh(resource="/weatherStartOfDay", includeIconFilename=True, notBefore=notBefore)
         else:
-          self._addWeatherDatapoint()
+          self._addWeatherDatapoint(notBefore)
       else:
         logging.info("_runForever - going to do full refresh")
         t = time.time()
-        self.trackDayChanges()
+        self.trackDayChanges(notBefore)
         self.lastFullRefresh = t
-        self.fullRefresh()
+        self.fullRefresh(notBefore=notBefore)
 
       lastReportHour = nextReportHour
 
@@ -314,12 +333,12 @@ class WeatherManager(object):
         'temperature': int(currentTemp),
         }
 
-    boardRequest = requests.get(
+    boardRequest = boardSession.get(
         url = "http://{url}:{port}/updateWeather".format(url=config.serverName, port=config.serverPort),
         params = boardBotParams)
     return boardRequest.ok
 
-  def fullRefresh(self, resource = "/weather", includeIconFilename = False, doCleanFirst = True):
+  def fullRefresh(self, resource = "/weather", includeIconFilename = False, doCleanFirst = True, notBefore = None):
     data = None
     self.lastFullRefresh = time.time()
     self.priorHour = time.localtime()[3]
@@ -338,7 +357,7 @@ class WeatherManager(object):
     tempMin = min(tempMin, currentTemp)
     tempMax = max(tempMax, currentTemp)
 
-    (hour, hourModifier, day, dayName) = self.getDateAndTimeInformation()
+    (hour, hourModifier, day, dayName) = self.getDateAndTimeInformation(notBefore)
     timeString = "{:02d} {}".format(hour, hourModifier)
     dayString = "{:02d}".format(day)
 
@@ -370,8 +389,12 @@ class WeatherManager(object):
       # do the full weather update.
       if doCleanFirst:
         logging.info("fullRefresh - doing clean first")
-        boardBotParams = {'ID_IWBB': CLIENT_ID, 'VERY_CLEAN': True}
-        boardRequest = requests.get(
+        # The supersede keys let the server drop older, unsent, updates if the
+        # board has been offline for a while.
+        boardBotParams = {'ID_IWBB': CLIENT_ID, 'VERY_CLEAN': True, 'supersede': 'weather-erase'}
+        if notBefore != None:
+          boardBotParams['notBefore'] = notBefore
+        boardRequest = boardSession.get(
             url = "http://{url}:{port}/erase".format(url=config.serverName, port=config.serverPort),
             params = boardBotParams)
         if not boardRequest.ok:
@@ -387,14 +410,17 @@ class WeatherManager(object):
           'minTemperature': int(tempMin),
           'maxTemperature': int(tempMax),
           'condition': conditionString,
+          'supersede': 'weather',
           'description': self._mapConditionAndDescriptionToStandardDescription(condition, description.upper())}
 
       if includeIconFilename:
         boardBotParams['iconFilename'] = self._mapConditionCodeToIconFile(condition),
+      if notBefore != None:
+        boardBotParams['notBefore'] = notBefore
       
       logging.info("Making request to http://{url}:{port}{resource} - params: {params}".format(
           url=config.serverName, port=config.serverPort, resource=resource, params=pprint.pformat(boardBotParams)))
-      boardRequest = requests.get(
+      boardRequest = boardSession.get(
           url = "http://{url}:{port}{resource}".format(url=config.serverName, resource=resource, port=config.serverPort),
           params = boardBotParams)
       return boardRequest.ok
@@ -402,8 +428,10 @@ class WeatherManager(object):
       logging.exception("error in contacting boardbot;")
       return False
 
-  def trackDayChanges(self):
-    d = datetime.datetime.fromtimestamp(time.time())
+  def trackDayChanges(self, t = None):
+    if t == None:
+      t = time.time()
+    d = datetime.datetime.fromtimestamp(t)
     if d.day != self.currentDay:
       self.currentDay = d.day
       logging.info("trackDayChanges - day has changed so resetting low and high;")
@@ -444,12 +472,14 @@ class WeatherManager(object):
     return r.json() 
 
 
-  def getDateAndTimeInformation(self):
+  def getDateAndTimeInformation(self, t = None):
     # Use the current time and not the time found in any web requests because those responses
     # may contain times in the past so that the information is internally consisten. 
     # (e.g., the time may be a few minutes old so that it reflects the time that temperature 
-    # readings were taken).
-    d = datetime.datetime.fromtimestamp(time.time())
+    # readings were taken).  Updates sent ahead of time pass the time they will be drawn at.
+    if t == None:
+      t = time.time()
+    d = datetime.datetime.fromtimestamp(t)
 
     hour = d.hour
     hourModifier = "AM"